@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+
+class AsyncServer():
+    """Serves the connections of a listening socket from one asyncio event loop.
+
+    A connection waiting for its next request costs only a coroutine, not a
+    thread. Once a request is readable, `serve_request(client, address)` runs on
+    a bounded thread pool with the socket in blocking mode, so the handlers the
+    threaded servers use (payload streaming, disk I/O) never block the loop.
+    The coroutine waits for the handler before looking for the next request,
+    which keeps the requests of one connection in order.
+
+    `accept(client, address)` performs the handshake and `serve_request`
+    handles one request; both return False once the connection is done.
+    """
+    def __init__(self, sock, accept, serve_request, max_connections=config.MAX_CONNECTIONS, workers=config.SERVER_WORKERS):
+        self.sock = sock
+        self.accept = accept
+        self.serve_request = serve_request
+        self.max_connections = max_connections
+        self.workers = workers
+        self.connections = set()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.slots = asyncio.Semaphore(self.max_connections)
+        self.sock.setblocking(False)
+        while True:
+            await self.slots.acquire()
+            client, address = await loop.sock_accept(self.sock)
+            task = asyncio.create_task(self._handle(client, address))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+
+    async def _handle(self, client, address):
+        loop = asyncio.get_running_loop()
+        # handlers use blocking socket calls on the worker threads
+        client.setblocking(True)
+        try:
+            await self._readable(client)
+            if not await loop.run_in_executor(self.executor, self.accept, client, address):
+                return
+            while True:
+                await self._readable(client)
+                if not await loop.run_in_executor(self.executor, self.serve_request, client, address):
+                    return
+        except Exception as e:
+            print(e)
+        finally:
+            client.close()
+            self.slots.release()
+
+    async def _readable(self, sock):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        loop.add_reader(sock.fileno(), wake)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(sock.fileno())
@@ -0,0 +1,695 @@
+"""Benchmarks for the distributed file system.
+
+Every benchmark starts its own master and chunk servers as subprocesses in a
+scratch directory, using the ports in config.py, so nothing else may be
+listening on them.
+
+    python3 benchmark.py chunk_size [--file-size MB]
+    python3 benchmark.py load [--idle N] [--clients N] [--seconds S]
+    python3 benchmark.py restart [--chunks N] [--chunks-per-file N]
+    python3 benchmark.py journal [--records N] [--threads N,N,...]
+    python3 benchmark.py placement [--chunks N]
+    python3 benchmark.py hedge [--chunks N]
+    python3 benchmark.py checksum [--file-size MB] [--reads N]
+    python3 benchmark.py compression [--file-size MB]
+    python3 benchmark.py erasure [--file-size MB] [--policies ec:K+M,...]
+    python3 benchmark.py dedup [--file-size MB] [--changed PERCENT]
+    python3 benchmark.py append [--appends N] [--append-size KB] [--records N] [--record-size BYTES] [--producers N,N,...]
+"""
+import argparse
+import contextlib
+import filecmp
+import glob
+import io
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import checksum
+import compression
+import config
+import erasure
+import journal
+import latency_tracker
+import master
+import placement
+import protocol
+import transfer
+from client import Client
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+class LocalCluster():
+    """A master and config.NUM_CHUNKS chunk servers running in a scratch directory."""
+    def __init__(self, master_args=(), chunk_args=()):
+        self.master_args = list(master_args)
+        self.chunk_args = list(chunk_args)
+        self.workdir = tempfile.mkdtemp(prefix='dfs-bench-')
+        self.master = None
+        self.chunk_servers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Starts the chunk servers and the master, returns the seconds the master took to come up."""
+        for idx in range(config.NUM_CHUNKS):
+            self.chunk_servers.append(self._spawn('chunk_server.py', str(idx), *self.chunk_args))
+        for port in config.CHUNK_PORTS:
+            self._wait_for(port)
+        return self.start_master()
+
+    def start_master(self):
+        """Starts the master and returns the seconds until it accepts connections."""
+        start = time.time()
+        self.master = self._spawn('master.py', *self.master_args)
+        self._wait_for(config.MASTER_PORT)
+        return time.time() - start
+
+    def stop_master(self):
+        self.master.terminate()
+        self.master.wait()
+
+    def stop(self):
+        for proc in [self.master] + self.chunk_servers:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def client(self):
+        client = Client()
+        client.master = protocol.connect(config.MASTER_PORT, 'client')
+        client.master_dead = False
+        return client
+
+    def _spawn(self, script, *args):
+        env = dict(os.environ, TERM='dumb')
+        return subprocess.Popen([sys.executable, os.path.join(SRC_DIR, script), *args], cwd=self.workdir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _wait_for(self, port, timeout=600):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                protocol.connect(port, 'benchmark').close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise Exception(f'Server on port {port} did not come up')
+
+
+def quiet(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def bench_chunk_size(args):
+    file_size = args.file_size * MB
+    sizes = [4096, MB, 64 * MB]
+    with LocalCluster() as cluster:
+        local_path = os.path.join(cluster.workdir, 'input')
+        with open(local_path, 'wb') as f:
+            f.write(os.urandom(file_size))
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+
+        print(f'file size {args.file_size} MB')
+        print(f'{"chunk size":>12} {"write MB/s":>12} {"read MB/s":>12}')
+        for chunk_size in sizes:
+            name = f'file_{chunk_size}'
+            start = time.time()
+            quiet(client.create_file, local_path, '/bench', name, chunk_size)
+            write_time = time.time() - start
+
+            start = time.time()
+            quiet(client.get_file, '/bench', name, local_path + '.out')
+            read_time = time.time() - start
+
+            if not filecmp.cmp(local_path, local_path + '.out', shallow=False):
+                raise Exception(f'read back data differs for chunk size {chunk_size}')
+            print(f'{chunk_size:>12} {file_size / MB / write_time:>12.2f} {file_size / MB / read_time:>12.2f}')
+        client.close_connection()
+
+
+def process_stats(pid):
+    """Returns the thread count and resident memory in MB of a process."""
+    stats = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            stats[key] = value.split()
+    return int(stats['Threads'][0]), int(stats['VmRSS'][0]) / 1024
+
+
+def process_cpu(pid):
+    """Returns the CPU seconds a process used so far."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def run_load(clients, seconds, connect, request):
+    """Runs `clients` threads sending `request` on their own connection, returns requests per second."""
+    counts = [0] * clients
+    deadline = time.time() + seconds
+
+    def worker(idx):
+        sock = connect()
+        while time.time() < deadline:
+            sock.sendall(request)
+            frame = protocol.recv_frame(sock)
+            protocol.recv_payload(sock, frame.payload_len)
+            counts[idx] += 1
+        sock.close()
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def bench_load(args):
+    # every idle connection is a socket in this process and in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f'{args.idle} idle connections per server, {args.clients} busy clients, {args.seconds}s per run')
+    print(f'{"mode":>10} {"server":>8} {"threads":>8} {"RSS MB":>8} {"ops/s":>10}')
+    for mode, flags in [('threaded', []), ('asyncio', ['--asyncio'])]:
+        with LocalCluster(master_args=flags, chunk_args=flags) as cluster:
+            transfer.write_chunk(0, 'load-test-chunk', os.urandom(4096))
+            servers = [
+                ('master', cluster.master.pid, lambda: protocol.connect(config.MASTER_PORT, 'client'),
+                 protocol.request('client', 'list_files', ['/'])),
+                ('chunk', cluster.chunk_servers[0].pid, lambda: protocol.connect(config.CHUNK_PORTS[0], 'client'),
+                 protocol.request('client', 'read_chunk', ['load-test-chunk'])),
+            ]
+            for name, pid, connect, request in servers:
+                idle = [connect() for _ in range(args.idle)]
+                time.sleep(1)
+                threads, rss = process_stats(pid)
+                ops = run_load(args.clients, args.seconds, connect, request)
+                print(f'{mode:>10} {name:>8} {threads:>8} {rss:>8.1f} {ops:>10.0f}')
+                for sock in idle:
+                    sock.close()
+            transfer.connections.clear()
+
+
+def write_master_log(path, chunks, chunks_per_file):
+    """Writes the master journal of a namespace holding `chunks` committed chunks."""
+    with open(path, 'wb') as f:
+        f.write(journal.MAGIC)
+        f.write(journal.encode('create_dir', ['/', 'bench']))
+        for file_idx in range(0, chunks, chunks_per_file):
+            name = f'file_{file_idx}'
+            count = min(chunks_per_file, chunks - file_idx)
+            f.write(journal.encode('create', ['/bench', name, config.CHUNK_SIZE]))
+            for start in range(0, count, config.CHUNK_ALLOC_BATCH):
+                batch = [[str(uuid.uuid4()), [0, 1, 2]] for _ in range(min(config.CHUNK_ALLOC_BATCH, count - start))]
+                f.write(journal.encode('allocate_chunks', ['/bench', name, batch]))
+            f.write(journal.encode('commit_file', ['/bench', name, count * config.CHUNK_SIZE]))
+
+
+def bench_restart(args):
+    cluster = LocalCluster()
+    log_path = os.path.join(cluster.workdir, config.MASTER_LOG)
+    write_master_log(log_path, args.chunks, args.chunks_per_file)
+    print(f'{args.chunks} chunks, master log {os.path.getsize(log_path) / MB:.1f} MB')
+    try:
+        log_seconds = cluster.start()
+        cluster.stop_master()
+
+        # snapshot the namespace the way the master does, whatever the size of the log
+        logger = master.Logger(log_path, os.path.join(cluster.workdir, config.MASTER_SNAPSHOT))
+        seq = logger.snapshot()
+        logger.journal.close()
+        snapshot_size = os.path.getsize(os.path.join(cluster.workdir, f'{config.MASTER_SNAPSHOT}.{seq}'))
+
+        snapshot_seconds = cluster.start_master()
+    finally:
+        cluster.close()
+
+    print(f'{"restart from":>24} {"seconds":>10}')
+    print(f'{"log":>24} {log_seconds:>10.2f}')
+    print(f'{f"snapshot ({snapshot_size / MB:.1f} MB)":>24} {snapshot_seconds:>10.2f}')
+
+
+def bench_journal(args):
+    workdir = tempfile.mkdtemp(prefix='dfs-bench-')
+    print(f'{args.records} durable records per run')
+    print(f'{"threads":>8} {"records/s":>10} {"fdatasyncs":>11} {"records/sync":>13}')
+    try:
+        for threads in [int(n) for n in args.threads.split(',')]:
+            log = journal.Journal(os.path.join(workdir, f'journal.{threads}'))
+            per_thread = args.records // threads
+
+            def worker(idx):
+                for n in range(per_thread):
+                    log.append('set_chunk_loc', ['/bench', f'file_{idx}', str(uuid.uuid4()), [0, 1, 2]])
+
+            workers = [threading.Thread(target=worker, args=(idx,)) for idx in range(threads)]
+            start = time.time()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.time() - start
+            log.close()
+            records = per_thread * threads
+            print(f'{threads:>8} {records / elapsed:>10.0f} {log.batches:>11} {records / log.batches:>13.1f}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class SimulatedRegistry():
+    """Status reports of imaginary chunk servers, for placement runs without a cluster."""
+    def __init__(self, disks, inflight_writes):
+        self.reports = {}
+        for chunk_loc, (disk, inflight) in enumerate(zip(disks, inflight_writes)):
+            self.reports[chunk_loc] = {'free_disk': disk, 'total_disk': disk, 'inflight_writes': inflight}
+
+    def alive(self):
+        return list(self.reports)
+
+    def status(self, chunk_loc):
+        return self.reports[chunk_loc]
+
+
+def bench_placement(args):
+    # servers with 100, 200 and 300 GB disks; server 0 is busy with 8 writes in flight.
+    # every server is its own failure domain, racks would fix the share of each rack
+    disks = [(1 + idx % 3) * 100 * 1024 * MB for idx in range(config.NUM_CHUNKS)]
+    inflight_writes = [8] + [0] * (config.NUM_CHUNKS - 1)
+    print(f'{args.chunks} chunks of {config.CHUNK_SIZE // MB} MB, replication factor {config.REPLICATION_FACTOR}')
+    print(f'{"mode":>10} {"busy server share %":>20} {"min fill %":>11} {"max fill %":>11}')
+    for mode in ['random', 'p2c', 'weighted']:
+        registry = SimulatedRegistry(disks, inflight_writes)
+        engine = placement.PlacementEngine(registry, mode, domains=None)
+        replicas = [0] * config.NUM_CHUNKS
+        for _ in range(args.chunks):
+            for chunk_loc in engine.choose(config.REPLICATION_FACTOR):
+                replicas[chunk_loc] += 1
+                registry.reports[chunk_loc]['free_disk'] -= config.CHUNK_SIZE
+        fill = [1 - report['free_disk'] / report['total_disk'] for report in registry.reports.values()]
+        share = replicas[0] / sum(replicas)
+        print(f'{mode:>10} {share * 100:>20.1f} {min(fill) * 100:>11.1f} {max(fill) * 100:>11.1f}')
+
+
+class MasterOrderTracker(latency_tracker.LatencyTracker):
+    """Reads replicas in the order the master listed them and never hedges, like clients did before."""
+    def order(self, chunk_locs):
+        return list(chunk_locs)
+
+
+class TimedDownloadEngine(transfer.DownloadEngine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.times = []
+
+    def _fetch(self, chunk_id, chunk_locs):
+        start = time.monotonic()
+        data = super()._fetch(chunk_id, chunk_locs)
+        self.times.append(time.monotonic() - start)
+        return data
+
+
+def simulated_read_chunk(chunk_loc, chunk_id, offset=0, length=None):
+    # every server answers in 2-4 ms, 1% of its reads stall for 200 ms (a GC pause, a busy disk);
+    # server 0 is slow, at 20 ms a read
+    if random.random() < 0.01:
+        time.sleep(0.2)
+    else:
+        time.sleep(0.02 if chunk_loc == 0 else random.uniform(0.002, 0.004))
+    return b'x'
+
+
+def bench_hedge(args):
+    random.seed(1)
+    chunks = [(str(idx), random.sample(range(config.NUM_CHUNKS), config.REPLICATION_FACTOR)) for idx in range(args.chunks)]
+    read_chunk = transfer.read_chunk
+    transfer.read_chunk = simulated_read_chunk
+    print(f'{args.chunks} chunk reads from simulated servers, server 0 slow, 1% stalls on every server')
+    print(f'{"replica choice":>16} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"p99.9 ms":>9} {"hedged %":>9}')
+    try:
+        for name, tracker in [('master order', MasterOrderTracker(percentile=0)),
+                              ('fastest first', latency_tracker.LatencyTracker(percentile=0)),
+                              ('hedged', latency_tracker.LatencyTracker())]:
+            engine = TimedDownloadEngine(tracker=tracker)
+            engine.download(chunks, io.BytesIO())
+            times = sorted(engine.times)
+            p50, p90, p99, p999 = (times[min(len(times) - 1, int(len(times) * q))] * 1000 for q in (0.5, 0.9, 0.99, 0.999))
+            print(f'{name:>16} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f} {p999:>9.1f} {engine.hedged / len(times) * 100:>9.1f}')
+    finally:
+        transfer.read_chunk = read_chunk
+
+
+def bench_checksum(args):
+    file_size = args.file_size * MB
+    data = os.urandom(file_size)
+    start = time.time()
+    for pos in range(0, file_size, config.CHECKSUM_BLOCK):
+        checksum.ALGORITHMS[checksum.DEFAULT_ALGORITHM](data[pos:pos + config.CHECKSUM_BLOCK])
+    algorithm = 'crc32c' if checksum.DEFAULT_ALGORITHM == checksum.CRC32C else 'crc32'
+    print(f'{algorithm} of {config.CHECKSUM_BLOCK // 1024} KB blocks: {file_size / MB / (time.time() - start):.0f} MB/s')
+
+    with LocalCluster() as cluster:
+        local_path = os.path.join(cluster.workdir, 'input')
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+        quiet(client.create_file, local_path, '/bench', 'file')
+        sidecars = glob.glob(os.path.join(cluster.workdir, 'chunkdata', '*', '*' + checksum.SUFFIX))
+
+        def read_throughput():
+            # the first read, and the mean over all reads, the chunks are in the page cache after the first;
+            # and the CPU time the chunk servers spent per MB over all of them
+            rates = []
+            cpu = sum(process_cpu(proc.pid) for proc in cluster.chunk_servers)
+            for _ in range(args.reads):
+                start = time.time()
+                quiet(client.get_file, '/bench', 'file', local_path + '.out')
+                rates.append(file_size / MB / (time.time() - start))
+            cpu = sum(process_cpu(proc.pid) for proc in cluster.chunk_servers) - cpu
+            return rates[0], statistics.mean(rates), cpu * 1000 / (args.reads * file_size / MB)
+
+        # without their sidecars the chunk servers serve the chunks unchecked
+        for path in sidecars:
+            os.rename(path, path + '.off')
+        unchecked = read_throughput()
+        for path in sidecars:
+            os.rename(path + '.off', path)
+        checked = read_throughput()
+        if not filecmp.cmp(local_path, local_path + '.out', shallow=False):
+            raise Exception('read back data differs')
+        client.close_connection()
+
+    print(f'file size {args.file_size} MB, {args.reads} reads')
+    print(f'{"checksums":>10} {"first MB/s":>11} {"mean MB/s":>10} {"server CPU ms/MB":>17}')
+    print(f'{"off":>10} {unchecked[0]:>11.1f} {unchecked[1]:>10.1f} {unchecked[2]:>17.2f}')
+    print(f'{"on":>10} {checked[0]:>11.1f} {checked[1]:>10.1f} {checked[2]:>17.2f}')
+    print(f'throughput cost {(1 - checked[1] / unchecked[1]) * 100:.1f}% of the mean')
+
+
+def csv_data(size):
+    """Returns about `size` bytes of log-like CSV lines."""
+    random.seed(1)
+    levels = ['INFO', 'INFO', 'INFO', 'WARN', 'ERROR']
+    paths = ['/api/users', '/api/orders', '/api/items', '/health', '/login']
+    lines = []
+    total = 0
+    while total < size:
+        line = (f'2024-05-{random.randint(1, 28):02d}T{random.randint(0, 23):02d}:{random.randint(0, 59):02d}:'
+                f'{random.randint(0, 59):02d},{random.choice(levels)},{random.choice(paths)},'
+                f'{random.randint(100, 599)},{random.randint(1, 5000)},user{random.randint(1, 10000)}\n')
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def bench_compression(args):
+    file_size = args.file_size * MB
+    datasets = [('csv', csv_data(file_size)), ('random', os.urandom(file_size))]
+    codecs = [compression.NONE, 'zlib:1', 'zlib', 'lzma:1']
+    with LocalCluster() as cluster:
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+        print(f'file size {args.file_size} MB, chunk size {config.CHUNK_SIZE // MB} MB')
+        print(f'{"data":>7} {"codec":>7} {"stored MB":>10} {"ratio":>6} {"write MB/s":>11} {"read MB/s":>10}')
+        for data_name, data in datasets:
+            local_path = os.path.join(cluster.workdir, data_name)
+            with open(local_path, 'wb') as f:
+                f.write(data)
+            for codec in codecs:
+                name = f'{data_name}_{codec.replace(":", "_")}'
+                before = chunk_bytes(cluster.workdir)
+                start = time.time()
+                quiet(client.create_file, local_path, '/bench', name, config.CHUNK_SIZE, codec)
+                write_time = time.time() - start
+                stored = (chunk_bytes(cluster.workdir) - before) / config.REPLICATION_FACTOR
+
+                start = time.time()
+                quiet(client.get_file, '/bench', name, local_path + '.out')
+                read_time = time.time() - start
+                if not filecmp.cmp(local_path, local_path + '.out', shallow=False):
+                    raise Exception(f'read back data differs for {data_name} with {codec}')
+                print(f'{data_name:>7} {codec:>7} {stored / MB:>10.1f} {file_size / stored:>6.2f} '
+                      f'{file_size / MB / write_time:>11.1f} {file_size / MB / read_time:>10.1f}')
+        client.close_connection()
+
+
+def bench_erasure(args):
+    file_size = args.file_size * MB
+    data = os.urandom(file_size)
+    stripes = [data[pos:pos + config.CHUNK_SIZE] for pos in range(0, file_size, config.CHUNK_SIZE)]
+    policies = args.policies.split(',')
+    print(f'GF(256) arithmetic with {"NumPy" if erasure.numpy is not None else "bytes.translate, NumPy not installed"}')
+    print(f'{args.file_size} MB in {config.CHUNK_SIZE // MB} MB stripes, MB/s of stripe data')
+    print(f'{"policy":>8} {"encode":>8} {"decode":>8} {"1 lost":>8} {"m lost":>8} {"rebuild":>8}')
+    for policy in policies:
+        code = erasure.code(policy)
+        start = time.perf_counter()
+        encoded = [code.encode(stripe) for stripe in stripes]
+        rates = [file_size / MB / (time.perf_counter() - start)]
+        # all data shards, one data shard lost, m data shards lost
+        for lost in ([], [0], list(range(min(code.m, code.k)))):
+            start = time.perf_counter()
+            for shards in encoded:
+                code.decode({idx: shard for idx, shard in enumerate(shards) if idx not in lost})
+            rates.append(file_size / MB / (time.perf_counter() - start))
+        start = time.perf_counter()
+        for shards in encoded:
+            code.rebuild({idx: shard for idx, shard in enumerate(shards) if idx != 0}, 0)
+        rates.append(file_size / MB / (time.perf_counter() - start))
+        print(f'{policy:>8} ' + ' '.join(f'{rate:>8.1f}' for rate in rates))
+
+    # every shard of a stripe needs a chunk server of its own
+    policies = [policy for policy in policies if sum(erasure.parse_policy(policy)) <= config.NUM_CHUNKS]
+    with LocalCluster() as cluster:
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+        local_path = os.path.join(cluster.workdir, 'data')
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        print(f'{"policy":>10} {"stored MB":>10} {"overhead":>9} {"write MB/s":>11} {"read MB/s":>10}')
+        for policy in [erasure.REPLICATED] + policies:
+            name = policy.replace(':', '_').replace('+', '_')
+            before = chunk_bytes(cluster.workdir)
+            start = time.time()
+            quiet(client.create_file, local_path, '/bench', name, config.CHUNK_SIZE, compression.NONE, policy)
+            write_time = time.time() - start
+            stored = chunk_bytes(cluster.workdir) - before
+            start = time.time()
+            quiet(client.get_file, '/bench', name, local_path + '.out')
+            read_time = time.time() - start
+            if not filecmp.cmp(local_path, local_path + '.out', shallow=False):
+                raise Exception(f'read back data differs for {policy}')
+            print(f'{policy:>10} {stored / MB:>10.1f} {stored / file_size:>8.2f}x '
+                  f'{file_size / MB / write_time:>11.1f} {file_size / MB / read_time:>10.1f}')
+
+        # reads decode around two dead chunk servers
+        for proc in cluster.chunk_servers[:2]:
+            proc.terminate()
+            proc.wait()
+        client.cache.clear()
+        for policy in [policy for policy in policies if erasure.parse_policy(policy)[1] >= 2]:
+            name = policy.replace(':', '_').replace('+', '_')
+            start = time.time()
+            quiet(client.get_file, '/bench', name, local_path + '.out')
+            read_time = time.time() - start
+            if not filecmp.cmp(local_path, local_path + '.out', shallow=False):
+                raise Exception(f'read back data differs for {policy} with two chunk servers down')
+            print(f'{policy:>10} read with 2 chunk servers down: {file_size / MB / read_time:.1f} MB/s')
+        client.close_connection()
+
+
+def bench_dedup(args):
+    file_size = args.file_size * MB
+    data = bytearray(os.urandom(file_size))
+    # a new version of the dataset with some of its chunks changed in place
+    random.seed(1)
+    num_chunks = -(-file_size // config.CHUNK_SIZE)
+    changed = bytearray(data)
+    for idx in random.sample(range(num_chunks), num_chunks * args.changed // 100):
+        changed[idx * config.CHUNK_SIZE] ^= 0xff
+    with LocalCluster() as cluster:
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+        paths = {}
+        for name, content in [('data', data), ('changed', changed)]:
+            paths[name] = os.path.join(cluster.workdir, name)
+            with open(paths[name], 'wb') as f:
+                f.write(content)
+        print(f'file size {args.file_size} MB, chunk size {config.CHUNK_SIZE // MB} MB, {args.changed}% of the chunks changed')
+        print(f'{"mode":>8} {"upload":>10} {"written MB":>11} {"seconds":>8} {"MB/s":>7}')
+        for deduplicate in (False, True):
+            mode = 'dedup' if deduplicate else 'uuid'
+            for upload, source in [('first', 'data'), ('repeat', 'data'), ('changed', 'changed')]:
+                before = chunk_bytes(cluster.workdir)
+                start = time.time()
+                quiet(client.create_file, paths[source], '/bench', f'{mode}_{upload}', config.CHUNK_SIZE, compression.NONE,
+                      erasure.REPLICATED, deduplicate)
+                elapsed = time.time() - start
+                written = chunk_bytes(cluster.workdir) - before
+                print(f'{mode:>8} {upload:>10} {written / MB:>11.1f} {elapsed:>8.2f} {file_size / MB / elapsed:>7.1f}')
+            quiet(client.get_file, '/bench', f'{mode}_changed', paths['changed'] + '.out')
+            if not filecmp.cmp(paths['changed'], paths['changed'] + '.out', shallow=False):
+                raise Exception(f'read back data differs in {mode} mode')
+        client.close_connection()
+
+
+def bench_append(args):
+    piece = os.urandom(args.append_size * 1024)
+    with LocalCluster() as cluster:
+        client = cluster.client()
+        quiet(client.create_dir, '/', 'bench')
+        piece_path = os.path.join(cluster.workdir, 'piece')
+        whole_path = os.path.join(cluster.workdir, 'whole')
+        with open(piece_path, 'wb') as f:
+            f.write(piece)
+
+        # a log growing by one piece at a time, appended to or written again in full
+        print(f'{args.appends} appends of {args.append_size} KB, chunk size {config.CHUNK_SIZE // MB} MB')
+        print(f'{"mode":>8} {"written MB":>11} {"seconds":>8} {"ms/append":>10}')
+        for mode in ('append', 'rewrite'):
+            before = chunk_bytes(cluster.workdir)
+            start = time.time()
+            with open(whole_path, 'wb') as f:
+                f.write(piece)
+            quiet(client.create_file, piece_path, '/bench', f'{mode}_0')
+            for idx in range(1, args.appends):
+                if mode == 'append':
+                    quiet(client.append_file, piece_path, '/bench', f'{mode}_0')
+                    continue
+                with open(whole_path, 'ab') as f:
+                    f.write(piece)
+                quiet(client.create_file, whole_path, '/bench', f'{mode}_{idx}')
+                quiet(client.delete_file, '/bench', f'{mode}_{idx - 1}')
+            elapsed = time.time() - start
+            written = chunk_bytes(cluster.workdir) - before
+            print(f'{mode:>8} {written / MB:>11.1f} {elapsed:>8.2f} {elapsed * 1000 / args.appends:>10.1f}')
+        quiet(client.get_file, '/bench', 'append_0', whole_path + '.out')
+        if not filecmp.cmp(whole_path, whole_path + '.out', shallow=False):
+            raise Exception('appended file differs from the file written in full')
+
+        # producers appending records to one file without coordinating
+        print(f'\n{args.records} records of {args.record_size} bytes per producer')
+        print(f'{"producers":>9} {"records/s":>10} {"MB/s":>7} {"failed":>7} {"duplicates":>11}')
+        for producers in [int(count) for count in args.producers.split(',')]:
+            name = f'records_{producers}'
+            empty_path = os.path.join(cluster.workdir, 'empty')
+            open(empty_path, 'wb').close()
+            quiet(client.create_file, empty_path, '/bench', name)
+            failed = []
+            def produce(idx):
+                producer = cluster.client()
+                for seq in range(args.records):
+                    record = f'{idx} {seq} '.encode().ljust(args.record_size, b'x')
+                    if producer.record_append('/bench', name, record) is None:
+                        failed.append(record)
+                producer.close_connection()
+            threads = [threading.Thread(target=produce, args=(idx,)) for idx in range(producers)]
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            elapsed = time.time() - start
+            read = quiet(client.read_records, '/bench', name)
+            total = producers * args.records
+            if len(set(read)) != total - len(failed):
+                raise Exception(f'{total - len(failed)} records appended, {len(set(read))} read back')
+            print(f'{producers:>9} {total / elapsed:>10.0f} {total * args.record_size / MB / elapsed:>7.1f} {len(failed):>7} '
+                  f'{len(read) - len(set(read)):>11}')
+        client.close_connection()
+
+
+def chunk_bytes(workdir):
+    """Returns the bytes of all chunk replicas in a cluster, without their checksums."""
+    paths = glob.glob(os.path.join(workdir, 'chunkdata', '*', '*'))
+    return sum(os.path.getsize(path) for path in paths if not path.endswith(checksum.SUFFIX))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DFS benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    chunk_size = subparsers.add_parser('chunk_size', help='write and read throughput at 4 KB, 1 MB and 64 MB chunks')
+    chunk_size.add_argument('--file-size', type=int, default=64, help='size of the test file in MB')
+    chunk_size.set_defaults(run=bench_chunk_size)
+
+    load = subparsers.add_parser('load', help='threads, memory and ops/s of the threaded and asyncio servers under idle connections')
+    load.add_argument('--idle', type=int, default=1000, help='idle connections opened to each server')
+    load.add_argument('--clients', type=int, default=16, help='connections sending requests back to back')
+    load.add_argument('--seconds', type=int, default=5, help='length of each measurement')
+    load.set_defaults(run=bench_load)
+
+    restart = subparsers.add_parser('restart', help='master restart time from the log and from a snapshot')
+    restart.add_argument('--chunks', type=int, default=1000000, help='chunks in the namespace')
+    restart.add_argument('--chunks-per-file', type=int, default=1000, help='chunks per file')
+    restart.set_defaults(run=bench_restart)
+
+    journal_parser = subparsers.add_parser('journal', help='durable master journal records per second and per fdatasync')
+    journal_parser.add_argument('--records', type=int, default=4000, help='records appended per run')
+    journal_parser.add_argument('--threads', default='1,4,16,64', help='comma separated numbers of appending threads')
+    journal_parser.set_defaults(run=bench_journal)
+
+    placement_parser = subparsers.add_parser('placement', help='replica placement of each mode on simulated uneven servers')
+    placement_parser.add_argument('--chunks', type=int, default=100000, help='chunks to place')
+    placement_parser.set_defaults(run=bench_placement)
+
+    hedge = subparsers.add_parser('hedge', help='chunk read latency percentiles with and without hedged reads on simulated servers')
+    hedge.add_argument('--chunks', type=int, default=5000, help='chunks to read')
+    hedge.set_defaults(run=bench_hedge)
+
+    checksum_parser = subparsers.add_parser('checksum', help='chunk read throughput with and without checksum verification')
+    checksum_parser.add_argument('--file-size', type=int, default=256, help='size of the test file in MB')
+    checksum_parser.add_argument('--reads', type=int, default=5, help='reads of the file with and without checksums')
+    checksum_parser.set_defaults(run=bench_checksum)
+
+    compression_parser = subparsers.add_parser('compression', help='stored size and throughput of each codec on CSV and random data')
+    compression_parser.add_argument('--file-size', type=int, default=64, help='size of each test file in MB')
+    compression_parser.set_defaults(run=bench_compression)
+
+    erasure_parser = subparsers.add_parser('erasure', help='Reed-Solomon encode and decode throughput, and stored size of erasure coded files')
+    erasure_parser.add_argument('--file-size', type=int, default=64, help='size of the test file in MB')
+    erasure_parser.add_argument('--policies', default='ec:4+2,ec:3+2,ec:10+4',
+                                help='comma separated erasure coding policies, the cluster runs those that fit on its chunk servers')
+    erasure_parser.set_defaults(run=bench_erasure)
+
+    dedup_parser = subparsers.add_parser('dedup', help='bytes written and upload time of repeated uploads with and without deduplication')
+    dedup_parser.add_argument('--file-size', type=int, default=256, help='size of the test file in MB')
+    dedup_parser.add_argument('--changed', type=int, default=5, help='percent of the chunks changed in the second version of the file')
+    dedup_parser.set_defaults(run=bench_dedup)
+
+    append_parser = subparsers.add_parser('append', help='appends against rewriting a growing file, and record append throughput of concurrent producers')
+    append_parser.add_argument('--appends', type=int, default=50, help='pieces the growing file is written in')
+    append_parser.add_argument('--append-size', type=int, default=256, help='size of each piece in KB')
+    append_parser.add_argument('--records', type=int, default=2000, help='records appended by each producer')
+    append_parser.add_argument('--record-size', type=int, default=1024, help='size of each record in bytes')
+    append_parser.add_argument('--producers', default='1,4,16', help='comma separated numbers of concurrent producers')
+    append_parser.set_defaults(run=bench_append)
+
+    args = parser.parse_args()
+    args.run(args)
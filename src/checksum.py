@@ -0,0 +1,217 @@
+"""Block checksums of chunk replicas.
+
+Every chunk file has a sidecar file next to it, named after the chunk with
+SUFFIX appended:
+
+    MAGIC | algorithm (B) | block size (I) | checksum (I) of every block
+
+CRC32C is used when the crc32c module is installed, zlib's CRC32 otherwise.
+The sidecar names its algorithm, so a replica can be checked by any chunk
+server that has that algorithm. Chunks written before checksums existed
+have no sidecar and are served unchecked until the scrubber adds one.
+"""
+import os
+import struct
+import threading
+import zlib
+
+import config
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+MAGIC = b'DFSC'
+HEADER = struct.Struct('!4sBI')
+SUFFIX = '.crc'
+
+CRC32 = 1
+CRC32C = 2
+ALGORITHMS = {CRC32: zlib.crc32}
+if crc32c is not None:
+    ALGORITHMS[CRC32C] = crc32c.crc32c
+DEFAULT_ALGORITHM = CRC32C if crc32c is not None else CRC32
+
+# read buffers are kept per thread, a fresh buffer per check costs more than the check
+buffers = threading.local()
+
+
+class ChunkCorrupted(Exception):
+    pass
+
+
+def sidecar(chunk_path):
+    return chunk_path + SUFFIX
+
+
+class BlockChecksums():
+    """Checksums of a chunk, fed with its data in pieces of any size."""
+    def __init__(self, block_size=config.CHECKSUM_BLOCK, algorithm=DEFAULT_ALGORITHM):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.function = ALGORITHMS[algorithm]
+        self.sums = []
+        self.crc = 0
+        self.filled = 0 # bytes of the current block seen so far
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block_size - self.filled)
+            self.crc = self.function(view[:n], self.crc)
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block_size:
+                self.sums.append(self.crc)
+                self.crc = 0
+                self.filled = 0
+
+    def write(self, path):
+        sums = self.sums + [self.crc] if self.filled else self.sums
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.algorithm, self.block_size))
+            f.write(struct.pack(f'!{len(sums)}I', *sums))
+
+
+def load(path):
+    """Returns (algorithm, block size, checksums) of a sidecar file, None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < HEADER.size or (len(data) - HEADER.size) % 4:
+        raise ChunkCorrupted(f'Checksum file {path} is damaged')
+    magic, algorithm, block_size = HEADER.unpack_from(data)
+    if magic != MAGIC or block_size == 0:
+        raise ChunkCorrupted(f'Checksum file {path} is damaged')
+    return algorithm, block_size, struct.unpack_from(f'!{(len(data) - HEADER.size) // 4}I', data, HEADER.size)
+
+
+def read_buffer(block_size):
+    size = max(1, config.VERIFY_BUFFER // block_size) * block_size
+    buf = getattr(buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = buffers.buf = memoryview(bytearray(size))
+    return buf
+
+
+def check(f, chunk_path, offset=0, count=None, throttle=None):
+    """Checks the blocks of the open chunk file f that hold `count` bytes from `offset`.
+
+    Returns False if the chunk has no checksums this server can check and
+    raises ChunkCorrupted on a mismatch. `throttle` is called with the
+    number of bytes read after every read.
+    """
+    sums = load(sidecar(chunk_path))
+    if sums is None or sums[0] not in ALGORITHMS:
+        return False
+    algorithm, block_size, crcs = sums
+    function = ALGORITHMS[algorithm]
+    size = os.fstat(f.fileno()).st_size
+    if len(crcs) != -(-size // block_size):
+        raise ChunkCorrupted(f'{size} bytes do not match {len(crcs)} checksums of {block_size} byte blocks')
+    if count is None:
+        count = size - offset
+    if count <= 0:
+        return True
+
+    block = offset // block_size
+    last = (offset + count - 1) // block_size
+    view = read_buffer(block_size)
+    f.seek(block * block_size)
+    while block <= last:
+        n = f.readinto(view[:min(len(view), (last - block + 1) * block_size)])
+        if not n:
+            raise ChunkCorrupted(f'Chunk ends inside block {block}')
+        if throttle is not None:
+            throttle(n)
+        for pos in range(0, n, block_size):
+            if function(view[pos:min(pos + block_size, n)]) != crcs[block]:
+                raise ChunkCorrupted(f'Checksum mismatch in block {block}')
+            block += 1
+    return True
+
+
+def read_checked(f, chunk_path, offset, count, lock):
+    """Yields `count` bytes from `offset` of the open chunk file f in pieces, each one checked before it is yielded.
+
+    The blocks are read once, into the buffer the piece is sent from, rather
+    than read by a check of their own and then again by sendfile. Every piece
+    is read with `lock` held and against checksums loaded under it, since
+    record appends rewrite the checksums of the blocks they write to. Raises
+    ChunkCorrupted on a mismatch. The pieces share one buffer, each is only
+    valid until the next one is asked for.
+    """
+    path = sidecar(chunk_path)
+    pos = offset
+    end = offset + count
+    while pos < end:
+        with lock:
+            sums = load(path)
+            if sums is None:
+                raise FileNotFoundError(f'Checksum file {path} is gone')
+            algorithm, block_size, crcs = sums
+            function = ALGORITHMS[algorithm]
+            size = os.fstat(f.fileno()).st_size
+            if len(crcs) != -(-size // block_size):
+                raise ChunkCorrupted(f'{size} bytes do not match {len(crcs)} checksums of {block_size} byte blocks')
+            block = pos // block_size
+            last = (end - 1) // block_size
+            start = block * block_size
+            view = read_buffer(block_size)
+            f.seek(start)
+            n = f.readinto(view[:min(len(view), (last - block + 1) * block_size)])
+            if not n:
+                raise ChunkCorrupted(f'Chunk ends inside block {block}')
+            for i in range(0, n, block_size):
+                if function(view[i:min(i + block_size, n)]) != crcs[block]:
+                    raise ChunkCorrupted(f'Checksum mismatch in block {block}')
+                block += 1
+        stop = min(end, start + n)
+        yield view[pos - start:stop - start]
+        pos = stop
+
+
+def create(f, chunk_path, throttle=None):
+    """Writes the sidecar of a chunk that has none yet."""
+    _write_from(f, chunk_path, BlockChecksums(), 0, throttle)
+
+
+def extend(fd, chunk_path, start):
+    """Updates the sidecar of a chunk written to from byte `start` on, only the blocks from the one holding `start` are read.
+
+    The checksums are written over the old ones in place, a sidecar torn by
+    a crash fails its chunk, which is then copied again from another replica.
+    """
+    path = sidecar(chunk_path)
+    sums = load(path)
+    if sums is None or sums[0] not in ALGORITHMS:
+        with open(chunk_path, 'rb') as f:
+            create(f, chunk_path)
+        return
+    algorithm, block_size, _ = sums
+    function = ALGORITHMS[algorithm]
+    first = start // block_size
+    size = os.fstat(fd).st_size
+    data = memoryview(os.pread(fd, size - first * block_size, first * block_size))
+    crcs = [function(data[pos:pos + block_size]) for pos in range(0, len(data), block_size)]
+    with open(path, 'r+b') as f:
+        f.seek(HEADER.size + 4 * first)
+        f.write(struct.pack(f'!{len(crcs)}I', *crcs))
+
+
+def _write_from(f, chunk_path, sums, start, throttle=None):
+    view = read_buffer(sums.block_size)
+    f.seek(start)
+    while True:
+        n = f.readinto(view)
+        if not n:
+            break
+        if throttle is not None:
+            throttle(n)
+        sums.update(view[:n])
+    temp_path = f'{sidecar(chunk_path)}.{threading.get_ident()}.tmp'
+    sums.write(temp_path)
+    os.replace(temp_path, sidecar(chunk_path))
@@ -2,62 +2,210 @@ import sys
 import socket
 import pickle
 import os.path
+import shutil
 import threading
+import time
 
 import config
-import json
+import aio_server
+import checksum
+import connection_pool
+import protocol
+import scrubber
 
+SEALED = '.sealed'
+APPEND_FULL = 2
+APPEND_SEALED = 3
 class ChunkServer():
     def __init__(self, host, port, rootdir):
         self.host = host
         self.port = port
         self.rootdir = rootdir
+        self.index = config.CHUNK_PORTS.index(port)
         self.present = {}
+        self.pool = connection_pool.ConnectionPool('chunk_server')
+        # counters for the status reports pushed to the master
+        self.stats_lock = threading.Lock()
+        self.chunk_count = self._count_chunks()
+        self.reads = 0
+        self.writes = 0
+        self.inflight_writes = 0
+        self.last_report = time.monotonic()
+        self.verified = {} # chunk_id -> last time the whole chunk matched its checksums
+        self.corrupt = set() # bad replicas not reported to the master yet
+        # a record append changes a chunk and its sidecar in place, checks of the chunk wait for it
+        self.chunk_locks = [threading.Lock() for _ in range(config.CHUNK_LOCKS)]
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
 
+    def start_heart_beat(self):
+        heart_beat_thread = threading.Thread(target=self.heart_beat_sender, daemon=True)
+        heart_beat_thread.start()
+
+    def start_scrubber(self):
+        scrubber_thread = threading.Thread(target=scrubber.Scrubber(self).run, daemon=True)
+        scrubber_thread.start()
+
+    def heart_beat_sender(self):
+        # pushes a status report to the master every HEART_BEAT_INTERVAL seconds,
+        # reconnecting at once when the master restarted
+        master = None
+        while True:
+            report = self.status_report()
+            for _ in range(2):
+                try:
+                    if master is None:
+                        master = protocol.connect(config.MASTER_PORT, 'chunk_server', timeout=config.HEART_BEAT_TIMEOUT)
+                    master.sendall(self._get_message_data('heartbeat', report))
+                    protocol.recv_frame(master)
+                    with self.stats_lock:
+                        self.corrupt.difference_update(report['corrupt'])
+                    break
+                except OSError:
+                    if master is not None:
+                        master.close()
+                    master = None
+            time.sleep(config.HEART_BEAT_INTERVAL)
+
+    def status_report(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 1e-6)
+        self.last_report = now
+        with self.stats_lock:
+            reads, writes = self.reads, self.writes
+            self.reads = self.writes = 0
+            inflight_writes = self.inflight_writes
+            chunk_count = self.chunk_count
+            corrupt = list(self.corrupt)
+        os.makedirs(self.rootdir, exist_ok=True)
+        disk = shutil.disk_usage(self.rootdir)
+        return {
+            'index': self.index,
+            'chunks': chunk_count,
+            'free_disk': disk.free,
+            'total_disk': disk.total,
+            'load': os.getloadavg()[0],
+            'inflight_writes': inflight_writes,
+            'reads_per_s': reads / elapsed,
+            'writes_per_s': writes / elapsed,
+            'corrupt': corrupt # replicas that failed their checksums, the master drops them
+        }
+
+    def _count_chunks(self):
+        if not os.path.isdir(self.rootdir):
+            return 0
+        return sum(1 for entry in os.scandir(self.rootdir) if self.is_chunk(entry.name))
+
+    @staticmethod
+    def is_chunk(name):
+        # the chunk directory also holds checksum sidecars, seal markers, partial writes and bad replicas
+        return not name.endswith(('.tmp', checksum.SUFFIX, SEALED, '.corrupt'))
+
+    def chunk_lock(self, chunk_id):
+        return self.chunk_locks[hash(chunk_id) % len(self.chunk_locks)]
+
+    def quarantine(self, chunk_id, error):
+        # the bad replica is kept aside for inspection and no longer served
+        print(f'Chunk {chunk_id} is corrupted: {error}')
+        chunk_path = os.path.join(self.rootdir, chunk_id)
+        try:
+            os.replace(chunk_path, chunk_path + '.corrupt')
+        except FileNotFoundError:
+            return
+        self._remove_sidecars(chunk_path)
+        self.verified.pop(chunk_id, None)
+        with self.stats_lock:
+            self.chunk_count -= 1
+            self.corrupt.add(chunk_id)
+
+    def _remove_sidecars(self, chunk_path):
+        for path in (checksum.sidecar(chunk_path), chunk_path + SEALED):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
     def listen(self):
-        self.sock.listen(5)
+        self.sock.listen(config.LISTEN_BACKLOG)
         while True:
             client, address = self.sock.accept()
             handler = threading.Thread(
                 target=self.service, args=(client, address))
             handler.start()
 
+    def listen_async(self):
+        # every connection is served from one event loop instead of a thread per connection
+        self.sock.listen(config.LISTEN_BACKLOG)
+        aio_server.AsyncServer(self.sock, self.accept, self.serve_request).serve_forever()
+
     def service(self, client, address):
-        ip, port = address
+        # a connection carries any number of requests until the peer closes it
         try:
-            request = client.recv(config.MESSAGE_SIZE)
-            if request == b'':
-                raise Exception(f'client {ip}:{address} disconnected')
-            message = json.loads(request.decode('utf-8'))
-
-            sender_type = message["sender_type"]
-            command = message["function"]
-            args = message["args"]
-
-            if sender_type == 'client':
-                if command == "write_chunk":
-                    self.write_chunk(client, args)
-                elif command == 'read_chunk':
-                    self.read_chunk(client, args)
-                elif command == 'delete_chunk':
-                    self.delete_chunk(client, args)
-            elif sender_type == 'master':
-                if command == 'heartbeat':
-                    self.heartbeart_handler(client, args)
-                elif command == 'delete_chunk':
-                    self.delete_chunk(client, args)
-                if command == 'replicate_chunk':
-                    self.replicate_chunk(client, args)
-                
-            elif sender_type == 'chunk_server':
-                if command == "write_chunk":
-                    self.write_chunk(client, args)
+            if self.accept(client, address):
+                while self.serve_request(client, address):
+                    pass
+        finally:
+            client.close()
 
+    def accept(self, client, address):
+        try:
+            protocol.accept(client)
         except Exception as e:
             print(e)
-            client.close()
+            return False
+        return True
+
+    def serve_request(self, client, address):
+        # handles one request, returns False once the connection should be closed
+        try:
+            frame = protocol.recv_frame(client)
+        except ConnectionError:
+            return False
+        try:
+            self.dispatch(client, frame)
+        except Exception as e:
+            print(e)
+            return False
+        return True
+
+    def dispatch(self, client, frame):
+        message = frame.body
+        sender_type = message["sender_type"]
+        command = message["function"]
+        args = message["args"]
+
+        if sender_type == 'client':
+            if command == "write_chunk":
+                self.write_chunk(client, args, frame.payload_len)
+            elif command == 'read_chunk':
+                self.read_chunk(client, args)
+            elif command == 'delete_chunk':
+                self.delete_chunk(client, args)
+            elif command == 'append_chunk':
+                self.append_chunk(client, args, frame.payload_len)
+        elif sender_type == 'master':
+            if command == 'heartbeat':
+                self.heartbeart_handler(client, args)
+            elif command == 'delete_chunk':
+                self.delete_chunk(client, args)
+            elif command == 'delete_chunks':
+                self.delete_chunks(client, args)
+            if command == 'replicate_chunk':
+                self.replicate_chunk(client, args)
+            # the master reads and writes shards itself when it rebuilds erasure coded stripes
+            elif command == 'read_chunk':
+                self.read_chunk(client, args)
+            elif command == 'write_chunk':
+                self.write_chunk(client, args, frame.payload_len)
+            elif command == 'seal_chunk':
+                self.seal_chunk(client, args)
+
+        elif sender_type == 'chunk_server':
+            if command == "write_chunk":
+                self.write_chunk(client, args, frame.payload_len)
+            elif command == 'append_chunk':
+                self.append_chunk(client, args, frame.payload_len)
                 
 
     def heartbeart_handler(self, client, args):
@@ -65,78 +213,287 @@ class ChunkServer():
         client.sendall(response)
 
     def read_chunk(self, client, args):
-        data = ''
-        with open(os.path.join(self.rootdir, args[0]), 'r') as f:
-            data = f.read()
-
-        response = {
-            'status': 0,
-            'data': data
-        }
+        # args: chunk_id, optional byte offset and length inside the chunk
+        offset = args[1] if len(args) > 1 else 0
+        length = args[2] if len(args) > 2 else None
+        chunk_path = os.path.join(self.rootdir, args[0])
+        try:
+            f = open(chunk_path, 'rb')
+        except OSError:
+            client.sendall(self._respond_status(-1, 'Chunk not found'))
+            return
 
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        client.send(response)
+        with self.stats_lock:
+            self.reads += 1
+        with f:
+            # bytes appended after the size is taken are not sent, so the lock is not held while sending
+            lock = self.chunk_lock(args[0])
+            try:
+                with lock:
+                    size = os.fstat(f.fileno()).st_size
+                    offset = min(offset, size)
+                    count = size - offset if length is None else min(length, size - offset)
+                    sums = checksum.load(checksum.sidecar(chunk_path))
+                if sums is None or sums[0] not in checksum.ALGORITHMS or count == 0:
+                    client.sendall(protocol.status(0, 'OK', count))
+                    if count > 0:
+                        # socket.sendfile goes through os.sendfile, the chunk never enters user space
+                        client.sendfile(f, offset, count)
+                    return
+                # the blocks being served are checked as they are read into the buffer they are sent from;
+                # the first piece is checked before anything is sent, a later bad one closes the connection
+                sent = False
+                for piece in checksum.read_checked(f, chunk_path, offset, count, lock):
+                    if not sent:
+                        client.sendall(protocol.status(0, 'OK', count))
+                        sent = True
+                    client.sendall(piece)
+            except checksum.ChunkCorrupted as e:
+                self.quarantine(args[0], e)
+                if sent:
+                    raise
+                client.sendall(self._respond_status(-1, 'Chunk corrupted'))
+                return
+            if count == size:
+                self.verified[args[0]] = time.monotonic()
 
 
     def delete_chunk(self, client, args):
         file_path = os.path.join(self.rootdir, args[0])
         try:
             os.remove(file_path)
-            client.send(self._respond_status(0, 'Chunk deleted'))
+            self._remove_sidecars(file_path)
+            self.verified.pop(args[0], None)
+            with self.stats_lock:
+                self.chunk_count -= 1
+            client.sendall(self._respond_status(0, 'Chunk deleted'))
         except Exception as e:
             print(e)
-            client.send(self._respond_status(1, 'Chunk not found'))
+            client.sendall(self._respond_status(1, 'Chunk not found'))
         
 
 
-    def write_chunk(self, client, args):
-        # recieve data from client as a stream (sendall)
-        data = b''
-        while True:
-            packet = client.recv(config.PACKET_SIZE)
-            if not packet:
+    def delete_chunks(self, client, args):
+        # batch from the master's garbage collector, a chunk that is already gone counts as deleted
+        failed = []
+        for chunk_id in args[0]:
+            chunk_path = os.path.join(self.rootdir, chunk_id)
+            try:
+                os.remove(chunk_path)
+                with self.stats_lock:
+                    self.chunk_count -= 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(e)
+                failed.append(chunk_id)
+                continue
+            self._remove_sidecars(chunk_path)
+            self.verified.pop(chunk_id, None)
+        client.sendall(protocol.response({'status': 0, 'failed': failed}))
+
+    def write_chunk(self, client, args, length):
+        with self.stats_lock:
+            self.writes += 1
+            self.inflight_writes += 1
+        try:
+            self._write_chunk(client, args, length)
+        finally:
+            with self.stats_lock:
+                self.inflight_writes -= 1
+
+    def _write_chunk(self, client, args, length):
+        # stream exactly `length` payload bytes into a temp file through one reused
+        # buffer, then rename it over the chunk so readers never see a partial chunk.
+        # args[1] is the rest of the replica chain: every packet is forwarded to the
+        # next replica as soon as it arrives and its ack is folded into ours
+        chunk_id = args[0]
+        chain = args[1] if len(args) > 1 else []
+        chunk_path = os.path.join(self.rootdir, chunk_id)
+        temp_path = f'{chunk_path}.{threading.get_ident()}.tmp'
+        sums = checksum.BlockChecksums()
+        buf = bytearray(min(config.PACKET_SIZE, max(length, 1)))
+        view = memoryview(buf)
+        downstream = self._forward_chain(chunk_id, chain, length)
+
+        error = None
+        f = None
+        try:
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            f = open(temp_path, 'wb')
+        except OSError as e:
+            error = e
+
+        # keep draining the payload after a local failure so the chain still gets the data
+        remaining = length
+        while remaining > 0:
+            n = client.recv_into(view, min(len(buf), remaining))
+            if n == 0:
+                error = ConnectionError(f'Connection closed with {remaining} bytes of chunk {chunk_id} missing')
                 break
-            data += packet
-        data = data.decode('utf-8').strip()
-        os.makedirs(os.path.dirname(os.path.join(self.rootdir, args[0])), exist_ok=True)
-        with open(os.path.join(self.rootdir, args[0]), 'w') as f:
-            f.write(data)
+            remaining -= n
+            if f is not None:
+                try:
+                    f.write(view[:n])
+                    sums.update(view[:n])
+                except OSError as e:
+                    error = e
+                    f.close()
+                    f = None
+            if downstream is not None:
+                try:
+                    downstream[1].sendall(view[:n])
+                except OSError:
+                    downstream[1].close()
+                    downstream = None
 
-        client.close()
+        stored = []
+        if f is not None:
+            f.close()
+            if error is None:
+                # the checksums go in place first, a chunk is never visible without its own
+                temp_sidecar = f'{checksum.sidecar(chunk_path)}.{threading.get_ident()}.tmp'
+                try:
+                    sums.write(temp_sidecar)
+                    os.replace(temp_sidecar, checksum.sidecar(chunk_path))
+                except OSError as e:
+                    error = e
+                    if os.path.exists(temp_sidecar):
+                        os.remove(temp_sidecar)
+            if error is None:
+                new_chunk = not os.path.exists(chunk_path)
+                os.replace(temp_path, chunk_path)
+                self.verified.pop(chunk_id, None)
+                stored.append(self.index)
+                if new_chunk:
+                    with self.stats_lock:
+                        self.chunk_count += 1
+        if error is not None:
+            print(error)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
+        if downstream is not None:
+            downstream_loc, downstream = downstream
+            try:
+                if remaining > 0:
+                    raise ConnectionError('upstream closed mid chunk')
+                stored += protocol.recv_frame(downstream).body.get('stored', [])
+                self.pool.release(downstream_loc, downstream)
+            except OSError:
+                downstream.close()
 
-    def _respond_status(self, code, message):
+        if remaining > 0:
+            return
+        response = {
+            'status': 0 if error is None else -1,
+            'message': 'Chunk written' if error is None else f'Write failed: {error}',
+            'stored': stored
+        }
+        client.sendall(protocol.response(response))
 
-        response =  {
-			'status': code,
-			'message': message
-		}
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        return response
+    def append_chunk(self, client, args, length):
+        # record append: args are chunk_id, the rest of the replica chain, the offset the first
+        # replica chose (None on the first replica) and the size the chunk must stay within.
+        # The first replica hands out offsets in order under the chunk lock, so records never
+        # overlap, and the rest of the chain writes each record at its offset. The lock is not
+        # held while the chain writes, a record still on its way to a replica leaves a hole there
+        chunk_id, chain, offset, limit = args
+        record = protocol.recv_payload(client, length)
+        chunk_path = os.path.join(self.rootdir, chunk_id)
+        with self.stats_lock:
+            self.writes += 1
+        response = None
+        with self.chunk_lock(chunk_id):
+            # the chunk was created empty before records were sent to it, a missing one was
+            # deleted with its file and must not come back
+            if not os.path.exists(chunk_path):
+                client.sendall(self._respond_status(-1, 'Chunk not found'))
+                return
+            size = os.path.getsize(chunk_path)
+            if os.path.exists(chunk_path + SEALED):
+                response = {'status': APPEND_SEALED, 'message': 'Chunk sealed'}
+            elif offset is None and size + length > limit:
+                response = {'status': APPEND_FULL, 'message': 'Chunk full'}
+            else:
+                if offset is None:
+                    offset = size
+                try:
+                    self._write_at(chunk_id, chunk_path, size, offset, record)
+                    size = max(size, offset + length)
+                except OSError as e:
+                    response = {'status': -1, 'message': f'Append failed: {e}'}
+        if response is None:
+            # every replica must take the record, a failure anywhere fails the append
+            response = self._append_downstream(chunk_id, chain, offset, limit, record)
+            if response['status'] == 0:
+                response['offset'] = offset
+        response['size'] = size
+        client.sendall(protocol.response(response))
+
+    def _write_at(self, chunk_id, chunk_path, size, offset, record):
+        fd = os.open(chunk_path, os.O_RDWR)
+        try:
+            os.pwrite(fd, record, offset)
+            # blocks before the record, or before the old end of the chunk, did not change
+            checksum.extend(fd, chunk_path, min(size, offset))
+        finally:
+            os.close(fd)
+        self.verified.pop(chunk_id, None)
+
+    def _append_downstream(self, chunk_id, chain, offset, limit, record):
+        if not chain:
+            return {'status': 0, 'message': 'Record appended'}
+        try:
+            with self.pool.connection(chain[0]) as downstream:
+                downstream.sendall(self._get_message_data('append_chunk', chunk_id, chain[1:], offset, limit, payload_len=len(record)))
+                downstream.sendall(record)
+                return protocol.recv_frame(downstream).body
+        except OSError as e:
+            # a record must be on every replica, the client appends it to a new chunk instead
+            return {'status': -1, 'message': f'Chunk server {chain[0]} unreachable: {e}'}
+
+    def seal_chunk(self, client, args):
+        # the master moved record appends of the file to a new chunk, this one takes no more
+        chunk_path = os.path.join(self.rootdir, args[0])
+        # answers with the size the chunk ends with, every record acknowledged so far lies within it
+        size = 0
+        with self.chunk_lock(args[0]):
+            if os.path.exists(chunk_path):
+                open(chunk_path + SEALED, 'wb').close()
+                size = os.path.getsize(chunk_path)
+        client.sendall(protocol.response({'status': 0, 'message': 'Chunk sealed', 'size': size}))
+
+    def _forward_chain(self, chunk_id, chain, length):
+        # open a write to the first reachable replica left in the chain, it forwards to the rest.
+        # returns (chunk_loc, connection) or None
+        for idx, chunk_loc in enumerate(chain):
+            try:
+                downstream = self.pool.acquire(chunk_loc)
+            except OSError:
+                print(f"Chunk server {chunk_loc} unreachable, skipping it in the replication chain of {chunk_id}")
+                continue
+            try:
+                downstream.sendall(self._get_message_data('write_chunk', chunk_id, chain[idx + 1:], payload_len=length))
+                return chunk_loc, downstream
+            except OSError:
+                downstream.close()
+                print(f"Chunk server {chunk_loc} unreachable, skipping it in the replication chain of {chunk_id}")
+        return None
+
+
+    def _respond_status(self, code, message):
+        return protocol.status(code, message)
     
     def _response_message(self, code):
 
         response =  {
 			'status': code,
 		}
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        return response
-
-    def _get_message_data(self, function, *args):
-        function = function
-        message = {
-            'sender_type': 'chunk_server',
-            'function': function,
-            'args': args
-        }
+        return protocol.response(response)
 
-        # encode the message in utf8
-        encoded = json.dumps(message).encode('utf-8')
-        encoded += b' ' * (config.MESSAGE_SIZE - len(encoded))
-        return encoded
+    def _get_message_data(self, function, *args, payload_len=0):
+        return protocol.request('chunk_server', function, args, payload_len)
 
     def read_chunk2(self, id):
         data = ''
@@ -147,14 +504,27 @@ class ChunkServer():
     
     # recieve on chunk server side and handle final reply to master in master.py 
     def send_chunk_data_to_new_chunk_server(self, chunk_id, new_chunk_loc):
-        data = self.read_chunk2(chunk_id)
+        # new_chunk_loc is the index of the chunk server receiving the copy
         try:
-            new_chunk_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            new_chunk_server.connect((socket.gethostbyname('localhost'), new_chunk_loc))
-            # new_chunk_server.settimeout(1)
-            request = self._get_message_data('write_chunk', chunk_id)	
-            new_chunk_server.sendall(request)
-            new_chunk_server.sendall(data)
+            with self.pool.connection(new_chunk_loc) as new_chunk_server:
+                # new_chunk_server.settimeout(1)
+                chunk_path = os.path.join(self.rootdir, chunk_id)
+                with open(chunk_path, 'rb') as f:
+                    # a bad replica must not be copied
+                    with self.chunk_lock(chunk_id):
+                        size = os.fstat(f.fileno()).st_size
+                        checksum.check(f, chunk_path)
+                    request = self._get_message_data('write_chunk', chunk_id, payload_len=size)
+                    new_chunk_server.sendall(request)
+                    if size > 0:
+                        new_chunk_server.sendfile(f, 0, size)
+                response = protocol.recv_frame(new_chunk_server).body
+            if response['status'] != 0:
+                print("New chunk server failed to store chunk_id: ", chunk_id)
+                return 0
+        except checksum.ChunkCorrupted as e:
+            self.quarantine(chunk_id, e)
+            return 0
         except socket.timeout:
             print("Socket operation timed out on sending data corresponding to chunk_id: ", chunk_id)
             return 0
@@ -202,4 +572,9 @@ if __name__ == '__main__':
     os.system('clear')
     print('Chunk Server Running')
     cs = ChunkServer(config.HOST, port, rootdir)
-    cs.listen()
\ No newline at end of file
+    cs.start_heart_beat()
+    cs.start_scrubber()
+    if '--asyncio' in sys.argv[2:]:
+        cs.listen_async()
+    else:
+        cs.listen()
\ No newline at end of file
@@ -1,170 +1,348 @@
-import socket
-import pickle
+import sys
 import os.path
 import threading
 import time
-import errno
+import io
 
+import compression
 import config
-import json
+import dedup
+import erasure
+import metadata_cache
+import protocol
+import records
+import transfer
 
 
 class Client():
 	def __init__(self):
 		self.master_dead = True
+		self.cache = metadata_cache.MetadataCache()
+		self.record_chunks = {} # file key -> (chunk_id, chunk_locs, chunk_size) record appends go to
 
 	def create_dir(self, dfs_dir, new_dir):
 		
+			self.cache.invalidate(self.cache.dir_key(dfs_dir))
 			request = self._get_message_data('create_dir', dfs_dir, new_dir)
 			self.master.sendall(request)
-			response = self.master.recv(config.MESSAGE_SIZE)
-			if not response:
-				raise Exception('Master not responding!')
-			response = json.loads(response.decode('utf-8'))
+			response = protocol.recv_frame(self.master).body
 			print(response['message'])
 
-	def create_file(self, local_path, dfs_dir, dfs_name):
+	def create_file(self, local_path, dfs_dir, dfs_name, chunk_size=config.CHUNK_SIZE, codec=compression.NONE, policy=erasure.REPLICATED,
+					deduplicate=False):
 			if not os.path.exists(local_path):
 				raise Exception('Local file does not exist')
-			request = self._get_message_data('create_file', dfs_dir, dfs_name)
+			if deduplicate and policy != erasure.REPLICATED:
+				print('Only replicated files can be deduplicated')
+				return
+			self.cache.invalidate(self.cache.file_key(dfs_dir, dfs_name))
+			self.cache.invalidate(self.cache.dir_key(dfs_dir))
+			request = self._get_message_data('create_file', dfs_dir, dfs_name, chunk_size, codec, policy)
 			self.master.sendall(request)
-			response = self.master.recv(config.MESSAGE_SIZE)
-			if not response:
-				raise Exception('Master not responding!')
-			response = json.loads(response.decode('utf-8'))
+			response = protocol.recv_frame(self.master).body
 			if response['status'] == -1:
 				print(response['message'])
 				return
 
 			num_bytes = os.path.getsize(local_path)
-			chunks = num_bytes // config.CHUNK_SIZE + int(num_bytes%config.CHUNK_SIZE != 0)
+			chunks = num_bytes // chunk_size + int(num_bytes%chunk_size != 0)
+
+			start = time.time()
+			engine = transfer.UploadEngine(chunk_size=chunk_size, codec=codec, policy=policy)
+			# content-addressed chunk ids need the whole file hashed before the master is asked for locations
+			content_ids = dedup.chunk_ids(local_path, chunk_size, codec) if deduplicate else None
+			allocations = self._allocate_chunks(dfs_dir, dfs_name, chunks, content_ids)
+			try:
+				num_bytes = engine.upload(local_path, allocations)
+			except Exception as e:
+				# e.g. the master has no chunk server with free disk space left, it drops the file
+				self.master.send(self._get_message_data('file_failed', dfs_dir, dfs_name))
+				print(f"error: {e}")
+				return
+			finally:
+				allocations.close()
+
+			self._report_failed(engine, dfs_dir, dfs_name)
 
-			dead_chunks = [0]*config.NUM_CHUNKS
-			replication_success = True
-			for chunk in range(chunks):
-				# print(f" Chunk: {chunk} | {chunks}")
-				request = self._get_message_data('set_chunk_loc', dfs_dir, dfs_name)
+			if engine.aborted:
+				request = self._get_message_data('file_failed', dfs_dir, dfs_name)
 				self.master.send(request)
-				response = self.master.recv(config.MESSAGE_SIZE)				
-				if not response:
-					raise Exception('Master not responding!')
-				response = json.loads(response.decode('utf-8'))
-				chunk_id = response['chunk_id']
-				chunk_locs = response['chunk_locs']
-				with open(local_path, 'rb') as f:
-					f.seek(chunk * config.CHUNK_SIZE)
-					data = f.read(config.CHUNK_SIZE)
-
-				count = 0
-				# create a hashmap of chunk locs and thier sockets to avoid constantly connecting to the same chunkserver
-				
-				for chunk_loc in chunk_locs:
-					try:
-						chunk_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-						chunk_server.connect((socket.gethostbyname('localhost'), config.CHUNK_PORTS[chunk_loc]))
-						request = self._get_message_data('write_chunk', chunk_id)
-						chunk_server.sendall(request)
-						chunk_server.sendall(data)
-						chunk_server.close()
-						dead_chunks[chunk_loc] = 0
-						count += 1
-					except Exception as e:
-						replication_success = False
-						if "[Errno 111] Connection refused" in str(e):
-							dead_chunks[chunk_loc] = 1
-						
-					
-				if sum(dead_chunks) == config.NUM_CHUNKS:
-					request = self._get_message_data('file_failed', dfs_dir, dfs_name)
-					self.master.send(request)
-
-				if count == 0:
-					print("too many chunkservers down")
-					return
+				print("too many chunkservers down")
+				return
 
-			request = self._get_message_data("commit_file", dfs_dir, dfs_name)
+			request = self._get_message_data("commit_file", dfs_dir, dfs_name, num_bytes)
 			self.master.send(request)
-			if not replication_success: 
+			elapsed = time.time() - start
+			print(f"Wrote {num_bytes} bytes in {elapsed:.2f}s ({num_bytes / (1024 * 1024) / max(elapsed, 1e-6):.2f} MB/s)")
+			if codec != compression.NONE or policy != erasure.REPLICATED or deduplicate:
+				print(f"Stored {engine.stored_bytes} bytes on the chunk servers with {codec}, {policy}")
+			if deduplicate:
+				print(f"{engine.skipped} of {chunks} chunks were stored already")
+			if engine.failed:
 				print("File written, but some of the chunkservers were down during file writing. Write file again under a separate name or delete and recreate this file later.")
 		
 
 
+	def append_file(self, local_path, dfs_dir, dfs_name):
+			if not os.path.exists(local_path):
+				raise Exception('Local file does not exist')
+			self.cache.invalidate(self.cache.file_key(dfs_dir, dfs_name))
+			# the master write locks the file until the append is committed or aborted
+			request = self._get_message_data('append_file', dfs_dir, dfs_name)
+			self.master.sendall(request)
+			response = protocol.recv_frame(self.master).body
+			if response['status'] == -1:
+				print(response['message'])
+				return
+			chunk_size, codec, policy = response['chunk_size'], response['codec'], response['policy']
+
+			start = time.time()
+			# a partial last chunk, or stripe, is not changed in place but written again with the new data behind it
+			head = io.BytesIO()
+			if response['tail']:
+				engine = transfer.DownloadEngine(chunk_size=chunk_size, codec=codec, policy=policy)
+				try:
+					engine.download(response['tail'], head, response['size'] % chunk_size)
+				except Exception as e:
+					self._abort_append(dfs_dir, dfs_name)
+					print(f"error: {e}")
+					return
+				finally:
+					self._forget_servers(engine)
+			head = head.getvalue()
+
+			num_bytes = len(head) + os.path.getsize(local_path)
+			chunks = num_bytes // chunk_size + int(num_bytes%chunk_size != 0)
+			engine = transfer.UploadEngine(chunk_size=chunk_size, codec=codec, policy=policy)
+			allocations = self._allocate_chunks(dfs_dir, dfs_name, chunks)
+			try:
+				num_bytes = engine.upload(local_path, allocations, head)
+			except Exception as e:
+				allocations.close()
+				self._abort_append(dfs_dir, dfs_name)
+				print(f"error: {e}")
+				return
+			finally:
+				allocations.close()
+
+			self._report_failed(engine, dfs_dir, dfs_name)
+			if engine.aborted:
+				self._abort_append(dfs_dir, dfs_name)
+				print("too many chunkservers down")
+				return
+
+			appended = num_bytes - len(head)
+			request = self._get_message_data('commit_append', dfs_dir, dfs_name, appended)
+			self.master.sendall(request)
+			response = protocol.recv_frame(self.master).body
+			if response['status'] != 0:
+				print(response['message'])
+				return
+			elapsed = time.time() - start
+			print(f"Appended {appended} bytes in {elapsed:.2f}s, {len(head)} bytes of the last chunk written again")
+
+
+	def _abort_append(self, dfs_dir, dfs_name):
+		# the master drops the chunks written so far and unlocks the file
+		self.master.sendall(self._get_message_data('abort_append', dfs_dir, dfs_name))
+		protocol.recv_frame(self.master)
+
+
+	def _report_failed(self, engine, dfs_dir, dfs_name):
+		if engine.failed:
+			# let the master drop the replicas that never received their chunk
+			failed = [[chunk_id, chunk_loc] for chunk_id, chunk_locs in engine.failed.items() for chunk_loc in chunk_locs]
+			request = self._get_message_data('replica_failed', dfs_dir, dfs_name, failed)
+			self.master.send(request)
+
+
+	def record_append(self, dfs_dir, dfs_name, record):
+		# appends the record at an offset the chunk servers choose, any number of clients may do this on one
+		# file at once. Returns the offset of the record in its chunk, None on failure. A record may end up
+		# in the file more than once, see records.py
+		key = self.cache.file_key(dfs_dir, dfs_name)
+		data = records.frame(record)
+		failed = [None, None] # chunk the last attempt failed on and its size, the master seals it
+		for _ in range(config.RECORD_APPEND_RETRIES):
+			target = self.record_chunks.get(key)
+			if target is None or failed[0] is not None:
+				request = self._get_message_data('record_chunk', dfs_dir, dfs_name, *failed)
+				self.master.sendall(request)
+				response = protocol.recv_frame(self.master).body
+				if response['status'] == -1:
+					print(response['message'])
+					return None
+				target = self.record_chunks[key] = (response['chunk_id'], response['chunk_locs'], response['chunk_size'])
+			chunk_id, chunk_locs, chunk_size = target
+			if len(data) > chunk_size // 4:
+				# bounds the space a full chunk leaves unused
+				print(f'Records may take at most a quarter of the chunk size, {chunk_size // 4 - records.HEADER.size} bytes')
+				return None
+			response = transfer.append_chunk(chunk_locs, chunk_id, data, chunk_size)
+			self.cache.invalidate(key)
+			if response['status'] == 0:
+				return response['offset']
+			failed = [chunk_id, response.get('size')]
+		print(f"Record append failed: {response['message']}")
+		return None
+
+
+	def read_records(self, dfs_dir, dfs_name):
+		# the records of a file written with record_append, padding and torn records left out
+		sink = io.BytesIO()
+		if self._read_file(dfs_dir, dfs_name, sink) is None:
+			return None
+		return list(records.parse(sink.getvalue()))
+
+
+	def _allocate_chunks(self, dfs_dir, dfs_name, num_chunks, content_ids=None):
+		# yields (chunk_id, chunk_locs) for every chunk, or every shard of every stripe, of the file; the next batch is
+		# always requested before the current one is handed out so writes never wait on the master.
+		# With content_ids the master is sent the ids themselves, and chunks it already stores come with chunk_locs None
+		if content_ids is None:
+			command = 'allocate_chunks'
+			batches = [min(config.CHUNK_ALLOC_BATCH, num_chunks - start) for start in range(0, num_chunks, config.CHUNK_ALLOC_BATCH)]
+		else:
+			command = 'allocate_content'
+			batches = [content_ids[start:start + config.CHUNK_ALLOC_BATCH] for start in range(0, len(content_ids), config.CHUNK_ALLOC_BATCH)]
+		if not batches:
+			return
+		self.master.sendall(self._get_message_data(command, dfs_dir, dfs_name, batches[0]))
+		outstanding = True
+		try:
+			for idx in range(len(batches)):
+				response = protocol.recv_frame(self.master).body
+				outstanding = False
+				if idx + 1 < len(batches):
+					self.master.sendall(self._get_message_data(command, dfs_dir, dfs_name, batches[idx + 1]))
+					outstanding = True
+				if response['status'] == -1:
+					raise Exception(response['message'])
+				for chunk_id, chunk_locs, *stored in response['chunks']:
+					yield chunk_id, None if stored and stored[0] else chunk_locs
+		finally:
+			# drain the prefetched batch if the caller stopped early so the master connection stays in sync
+			if outstanding:
+				protocol.recv_frame(self.master)
+
+
 	def read_file(self, dfs_dir, dfs_name):
-		fail = False
+		sys.stdout.flush()
+		if self._read_file(dfs_dir, dfs_name, sys.stdout.buffer) is not None:
+			sys.stdout.buffer.flush()
+			print()
+
+
+	def get_file(self, dfs_dir, dfs_name, local_path):
+		start = time.time()
+		with open(local_path, 'wb') as f:
+			num_bytes = self._read_file(dfs_dir, dfs_name, f)
+		if num_bytes is None:
+			os.remove(local_path)
+			return
+		elapsed = time.time() - start
+		print(f"Read {num_bytes} bytes in {elapsed:.2f}s ({num_bytes / (1024 * 1024) / max(elapsed, 1e-6):.2f} MB/s)")
+
+
+	def _read_file(self, dfs_dir, dfs_name, sink):
+		# streams the file into sink, returns the number of bytes written or None on failure
+		key = self.cache.file_key(dfs_dir, dfs_name)
+		cached = self.cache.get(key)
+		done = None
+		if cached is not None:
+			# the chunk map is still under lease, the master is not asked at all
+			engine = transfer.DownloadEngine(chunk_size=cached['chunk_size'], codec=cached['codec'], policy=cached['policy'])
+			try:
+				return engine.download(cached['chunks'], sink, cached['size'])
+			except Exception:
+				# no replica of a chunk answered, ask the master where the chunks are now
+				self.cache.invalidate(key)
+				done = engine
+			finally:
+				self._forget_servers(engine)
 
 		try:
 			request = self._get_message_data('read_file', dfs_dir, dfs_name)
 			self.master.sendall(request)
-			chunk_ids, chunks_locs = [], []
-			while True:
-				response = self.master.recv(config.MESSAGE_SIZE)
-				if not response:
-					raise Exception('Master not responding!')
-				response = json.loads(response.decode('utf-8'))
-				if response['status'] == -1:
-					print(response['message'])
-					fail = True
-					break
-				if response['status'] == 1:
-					break
-				chunk_ids.append(response['chunk_id'])
-				chunks_locs.append(response['chunk_loc'])
-
-			if not fail:
-				data = ''
-				final_success = True
-				
-				for id, locs in zip(chunk_ids, chunks_locs):
-					success = False
-					for loc in locs:
-						if success == False:
-							try:
-								chunk_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-								chunk_server.connect((socket.gethostbyname('localhost'), config.CHUNK_PORTS[loc]))
-								request = self._get_message_data('read_chunk', id)	
-								chunk_server.sendall(request)
-								response = chunk_server.recv(config.MESSAGE_SIZE)
-								response = json.loads(response.decode('utf-8'))
-								if response['status'] == -1:
-									success = False
-								else:
-									data += response['data']
-									# print(response['data'])
-									success = True
-							except:
-								replication_success = False
-								success = False
-						else:
-							break
-					if success == False:
-						final_success = False
-						break
-				
-				if final_success == False:
-					print("error: too many chunkservers down")
-					self.master.send(self._get_status_data(-1, "error: too many chunkservers down."))
-				else:
-					self.master.send(self._get_status_data(0, "ok"))
-					print(data)
+			response = protocol.recv_frame(self.master).body
+			if response['status'] == -1:
+				print(response['message'])
+				return None
+
+			chunks = response['chunks']
+			skip = 0
+			if done is not None:
+				# go on after the chunks the cached read already wrote out
+				skip = done.chunks_done
+				if [chunk_id for chunk_id, _ in chunks[:skip]] != [chunk_id for chunk_id, _ in cached['chunks'][:skip]]:
+					print('error: file changed while it was read')
+					self._release_read(dfs_dir, dfs_name, -1, 'error: file changed while it was read')
+					return None
+			codec = response.get('codec', compression.NONE)
+			policy = response.get('policy', erasure.REPLICATED)
+			self.cache.put(key, {'chunk_size': response['chunk_size'], 'codec': codec, 'policy': policy, 'size': response['size'],
+								 'chunks': chunks}, response.get('lease'))
+
+			engine = transfer.DownloadEngine(chunk_size=response['chunk_size'], codec=codec, policy=policy)
+			finished = threading.Event()
+			renewer = threading.Thread(target=self._renew_leases, args=(finished,), daemon=True)
+			renewer.start()
+			try:
+				# skipped chunks, or stripes, all held a full chunk size
+				num_bytes = engine.download(chunks[skip:], sink, response['size'] - (done.bytes_done if done else 0))
+			except Exception as e:
+				self.cache.invalidate(key)
+				print(f"error: {e}")
+				finished.set()
+				renewer.join()
+				self._release_read(dfs_dir, dfs_name, -1, f"error: {e}")
+				return None
+			finally:
+				finished.set()
+				renewer.join()
+				self._forget_servers(engine)
+			self._release_read(dfs_dir, dfs_name, 0, "ok")
+			if done is not None:
+				num_bytes += done.bytes_done
+			return num_bytes
 		except Exception as e:
 			self.master.close()
 			self.master_dead = True
 			if "[Errno 32] Broken pipe" in str(e):
 				print('Master not responding!')
 			# else: print(e)
+
+
+	def _renew_leases(self, finished):
+		# a download sends the master nothing, this keeps the read lock from running out under it
+		while not finished.wait(config.LOCK_RENEW_INTERVAL):
+			try:
+				self.master.sendall(self._get_message_data('renew_lease'))
+			except OSError:
+				return
+
+	def _release_read(self, dfs_dir, dfs_name, status, message):
+		# drops the shared lock read_file took, the master does not answer
+		self.master.sendall(self._get_message_data('release_read', dfs_dir, dfs_name, status, message))
+
+	def _forget_servers(self, engine):
+		# cached chunk maps naming a chunk server that did not answer are stale
+		for chunk_loc in engine.unreachable:
+			self.cache.invalidate_server(chunk_loc)
 		
 	
 	def list_files(self, dfs_dir):
 		try:
-			request = self._get_message_data('list_files', dfs_dir)
-			self.master.sendall(request)
-			response = self.master.recv(config.MESSAGE_SIZE)
-			if not response:
-				raise Exception('Master not responding!')
-			response = json.loads(response.decode('utf-8'))
-			if response['status'] == -1:
-				print(response['message'])
-				return
+			key = self.cache.dir_key(dfs_dir)
+			response = self.cache.get(key)
+			if response is None:
+				request = self._get_message_data('list_files', dfs_dir)
+				self.master.sendall(request)
+				response = protocol.recv_frame(self.master).body
+				if response['status'] == -1:
+					print(response['message'])
+					return
+				self.cache.put(key, response, response.get('lease'))
 			for file in response['data']:
 				print(file)
 			for directory in response['directories']:
@@ -178,56 +356,17 @@ class Client():
 
 
 	def delete_file(self, dfs_dir, dfs_name):
-		fail = False
+		# the master drops the metadata and deletes the chunks in the background
+		self.cache.invalidate(self.cache.file_key(dfs_dir, dfs_name))
+		self.cache.invalidate(self.cache.dir_key(dfs_dir))
 		try:
 			request = self._get_message_data('delete_file', dfs_dir, dfs_name)
 			self.master.sendall(request)
-			chunk_ids, chunks_locs = [], []
-			while True:
-				# time.sleep(0.2)
-				response = self.master.recv(config.MESSAGE_SIZE)
-				if not response:
-					raise Exception('Master not responding!')
-				response = json.loads(response.decode('utf-8'))
-				if response['status'] == -1:
-					print(response['message'])
-					fail = True
-					break
-				if response['status'] == 1:
-					break
-				chunk_ids.append(response['chunk_id'])
-				chunks_locs.append(response['chunk_loc'])
-
-			if not fail:
-				for id, locs in zip(chunk_ids, chunks_locs):
-					dead_chunks = [0]*config.NUM_CHUNKS
-					for loc in locs:
-						try:
-							chunk_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-							chunk_server.connect((socket.gethostbyname('localhost'), config.CHUNK_PORTS[loc]))
-							request = self._get_message_data('delete_chunk', id)	
-							chunk_server.sendall(request)
-							response = chunk_server.recv(config.MESSAGE_SIZE)
-							if not response:
-								raise Exception('Chunkserver not responding!')
-							response = json.loads(response.decode('utf-8'))
-							chunk_server.close()
-							dead_chunks[loc] = 0
-						except Exception as e:
-							if "[Errno 111] Connection refused" in str(e):
-								dead_chunks[loc] = 1
-
-						if sum(dead_chunks) == config.NUM_CHUNKS:
-							request = self._get_message_data('file_failed', dfs_dir, dfs_name)
-							self.master.send(request)
-
-				request = self._get_message_data("commit_delete", dfs_dir, dfs_name)
-				self.master.send(request)
-				self.master.recv(config.MESSAGE_SIZE)
-				if response['status'] != 0:
-					print(response['message'])
-				else:
-					print(f"Deleted {dfs_name}")
+			response = protocol.recv_frame(self.master).body
+			if response['status'] != 0:
+				print(response['message'])
+			else:
+				print(f"Deleted {dfs_name}")
 		except Exception as e:
 			self.master.close()
 			self.master_dead = True
@@ -243,27 +382,8 @@ class Client():
 			self.master.close()
 
 
-	def _get_message_data(self, function, *args):
-		function = function
-		message = {
-			'sender_type': 'client',
-			'function': function,
-			'args': args
-		}
-
-		encoded = json.dumps(message).encode('utf-8')
-		encoded += b' ' * (config.MESSAGE_SIZE - len(encoded))
-		return encoded
-
-
-	def _get_status_data(self, status, message):
-		message = {
-			'status': status,
-			'message': message
-		}
-		encoded = json.dumps(message).encode('utf-8')
-		encoded += b' ' * (config.MESSAGE_SIZE - len(encoded))
-		return encoded
+	def _get_message_data(self, function, *args, payload_len=0):
+		return protocol.request('client', function, args, payload_len)
 		
 
 if __name__ == '__main__':
@@ -272,10 +392,12 @@ if __name__ == '__main__':
 	while True:
 		if client.master_dead:
 			try:
-				client.master = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				client.master.connect((socket.gethostbyname('localhost'), config.MASTER_PORT))
+				client.master = protocol.connect(config.MASTER_PORT, 'client')
 				client.master_dead = False
 				print('Connected to DFS')
+			except protocol.ProtocolError as e:
+				print(e)
+				break
 			except:
 				time.sleep(2)
 				print('DFS currently down. Reconnecting...')
@@ -312,14 +434,53 @@ if __name__ == '__main__':
 				else:
 					print('usage: read <dfs_directory> <dfs_name>')
 
+			elif command == 'get':
+				# usage: get <dfs_directory> <dfs_name> <local_file>
+				if len(args) == 3:
+					client.get_file(args[0], args[1], args[2])
+				else:
+					print('usage: get <dfs_directory> <dfs_name> <local_file>')
+
 			elif command == 'create':
-				# usage: create <local_file> <dfs_directory> <dfs_name>
+				# usage: create <local_file> <dfs_directory> <dfs_name> [chunk_size] [codec] [policy] [dedup]
+				options = {}
+				for arg in args[3:]:
+					if arg == 'dedup':
+						options.setdefault('deduplicate', True)
+					elif arg.isdigit():
+						options.setdefault('chunk_size', int(arg))
+					elif arg == erasure.REPLICATED or arg.startswith('ec:'):
+						options.setdefault('policy', arg)
+					else:
+						options.setdefault('codec', arg)
+				if len(args) >= 3 and len(options) == len(args) - 3:
+					client.create_file(args[0], args[1], args[2], **options)
+				else:
+					print('usage: create <local_file> <dfs_directory> <dfs_name> [chunk_size] [codec] [policy] [dedup]')
+
+			elif command == 'append':
+				# usage: append <local_file> <dfs_directory> <dfs_name>
 				if len(args) == 3:
-					client.create_file(args[0], args[1], args[2])
-				elif len(args) > 3:
-					print('usage: create <local_file> <dfs_directory> <dfs_name>')
+					client.append_file(args[0], args[1], args[2])
+				else:
+					print('usage: append <local_file> <dfs_directory> <dfs_name>')
+
+			elif command == 'record_append':
+				# usage: record_append <dfs_directory> <dfs_name> <record>
+				if len(args) >= 3:
+					offset = client.record_append(args[0], args[1], ' '.join(args[2:]).encode())
+					if offset is not None:
+						print(f"Record appended at offset {offset} of its chunk")
+				else:
+					print('usage: record_append <dfs_directory> <dfs_name> <record>')
+
+			elif command == 'records':
+				# usage: records <dfs_directory> <dfs_name>
+				if len(args) == 2:
+					for record in client.read_records(args[0], args[1]) or []:
+						print(record.decode(errors='replace'))
 				else:
-					print('usage: create <local_file> <dfs_directory> <dfs_name>')
+					print('usage: records <dfs_directory> <dfs_name>')
 
 			elif command == 'create_dir':
 				# usage: create_dir <dfs_directory> <directory_name>
@@ -0,0 +1,87 @@
+"""Chunk compression, chosen per file when it is created.
+
+A codec is named 'none', 'zlib', 'zlib:<level>' (1-9), 'lzma' or
+'lzma:<preset>' (0-9). Chunks of a file with a codec other than 'none' are
+stored as
+
+    flag (B) | raw length (I) | stored length (I) | data
+
+where the flag says whether the data is compressed or kept as it is,
+because compressing did not make it smaller. Chunks of 'none' files are
+stored as they are, like chunks of files created before codecs existed.
+The logical size of every chunk but the last is still the file's chunk
+size, so a byte offset maps to a chunk the same way for every codec.
+"""
+import lzma
+import struct
+import zlib
+
+import config
+
+HEADER = struct.Struct('!BII')
+RAW = 0
+COMPRESSED = 1
+
+NONE = 'none'
+LEVELS = {'zlib': (range(1, 10), 6), 'lzma': (range(0, 10), 6)} # codec -> (valid levels, default level)
+
+
+def parse(name):
+    """Returns (codec, level) of a codec name, raises an Exception for unknown ones."""
+    codec, _, level = name.partition(':')
+    if codec == NONE and not level:
+        return NONE, None
+    if codec not in LEVELS:
+        raise Exception(f'Unknown codec {name}, use none, zlib[:1-9] or lzma[:0-9]')
+    levels, default = LEVELS[codec]
+    if not level:
+        return codec, default
+    if not level.isdigit() or int(level) not in levels:
+        raise Exception(f'Unknown level {level} of codec {codec}')
+    return codec, int(level)
+
+
+def encode(name, data):
+    """Returns the chunk as it is stored for a file with the codec."""
+    codec, level = parse(name)
+    if codec == NONE:
+        return data
+    probe = data[:config.COMPRESSION_PROBE]
+    if len(data) > len(probe) and len(zlib.compress(probe, 1)) >= len(probe):
+        # a sample that does not shrink at the fastest level saves compressing the whole chunk
+        return HEADER.pack(RAW, len(data), len(data)) + data
+    if codec == 'zlib':
+        compressed = zlib.compress(data, level)
+    else:
+        compressed = lzma.compress(data, preset=level)
+    if len(compressed) >= len(data):
+        # incompressible data is kept as it is
+        return HEADER.pack(RAW, len(data), len(data)) + data
+    return HEADER.pack(COMPRESSED, len(data), len(compressed)) + compressed
+
+
+def decode(name, stored, padded=False):
+    """Returns the data of a stored chunk of a file with the codec.
+
+    `padded` chunks may end in bytes past the stored data, like the decoded
+    stripes of erasure coded files.
+    """
+    codec, _ = parse(name)
+    if codec == NONE:
+        return stored
+    if len(stored) < HEADER.size:
+        raise Exception('Stored chunk is shorter than its header')
+    flag, raw_length, stored_length = HEADER.unpack_from(stored)
+    body = memoryview(stored)[HEADER.size:]
+    if len(body) != stored_length and not (padded and len(body) > stored_length):
+        raise Exception(f'Stored chunk holds {len(body)} bytes instead of {stored_length}')
+    body = body[:stored_length]
+    if flag == RAW:
+        data = bytes(body)
+    elif codec == 'zlib':
+        data = zlib.decompress(body)
+    else:
+        data = lzma.decompress(body)
+    if len(data) != raw_length:
+        raise Exception(f'Chunk decompressed to {len(data)} bytes instead of {raw_length}')
+    return data
@@ -1,19 +1,72 @@
 HOST = "localhost"
-CHUNK_SIZE = 4096
-MESSAGE_SIZE = 8192
-PACKET_SIZE = 16384
+CHUNK_SIZE = 1048576 # default chunk size of new files, chosen per file at create time
+MAX_CHUNK_SIZE = 67108864
+LEGACY_CHUNK_SIZE = 4096 # chunk size of files logged before it was stored per file
+MESSAGE_SIZE = 8192 # size of the old padded JSON messages, only used to reject old peers
+PACKET_SIZE = 262144 # receive buffer of a chunk write
+CHECKSUM_BLOCK = 65536 # bytes covered by one checksum of a chunk
+VERIFY_BUFFER = 1048576 # bytes read at a time when checking chunk checksums
+COMPRESSION_PROBE = 65536 # bytes at the start of a chunk compressed first, chunks whose sample does not shrink are stored uncompressed
+CHUNK_ALLOC_BATCH = 256 # chunk ids handed out per allocate_chunks call
+UPLOAD_WINDOW = 16 # chunks buffered or in flight per upload
+TRANSFER_MEMORY = 268435456 # upper bound on chunk bytes buffered by one upload or read, shrinks the windows for big chunks
+UPLOAD_WORKERS = 8 # threads writing chunks to chunk servers per upload
+UPLOAD_READ_BUFFER = 1048576 # read buffer of the local file being uploaded
+DOWNLOAD_WINDOW = 16 # chunks fetched ahead of the one being written out per read
+DOWNLOAD_WORKERS = 8 # threads reading chunks from chunk servers per read
+READ_LATENCY_ALPHA = 0.2 # weight of the newest read in the moving average latency of a chunk server
+READ_FAILURE_PENALTY = 1.0 # seconds a failed read counts as in the moving average
+HEDGE_PERCENTILE = 95 # a chunk read slower than this percentile of recent reads is repeated on another replica, 0 disables hedging
+HEDGE_MIN_DELAY = 0.005 # shortest wait in seconds before a hedged read
+HEDGE_MIN_SAMPLES = 20 # reads measured before hedging starts
+HEDGE_REFRESH = 64 # reads between recomputations of the hedge delay
+LATENCY_WINDOW = 1000 # recent read latencies the hedge percentile is taken over
+POOL_MAX_SIZE = 8 # idle connections kept per chunk server
+POOL_IDLE_TIMEOUT = 60 # seconds before an idle pooled connection is closed
+LISTEN_BACKLOG = 1024 # pending connections queued by the master and chunk server sockets
+MAX_CONNECTIONS = 10000 # open connections served at once by a server in --asyncio mode
+SERVER_WORKERS = 32 # threads running request handlers of a server in --asyncio mode
+CHUNK_LOCKS = 64 # locks a chunk server spreads its chunks over, serializing record appends with checksum checks
+RECORD_LOCKS = 64 # locks the master spreads the files taking record appends over
+RECORD_APPEND_RETRIES = 5 # attempts of a record append, each after a failed or full chunk
 
 
 MASTER_PORT = 8090
 MASTER_SERVER = "localhost"
 HEART_BEAT_INTERVAL = 5
 HEART_BEAT_TIMEOUT = 10
+SCRUB_RATE = 10485760 # bytes per second the scrubber of a chunk server reads
+SCRUB_INTERVAL = 86400 # seconds before a chunk is checked again by the scrubber
+SCRUB_IDLE = 60 # seconds between walks of the chunk directory
 PRUNING_INTERVAL = 5
+GC_INTERVAL = 1 # seconds between garbage collection rounds
+GC_BATCH = 1000 # chunk ids per delete_chunks request, at most one request per chunk server and round
+GC_RETRY_MAX = 60 # longest backoff in seconds before retrying a chunk server garbage collection failed on
+GC_GRACE = 60 # seconds the chunks of a deleted file are kept, must be longer than METADATA_LEASE
+LOCK_LEASE = 300 # seconds a file lock outlives the last request of the client holding it
+LOCK_RENEW_INTERVAL = 60 # seconds between the lease renewals of a client reading a file, shorter than LOCK_LEASE
+METADATA_LEASE = 30 # seconds a client may use a chunk map or directory listing without asking the master again, 0 disables caching
+METADATA_CACHE_SIZE = 1024 # chunk maps and directory listings cached per client
 MASTER_LOG = 'master.log'
+MASTER_SNAPSHOT = 'master.snapshot' # snapshots of the namespace, master.snapshot.N covers log segments up to master.log.N
+REPLAY_MAX_SKIPPED = 0 # log records naming a missing directory that startup skips before the master refuses to start
+JOURNAL_SYNC = True # fdatasync the journal before a change is acknowledged
+JOURNAL_SYNC_WINDOW = 0.001 # seconds the journal waits for more changes before syncing a batch
+SNAPSHOT_INTERVAL = 10 # seconds between checks whether a snapshot is due
+SNAPSHOT_LOG_BYTES = 16777216 # log written since the last snapshot that makes a new one due
 
 
 NUM_CHUNKS = 6
 CHUNK_PORTS = [8000, 8001, 8002, 8003, 8004, 8005]
 
 REPLICATION_FACTOR = 3
+PLACEMENT_MODE = 'weighted' # 'weighted': by free disk and load, 'p2c': better of two random servers, 'random': uniform
+PLACEMENT_MIN_FREE_DISK = 1073741824 # chunk servers with less free disk get no new replicas
+PLACEMENT_RATE_WEIGHT = 0.01 # requests per second that weigh as much as one in-flight write
+FAILURE_DOMAINS = ['rack0', 'rack0', 'rack1', 'rack1', 'rack2', 'rack2'] # rack of each chunk server, None for one per server
+REPLICATION_INTERVAL = 1 # seconds between rounds of the re-replication scheduler
+REPLICATION_SCAN_INTERVAL = 300 # seconds between full scans for under-replicated chunks, besides the scan when a server goes down
+REPLICATION_MAX_PER_SERVER = 2 # chunk copies in flight per chunk server, as source or target
+REPLICATION_TIMEOUT = 120 # seconds the master waits for one chunk copy
+REPLICATION_MODE = 'chain' # 'chain': client sends a chunk once and replicas forward it, 'fanout': client sends to every replica
 ROOT_DIR = ['./chunkdata/chunk0', './chunkdata/chunk1', './chunkdata/chunk2', './chunkdata/chunk3', './chunkdata/chunk4', './chunkdata/chunk5']
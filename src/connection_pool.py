@@ -0,0 +1,76 @@
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import protocol
+
+
+class ConnectionPool():
+    """Keeps handshaken connections to the chunk servers open for reuse.
+
+    Connections are keyed by chunk server index. At most `max_size` idle
+    connections are kept per chunk server, connections idle for longer than
+    `idle_timeout` are closed instead of reused, and every idle connection is
+    checked for a hang up by the peer before it is handed out again.
+    """
+    def __init__(self, sender_type, max_size=config.POOL_MAX_SIZE, idle_timeout=config.POOL_IDLE_TIMEOUT, timeout=None):
+        self.sender_type = sender_type
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {} # chunk_loc -> [(sock, last_used)], most recently used last
+
+    @contextmanager
+    def connection(self, chunk_loc):
+        """Yields a connection to the chunk server, returned to the pool unless the block raised."""
+        sock = self.acquire(chunk_loc)
+        try:
+            yield sock
+        except BaseException:
+            sock.close()
+            raise
+        self.release(chunk_loc, sock)
+
+    def acquire(self, chunk_loc):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get(chunk_loc)
+                if not idle:
+                    break
+                sock, last_used = idle.pop()
+            if now - last_used < self.idle_timeout and self._healthy(sock):
+                return sock
+            sock.close()
+        return protocol.connect(config.CHUNK_PORTS[chunk_loc], self.sender_type, timeout=self.timeout)
+
+    def release(self, chunk_loc, sock):
+        with self.lock:
+            idle = self.idle.setdefault(chunk_loc, [])
+            if len(idle) < self.max_size:
+                idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def clear(self, chunk_loc=None):
+        """Closes the idle connections to one chunk server, or to all of them."""
+        with self.lock:
+            if chunk_loc is None:
+                idle = [conn for conns in self.idle.values() for conn in conns]
+                self.idle = {}
+            else:
+                idle = self.idle.pop(chunk_loc, [])
+        for sock, _ in idle:
+            sock.close()
+
+    def _healthy(self, sock):
+        # an idle connection must have nothing to read, EOF or stray data means it is unusable
+        poller = select.poll()
+        try:
+            poller.register(sock, select.POLLIN)
+        except (OSError, ValueError):
+            return False
+        return not poller.poll(0)
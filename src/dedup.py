@@ -0,0 +1,41 @@
+"""Content-addressed chunk ids of deduplicated files.
+
+A file created with dedup gets chunk ids derived from the bytes of its
+chunks instead of random UUIDs:
+
+    PREFIX + sha256(codec name | 0 | chunk data)
+
+The codec is part of the hash because chunks are stored after compression,
+so the same data under two codecs are two different chunks. The client
+hashes the file before it asks the master for chunk locations, and does not
+write the chunks the chunk servers already hold. The master counts the
+files referencing every such chunk and only deletes it when the last one
+is gone.
+"""
+import hashlib
+
+import config
+
+PREFIX = 'sha256-'
+
+
+def content_id(codec, data):
+    digest = hashlib.sha256(codec.encode() + b'\0')
+    digest.update(data)
+    return PREFIX + digest.hexdigest()
+
+
+def is_content_id(chunk_id):
+    return chunk_id.startswith(PREFIX)
+
+
+def chunk_ids(local_path, chunk_size, codec):
+    """Returns the content ids of the chunks of a local file, in file order."""
+    ids = []
+    with open(local_path, 'rb', buffering=config.UPLOAD_READ_BUFFER) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            ids.append(content_id(codec, data))
+    return ids
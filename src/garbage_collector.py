@@ -0,0 +1,125 @@
+import itertools
+import threading
+import time
+
+import config
+import protocol
+
+
+class DeleteQueue():
+    """Chunk replicas waiting to be deleted, grouped by chunk server index.
+
+    The queue is part of the master's state: it is rebuilt from the journal
+    and stored in snapshots, so deletes survive a master restart. A replica
+    is only handed out for deletion `grace` seconds after it was queued, so
+    clients reading with a cached chunk map can finish within their lease.
+    """
+    def __init__(self, grace=config.GC_GRACE):
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.pending = {} # chunk_loc -> {chunk_id: time it may be deleted}, oldest first
+
+    def add(self, chunks):
+        """Queues the replicas of the (chunk_id, chunk_locs) pairs."""
+        ready = time.monotonic() + self.grace
+        with self.lock:
+            for chunk_id, chunk_locs in chunks:
+                for chunk_loc in chunk_locs:
+                    self.pending.setdefault(chunk_loc, {}).setdefault(chunk_id, ready)
+
+    def done(self, chunk_loc, chunk_ids):
+        with self.lock:
+            pending = self.pending.get(chunk_loc)
+            if pending is None:
+                return
+            for chunk_id in chunk_ids:
+                pending.pop(chunk_id, None)
+            if not pending:
+                del self.pending[chunk_loc]
+
+    def take(self, chunk_loc, count):
+        """Returns up to `count` of the oldest chunk ids that are due on the chunk server, without removing them."""
+        now = time.monotonic()
+        with self.lock:
+            pending = self.pending.get(chunk_loc, {})
+            due = itertools.takewhile(lambda chunk_id: pending[chunk_id] <= now, pending)
+            return list(itertools.islice(due, count))
+
+    def holders(self, chunk_id):
+        """Returns the chunk servers still due to delete a replica of the chunk."""
+        with self.lock:
+            return [chunk_loc for chunk_loc, pending in self.pending.items() if chunk_id in pending]
+
+    def locations(self):
+        with self.lock:
+            return list(self.pending)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(pending) for pending in self.pending.values())
+
+    def dump(self):
+        with self.lock:
+            return {chunk_loc: list(pending) for chunk_loc, pending in self.pending.items()}
+
+    def load(self, state):
+        # the grace period starts over, clients may have cached the chunk maps before the restart
+        ready = time.monotonic() + self.grace
+        with self.lock:
+            for chunk_loc, chunk_ids in state.items():
+                pending = self.pending.setdefault(chunk_loc, {})
+                for chunk_id in chunk_ids:
+                    pending.setdefault(chunk_id, ready)
+
+
+class GarbageCollector():
+    """Deletes the queued chunk replicas in the background.
+
+    Every `interval` seconds each live chunk server with queued replicas gets one
+    delete_chunks request with at most `batch` chunk ids, which also bounds
+    the delete rate per server. A chunk server that fails is retried with
+    exponential backoff, up to GC_RETRY_MAX seconds apart. Finished deletes
+    are journaled so they are not repeated after a restart.
+    """
+    def __init__(self, queue, pool, logger, registry, batch=config.GC_BATCH, interval=config.GC_INTERVAL):
+        self.queue = queue
+        self.pool = pool
+        self.logger = logger
+        self.registry = registry
+        self.batch = batch
+        self.interval = interval
+        self.failures = {} # chunk_loc -> failed attempts in a row
+        self.retry_at = {} # chunk_loc -> earliest next attempt
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for chunk_loc in self.queue.locations():
+                if not self.registry.is_alive(chunk_loc):
+                    continue
+                if self.retry_at.get(chunk_loc, 0) <= time.monotonic():
+                    self.collect(chunk_loc)
+
+    def collect(self, chunk_loc):
+        chunk_ids = self.queue.take(chunk_loc, self.batch)
+        if not chunk_ids:
+            return
+        try:
+            with self.pool.connection(chunk_loc) as sock:
+                sock.sendall(protocol.request('master', 'delete_chunks', [chunk_ids]))
+                response = protocol.recv_frame(sock).body
+            if response['status'] != 0:
+                raise Exception(response.get('message', 'delete_chunks failed'))
+        except Exception as e:
+            failures = self.failures.get(chunk_loc, 0) + 1
+            self.failures[chunk_loc] = failures
+            self.retry_at[chunk_loc] = time.monotonic() + min(config.GC_RETRY_MAX, self.interval * 2 ** failures)
+            print(f'Garbage collection on chunk server {chunk_loc} failed: {e}')
+            return
+
+        self.failures.pop(chunk_loc, None)
+        self.retry_at.pop(chunk_loc, None)
+        failed = set(response.get('failed', []))
+        deleted = [chunk_id for chunk_id in chunk_ids if chunk_id not in failed]
+        self.queue.done(chunk_loc, deleted)
+        self.logger.log_info('gc_done', [chunk_loc, deleted])
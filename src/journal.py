@@ -0,0 +1,146 @@
+"""Binary operation journal of the master.
+
+A journal file starts with MAGIC and holds one record per operation:
+
+    payload length (I) | crc32 of payload (I) | payload
+
+The payload is the compact JSON of [command, args]. A record whose header or
+payload is cut short, or whose checksum does not match, marks the torn tail
+of a journal that was being written when the master died; it and everything
+after it are dropped on replay.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import config
+
+MAGIC = b'DFSJ\x01'
+RECORD = struct.Struct('!II')
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def encode(command, args):
+    payload = json.dumps([command, args], separators=(',', ':')).encode('utf-8')
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def is_journal(path):
+    # a journal cut off inside its header is still a journal
+    with open(path, 'rb') as f:
+        return MAGIC.startswith(f.read(len(MAGIC)))
+
+
+def read(path, truncate=True):
+    """Returns the (command, args) records of a journal, cutting off a torn tail when `truncate` is set."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    view = memoryview(data)
+    records = []
+    pos = len(MAGIC) if len(data) >= len(MAGIC) else 0
+    while pos + RECORD.size <= len(data):
+        length, crc = RECORD.unpack_from(data, pos)
+        payload = view[pos + RECORD.size:pos + RECORD.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        command, args = json.loads(bytes(payload))
+        records.append((command, args))
+        pos += RECORD.size + length
+
+    if pos < len(data):
+        print(f'Dropping {len(data) - pos} bytes of torn records at the end of {path}')
+        if truncate:
+            with open(path, 'r+b') as f:
+                f.truncate(pos)
+                fdatasync(f.fileno())
+    return records
+
+
+class Journal():
+    """Appends records to a journal file, syncing concurrent appends together.
+
+    `write` queues a record and returns a ticket, `wait` returns once that
+    record is on disk. One writer thread writes everything queued so far with
+    a single write and fdatasync, after waiting up to `window` seconds for
+    more records to join the batch, so concurrent handlers share one sync.
+    """
+    def __init__(self, path, window=config.JOURNAL_SYNC_WINDOW, sync=config.JOURNAL_SYNC):
+        self.window = window
+        self.sync = sync
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            self.f.write(MAGIC)
+            self.f.flush()
+        self.cond = threading.Condition()
+        self.pending = []
+        self.queued = 0 # tickets handed out
+        self.durable = 0 # tickets on disk
+        self.batches = 0
+        self.error = None
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_batches, daemon=True)
+        self.writer.start()
+
+    def write(self, command, args):
+        """Queues a record, returns its ticket and size in bytes."""
+        record = encode(command, args)
+        with self.cond:
+            if self.closed:
+                raise Exception('Journal is closed')
+            self.pending.append(record)
+            self.queued += 1
+            self.cond.notify_all()
+            return self.queued, len(record)
+
+    def wait(self, ticket):
+        with self.cond:
+            while self.durable < ticket and self.error is None:
+                self.cond.wait()
+            if self.durable < ticket:
+                raise Exception(f'Journal write failed: {self.error}')
+
+    def append(self, command, args):
+        ticket, _ = self.write(command, args)
+        self.wait(ticket)
+
+    def close(self):
+        """Writes out the queued records and closes the file."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        self.f.close()
+
+    def _write_batches(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                closing = self.closed
+            if self.window and not closing:
+                time.sleep(self.window)
+
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+                last = self.queued
+            try:
+                self.f.write(b''.join(batch))
+                self.f.flush()
+                if self.sync:
+                    fdatasync(self.f.fileno())
+            except OSError as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.durable = last
+                self.batches += 1
+                self.cond.notify_all()
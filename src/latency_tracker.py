@@ -0,0 +1,63 @@
+import threading
+from collections import deque
+
+import config
+
+
+class LatencyTracker():
+    """Chunk read latencies seen by this process.
+
+    Every chunk server has a moving average of its read latency, used to try
+    the fastest replica first. Servers not read from yet count as fast, so
+    they get measured. A failed read counts as a read of
+    READ_FAILURE_PENALTY seconds. The last `window` latencies of all servers
+    give the hedge delay: a read still running after the `percentile`th
+    percentile latency is repeated on another replica.
+    """
+    def __init__(self, alpha=config.READ_LATENCY_ALPHA, percentile=config.HEDGE_PERCENTILE, window=config.LATENCY_WINDOW):
+        self.alpha = alpha
+        self.percentile = percentile
+        self.lock = threading.Lock()
+        self.averages = {} # chunk_loc -> moving average in seconds
+        self.samples = deque(maxlen=window)
+        self.delay = None
+        self.stale = 0 # samples since the delay was computed
+
+    def record(self, chunk_loc, seconds):
+        with self.lock:
+            self._update(chunk_loc, seconds)
+            self.samples.append(seconds)
+            self.stale += 1
+
+    def failed(self, chunk_loc):
+        with self.lock:
+            self._update(chunk_loc, config.READ_FAILURE_PENALTY)
+
+    def order(self, chunk_locs):
+        """Returns the replicas fastest first, keeping the given order between equally fast ones."""
+        with self.lock:
+            return sorted(chunk_locs, key=lambda chunk_loc: self.averages.get(chunk_loc, 0.0))
+
+    def average(self, chunk_loc):
+        with self.lock:
+            return self.averages.get(chunk_loc)
+
+    def hedge_delay(self):
+        """Seconds after which a read gets a hedged duplicate, None while hedging is off or there are too few samples."""
+        with self.lock:
+            if not self.percentile or len(self.samples) < config.HEDGE_MIN_SAMPLES:
+                return None
+            # sorting the window on every read would cost more than the reads, refresh now and then
+            if self.delay is None or self.stale >= config.HEDGE_REFRESH:
+                ordered = sorted(self.samples)
+                idx = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+                self.delay = max(config.HEDGE_MIN_DELAY, ordered[idx])
+                self.stale = 0
+            return self.delay
+
+    def _update(self, chunk_loc, seconds):
+        average = self.averages.get(chunk_loc)
+        if average is None:
+            self.averages[chunk_loc] = seconds
+        else:
+            self.averages[chunk_loc] = average + self.alpha * (seconds - average)
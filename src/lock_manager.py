@@ -0,0 +1,100 @@
+import threading
+import time
+
+import config
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+
+class FileLock():
+    def __init__(self, mode):
+        self.mode = mode
+        self.holders = {} # owner -> times the owner holds the lock
+        self.expires = 0
+
+
+class LockManager():
+    """Shared and exclusive file locks held by client connections.
+
+    Locks are keyed by file inode and owners are client connections. Every
+    lock carries a lease that the owner renews with each request it sends; a
+    lock whose lease ran out is dropped the next time anyone looks at it, so a
+    hung client can not keep a file locked forever. Conflict checks, acquires
+    and releases only touch the entry of one file.
+    """
+    def __init__(self, lease=config.LOCK_LEASE):
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.locks = {} # inode -> FileLock
+        self.owned = {} # owner -> {inode: mode}
+
+    def acquire(self, owner, inode, mode):
+        """Takes the lock on the file, returns False if another owner holds a conflicting one."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self._entry(inode, now)
+            if entry is None:
+                entry = FileLock(mode)
+                self.locks[inode] = entry
+            elif mode == EXCLUSIVE or entry.mode == EXCLUSIVE:
+                if len(entry.holders) != 1 or owner not in entry.holders:
+                    return False
+                entry.mode = EXCLUSIVE
+            entry.holders[owner] = entry.holders.get(owner, 0) + 1
+            entry.expires = max(entry.expires, now + self.lease)
+            self.owned.setdefault(owner, {})[inode] = entry.mode
+            return True
+
+    def release(self, owner, inode):
+        with self.lock:
+            entry = self.locks.get(inode)
+            if entry is None or owner not in entry.holders:
+                return
+            entry.holders[owner] -= 1
+            if entry.holders[owner] == 0:
+                self._drop_holder(entry, owner, inode)
+
+    def release_all(self, owner):
+        """Drops every lock of the owner, returns the inodes and modes it held."""
+        with self.lock:
+            held = self.owned.pop(owner, {})
+            for inode in held:
+                entry = self.locks.get(inode)
+                if entry is not None:
+                    entry.holders.pop(owner, None)
+                    if not entry.holders:
+                        del self.locks[inode]
+            return list(held.items())
+
+    def renew(self, owner):
+        """Extends the leases of every lock the owner holds."""
+        expires = time.monotonic() + self.lease
+        with self.lock:
+            for inode in self.owned.get(owner, ()):
+                entry = self.locks.get(inode)
+                if entry is not None:
+                    entry.expires = max(entry.expires, expires)
+
+    def is_locked(self, inode):
+        with self.lock:
+            return self._entry(inode, time.monotonic()) is not None
+
+    def _entry(self, inode, now):
+        # a lock is only expired once every holder stopped renewing it
+        entry = self.locks.get(inode)
+        if entry is not None and entry.expires < now:
+            for owner in list(entry.holders):
+                self._drop_holder(entry, owner, inode)
+            return None
+        return entry
+
+    def _drop_holder(self, entry, owner, inode):
+        del entry.holders[owner]
+        owned = self.owned.get(owner)
+        if owned is not None:
+            owned.pop(inode, None)
+            if not owned:
+                del self.owned[owner]
+        if not entry.holders:
+            del self.locks[inode]
@@ -1,152 +1,280 @@
 import socket
 import threading
-import logging
 
 import config
+import aio_server
+import compression
+import connection_pool
+import dedup
+import erasure
+import garbage_collector
+import journal
+import lock_manager
+import placement
+import protocol
+import server_registry
 import uuid as uuid
-import random
 import os.path
+import warnings
 
 import sys
 import json
+import heapq
+import itertools
 import pickle
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 import threading
 
-class SynchronizedDict:
-    def __init__(self):
-        self._lock = threading.Lock()
-        self._dictionary = {}
-
-    def __getitem__(self, key):
-        return self._dictionary[key]
-
-    def __setitem__(self, key, value):
-        with self._lock:
-            self._dictionary[key] = value
+class Logger():
+    """Operation journal of the master, rolled over into numbered segments by snapshots.
+
+    `{log_file}` is the segment being written, `{log_file}.N` are older
+    segments and `{snapshot_file}.N` holds the namespace as of the end of
+    segment N. Startup loads the newest snapshot and replays only the segments
+    written after it. Segments are binary journals (journal.py); text logs of
+    older masters are still replayed and then kept as a segment.
+    """
+    def __init__(self, log_file, snapshot_file=config.MASTER_SNAPSHOT):
+        self.log_file = log_file
+        self.snapshot_file = snapshot_file
+        self.lock = threading.Lock()
+        self.log_bytes = 0 # bytes logged since the last snapshot
+        self.next_seq = 0
+        self.journal = None
+        self.namespace = Namespace()
+        self.root = self.namespace.root
+        self.deletes = garbage_collector.DeleteQueue()
+        self.skipped = 0 # records replay could not apply
+        self.restore(log_file)
+        self._open_log()
 
-    def __delitem__(self, key):
-        with self._lock:
-            del self._dictionary[key]
 
-    def __len__(self):
-        return len(self._dictionary)
+    def restore(self, log_file):
+        snapshot_seq = -1
+        snapshots = self._numbered(self.snapshot_file)
+        if snapshots:
+            snapshot_seq = max(snapshots)
+            with open(f'{self.snapshot_file}.{snapshot_seq}', 'rb') as f:
+                state = pickle.load(f)
+            self.namespace.load(state)
+            self.deletes.load(state.get('deletes', {}))
+
+        segments = self._numbered(log_file)
+        self.next_seq = max(segments + [snapshot_seq]) + 1
+        paths = [f'{log_file}.{seq}' for seq in sorted(segments) if seq > snapshot_seq]
+        for path in paths + [log_file]:
+            if os.path.exists(path):
+                self.log_bytes += os.path.getsize(path)
+                self._replay_file(path)
+
+        if self.skipped:
+            # a record that does not apply means the journal lost or reordered records, files may be missing
+            print(f'Replay skipped {self.skipped} records of {log_file}', file=sys.stderr)
+            if self.skipped > config.REPLAY_MAX_SKIPPED:
+                raise Exception(f'Replay skipped {self.skipped} records, more than REPLAY_MAX_SKIPPED ({config.REPLAY_MAX_SKIPPED})')
+
+        if os.path.exists(log_file) and not journal.is_journal(log_file):
+            # the journal is appended in the binary format, keep the text log as an older segment
+            os.replace(log_file, f'{log_file}.{self.next_seq}')
+            self.next_seq += 1
+
+    def _replay_file(self, path):
+        if journal.is_journal(path):
+            for command, args in journal.read(path):
+                self.replay(command, args)
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                command, args = self.parse(line)
+                self.replay(command, args)
+
+    def snapshot(self):
+        """Writes the namespace to a new snapshot and deletes the log segments it covers.
+
+        The log is rolled over and the process forked while the log and the
+        namespace are locked, so the child sees exactly the state described by
+        the finished segments. The child writes the snapshot while this process
+        keeps serving requests.
+        """
+        pid = None
+        with self.lock, self.namespace.lock:
+            seq = self._roll()
+            # copied before the fork, the GC thread may hold the queue's lock at that moment
+            deletes = self.deletes.dump()
+            if hasattr(os, 'fork'):
+                with warnings.catch_warnings():
+                    # the child only pickles the namespace and exits, it never touches another thread's lock
+                    warnings.simplefilter('ignore', DeprecationWarning)
+                    pid = os.fork()
+                if pid == 0:
+                    try:
+                        self._write_snapshot(seq, self._state(deletes))
+                    except BaseException as e:
+                        print(e)
+                        os._exit(1)
+                    os._exit(0)
+            else:
+                state = self._state(deletes)
 
-    def keys(self):
-        return list(self._dictionary.keys())
+        if pid is None:
+            self._write_snapshot(seq, state)
+        else:
+            _, status = os.waitpid(pid, 0)
+            if os.waitstatus_to_exitcode(status) != 0:
+                # keep the segments, the next snapshot covers them
+                raise Exception(f'Snapshot {seq} failed')
+
+        for old in self._numbered(self.snapshot_file):
+            if old < seq:
+                os.remove(f'{self.snapshot_file}.{old}')
+        for old in self._numbered(self.log_file):
+            if old <= seq:
+                os.remove(f'{self.log_file}.{old}')
+        return seq
+
+    def _state(self, deletes):
+        # runs in the forked child, which must not take any lock
+        state = self.namespace.dump()
+        state['deletes'] = deletes
+        return state
+
+    def _roll(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.journal.close()
+        if os.path.exists(self.log_file):
+            os.replace(self.log_file, f'{self.log_file}.{seq}')
+        self._open_log()
+        self.log_bytes = 0
+        return seq
+
+    def _open_log(self):
+        self.journal = journal.Journal(self.log_file)
+
+    def _write_snapshot(self, seq, state):
+        path = f'{self.snapshot_file}.{seq}'
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _numbered(self, prefix):
+        # sequence numbers of the files named prefix.N
+        directory, name = os.path.split(prefix)
+        seqs = []
+        for entry in os.listdir(directory or '.'):
+            if entry.startswith(name + '.') and entry[len(name) + 1:].isdigit():
+                seqs.append(int(entry[len(name) + 1:]))
+        return seqs
+
+    def parse(self, line):
+        # turns a line of the old text log back into the command and args it was logged with
+        line = line.split()
+        command = line[0]
+        if command == 'create':
+            # files logged before chunk sizes were stored per file use the old fixed size
+            chunk_size = int(line[3]) if len(line) > 3 else config.LEGACY_CHUNK_SIZE
+            return command, [line[1], line[2], chunk_size]
+        elif command == 'set_chunk_loc':
+            return command, [line[1], line[2], line[3], json.loads(''.join(line[4:]))]
+        elif command == 'allocate_chunks':
+            return command, [line[1], line[2], json.loads(''.join(line[3:]))]
+        elif command == 'commit_file':
+            return command, [line[1], line[2], int(line[3]) if len(line) > 3 else 0]
+        return command, line[1:]
+
+    def replay(self, command, args):
+        # the first segment after a snapshot may repeat changes the snapshot
+        # already holds, so replaying a record twice must be harmless
+        namespace = self.namespace
+        if command in ('create', 'create_dir', 'commit_delete') and namespace.lookup_dir(args[0]) is None:
+            # a record of a directory that was never logged can not be applied, restore counts it
+            print(f'Skipping {command} {args[1]}: directory {args[0]} does not exist', file=sys.stderr)
+            self.skipped += 1
+            return
 
-    def values(self):
-        return list(self._dictionary.values())
+        if command == 'create':
+            # files logged before codecs existed are stored uncompressed
+            codec = args[3] if len(args) > 3 else compression.NONE
+            policy = args[4] if len(args) > 4 else erasure.REPLICATED
+            file = namespace.add_file(namespace.lookup_dir(args[0]), args[1], args[2], codec, policy)
+            file.status = FileStatus.CREATING
 
-    def items(self):
-        return list(self._dictionary.items())
+        elif command == 'create_dir':
+            curr_dir = namespace.lookup_dir(args[0])
+            if args[1] not in curr_dir.subdirectories:
+                namespace.add_dir(curr_dir, args[1])
 
+        elif command == 'commit_delete':
+            curr_dir = namespace.lookup_dir(args[0])
+            if args[1] in curr_dir.files:
+                self.deletes.add(namespace.release_chunks(curr_dir.files[args[1]]))
+                namespace.remove_file(curr_dir, args[1])
 
+        elif command == 'gc_done':
+            self.deletes.done(args[0], args[1])
 
-class Logger():
-    def __init__(self, log_file):
-        logging.basicConfig(filename=log_file, format='%(message)s')
-        self.log = logging.getLogger('Master')
-        self.log.setLevel(logging.INFO)
-        self.root = Directory('/')
-        self.restore(log_file)
+        elif command == 'gc_enqueue':
+            self.deletes.add(args[0])
 
+        elif command == 'abort_file':
+            # args[0] is the path of the file itself
+            file = namespace.lookup_path(args[0])
+            if file is not None and file.status is not FileStatus.COMMITTED:
+                namespace.rename_file(file, '__aborted__' + args[2])
+                file.status = FileStatus.ABORTED
 
-    def restore(self, log_file):
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                while True:
-                    line = f.readline().strip()
-                    if len(line) == 0:
-                        break
-                    line = line.split()
-                    command = line[0]
-                    if command == 'create':
-                        directory, file_name = line[1], line[2]
-                        directory = [part for part in directory.split('/') if part]
-                        curr_dir = self.root
-                        for d in directory: 
-                            curr_dir = curr_dir.subdirectories[d]
-                        curr_dir.add_file(file_name)
-                        file = curr_dir.files[file_name]
-                        file.status = FileStatus.CREATING
-
-                    elif command == 'create_dir':
-                        dir_loc, new_dir = line[1], line[2]
-                        dir_loc = [part for part in dir_loc.split('/') if part]
-                        curr_dir = self.root
-                        for d in dir_loc:
-                            curr_dir = curr_dir.subdirectories[d]
-                        curr_dir.subdirectories[new_dir] = Directory(curr_dir.dfs_path + '/' + new_dir)
-
-                    elif command == 'set_chunk_loc':
-                        dfs_dir, dfs_name = line[1], line[2]
-                        directory = [part for part in dfs_dir.split('/') if part]
-                        curr_dir = self.root
-                        for d in directory: 
-                            curr_dir = curr_dir.subdirectories[d]
-                        chunk_id, chunk_locs = line[3], line[4]
-                        file = curr_dir.files[dfs_name]
+        else:
+            file = namespace.lookup_file(args[0], args[1])
+            if file is None:
+                return
+            if command == 'set_chunk_loc':
+                namespace.set_chunk_locs(file, args[2], args[3])
+            elif command == 'allocate_chunks':
+                chunks = file.chunks if file.appending is None else file.appending
+                for chunk_id, chunk_locs in args[2]:
+                    chunks[chunk_id] = chunk_locs
+            elif command == 'allocate_content':
+                for chunk_id, chunk_locs in args[2]:
+                    if dedup.is_content_id(chunk_id):
+                        namespace.share_chunk(file, chunk_id, chunk_locs)
+                    else:
                         file.chunks[chunk_id] = chunk_locs
-
-                    elif command == 'delete':
-                        directory, file_name = line[1], line[2]
-                        directory = [part for part in directory.split('/') if part]
-                        curr_dir = self.root
-                        for d in directory: 
-                            curr_dir = curr_dir.subdirectories[d]
-                        file = curr_dir.files[file_name]
-                        file.status = FileStatus.DELETED
-
-                    elif command == 'commit_file':
-                        directory, file_name = line[1], line[2]
-                        directory = [part for part in directory.split('/') if part]
-                        curr_dir = self.root
-                        for d in directory:
-                            curr_dir = curr_dir.subdirectories[d]
-                        file = curr_dir.files[file_name]
-                        file.status = FileStatus.COMMITTED
-
-                    elif command == 'commit_delete':
-                        directory, file_name = line[1], line[2]
-                        directory = [part for part in directory.split('/') if part]
-                        curr_dir = self.root
-                        for d in directory:
-                            curr_dir = curr_dir.subdirectories[d]
-                        curr_dir.files.pop(file_name)
-
-                    elif command == 'abort_file':
-                        directory, file_name, uid = line[1], line[2], line[3]
-                        directory = [part for part in directory.split('/') if part]
-                        directory = directory[:-1]
-                        curr_dir = self.root
-                        for d in directory:
-                            curr_dir = curr_dir.subdirectories[d]
-                        file = curr_dir.files[file_name]
-                        curr_dir.files.pop(file_name)
-                        file.name = '__aborted__' + uid
-                        file.status = FileStatus.ABORTED
-                        curr_dir.replace_file(file)
+            elif command == 'delete':
+                file.status = FileStatus.DELETED
+            elif command == 'commit_file':
+                file.status = FileStatus.COMMITTED
+                file.size = args[2]
+            elif command == 'append_file':
+                if file.appending is None:
+                    file.appending = {}
+                    file.append_tail = args[2]
+            elif command == 'commit_append':
+                self.deletes.add(namespace.commit_append(file, args[2]))
+            elif command == 'abort_append':
+                self.deletes.add(namespace.abort_append(file))
+            elif command == 'record_chunk':
+                file.chunks[args[2]] = args[3]
+                file.open_chunk = args[2]
+                file.size = args[4]
 
 
     def log_info(self, command, args):
-        if command == 'create':
-            self.log.info(f'create {args[0]} {args[1]}')
-        elif command == 'create_dir':
-            self.log.info(f'create_dir {args[0]} {args[1]}')
-        elif command == 'set_chunk_loc':
-            self.log.info(f'set_chunk_loc {args[0]} {args[1]} {args[2]} {args[3]}')
-        elif command == 'delete':
-            self.log.info(f'delete {args[0]} {args[1]}')
-        elif command == 'commit_file':
-            self.log.info(f'commit_file {args[0]} {args[1]}')
-        elif command == 'commit_delete':
-            self.log.info(f'commit_delete {args[0]} {args[1]}')
-        elif command == 'abort_file':
-            self.log.info(f'abort_file {args[0]} {args[1]} {args[2]}')
+        """Journals a change, returns once it is on disk."""
+        with self.lock:
+            current = self.journal
+            ticket, size = current.write(command, args)
+            self.log_bytes += size
+        # handlers waiting here share one fdatasync
+        current.wait(ticket)
 
 
 class FileStatus():
@@ -162,25 +290,562 @@ class Directory():
         self.files = {}
         self.subdirectories = {}
 
-    def add_file(self, name: str):
+    def add_file(self, name: str, chunk_size: int = config.CHUNK_SIZE, codec: str = compression.NONE,
+                 policy: str = erasure.REPLICATED):
         path = self.dfs_path + name
-        self.files[name] = File(name, path)
+        self.files[name] = File(name, path, chunk_size, codec, policy)
 
     def replace_file(self, file):
         self.files[file.name] = file
 
+unpack_lock = threading.Lock()
+
+def pack_chunks(chunks):
+    """Packs a chunk map into two flat values, chunk ids never contain whitespace."""
+    ids = '\n'.join(chunks.keys())
+    locs = bytearray()
+    for chunk_locs in chunks.values():
+        locs.append(len(chunk_locs))
+        locs.extend(chunk_locs)
+    return ids, bytes(locs)
+
+def unpack_chunks(packed):
+    ids, locs = packed
+    chunks = {}
+    if not ids:
+        return chunks
+    pos = 0
+    for chunk_id in ids.split('\n'):
+        count = locs[pos]
+        chunks[chunk_id] = list(locs[pos + 1:pos + 1 + count])
+        pos += 1 + count
+    return chunks
+
+
 class File():
-    def __init__(self, name, dfs_path: str):
+    def __init__(self, name, dfs_path: str, chunk_size: int = config.CHUNK_SIZE, codec: str = compression.NONE,
+                 policy: str = erasure.REPLICATED):
         self.name = name
         self.dfs_path = dfs_path
         self.size = 0
-        self.chunks = {}
+        self.chunk_size = chunk_size
+        self.codec = codec # compression of the chunks, see compression.py
+        self.policy = policy # replicated, or erasure coded in stripes of shards, see erasure.py
+        self._chunks = {}
+        self._packed = None
         self.status = None
         self.is_locked = False
+        self.appending = None # chunks written by an append in progress, not part of the file before commit_append
+        self.append_tail = [] # chunk ids of the partial last chunk or stripe the append writes again
+        self.open_chunk = None # chunk record appends go to, see record_chunk
+
+    @property
+    def chunks(self):
+        # snapshots load the chunk map packed, it is unpacked on first use
+        if self._packed is not None:
+            with unpack_lock:
+                if self._packed is not None:
+                    self._chunks = unpack_chunks(self._packed)
+                    self._packed = None
+        return self._chunks
+
+    @chunks.setter
+    def chunks(self, chunks):
+        self._chunks = chunks
+        self._packed = None
+
+    def packed_chunks(self):
+        if self._packed is not None:
+            return self._packed
+        return pack_chunks(self._chunks)
+
+    def has_chunk(self, chunk_id):
+        # a packed map is only unpacked when it may hold the chunk
+        packed = self._packed
+        if packed is not None and chunk_id not in packed[0]:
+            return False
+        return chunk_id in self.chunks
+
+    def chunk_locs(self, chunk_id):
+        if self.appending is not None and chunk_id in self.appending:
+            return self.appending[chunk_id]
+        return self.chunks.get(chunk_id)
+
+    def set_locs(self, chunk_id, chunk_locs):
+        if self.appending is not None and chunk_id in self.appending:
+            self.appending[chunk_id] = chunk_locs
+        else:
+            self.chunks[chunk_id] = chunk_locs
+
     def __repr__(self):
-        return f"Path: {self.dfs_path}, Size: {self.size}, Status: {self.status}" 
-    
-chunk_server_lock = threading.Lock()
+        return f"Path: {self.dfs_path}, Size: {self.size}, Chunk Size: {self.chunk_size}, Codec: {self.codec}, Policy: {self.policy}, Status: {self.status}" 
+
+
+class Namespace():
+    """Path index kept in sync with the Directory tree.
+
+    Every directory and file is found by its full path with one dict probe,
+    and carries a stable inode id and a link to its parent directory. All
+    changes to the tree go through this class so the tree and the index never
+    disagree; the live handlers and log replay share the same instance.
+
+    Content-addressed chunks (dedup.py) may be referenced by many files.
+    `shared` maps each of them to the files referencing it, which doubles as
+    its reference count; its locations are changed in all of those files at
+    once, and it is only released for deletion with its last file.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.next_inode = 0
+        self.inodes = {}
+        self.dirs = {} # normalized path -> Directory
+        self.files = {} # full path -> File
+        self.shared = {} # content-addressed chunk id -> files referencing it
+        self.root = Directory('/')
+        self._register(self.root, None)
+        self.dirs['/'] = self.root
+
+    @staticmethod
+    def normalize(path):
+        return '/' + '/'.join(part for part in path.split('/') if part)
+
+    def lookup_dir(self, path):
+        directory = self.dirs.get(path)
+        if directory is None:
+            directory = self.dirs.get(self.normalize(path))
+        return directory
+
+    def lookup_file(self, dir_path, name):
+        directory = self.lookup_dir(dir_path)
+        if directory is None:
+            return None
+        return directory.files.get(name)
+
+    def lookup_path(self, path):
+        file = self.files.get(path)
+        if file is None:
+            file = self.files.get(self.normalize(path))
+        return file
+
+    def find_chunk(self, chunk_id):
+        """Returns a file holding the chunk, None if no file does. Looks at every file unless the chunk is shared."""
+        files = self.shared.get(chunk_id)
+        if files:
+            return next(iter(files))
+        for file in list(self.files.values()):
+            if file.has_chunk(chunk_id):
+                return file
+        return None
+
+    def share_chunk(self, file, chunk_id, chunk_locs):
+        """Adds the file's reference to a content-addressed chunk.
+
+        Returns the locations of the chunk, which are `chunk_locs` unless
+        other files reference it already, and those other files.
+        """
+        with self.lock:
+            files = self.shared.setdefault(chunk_id, set())
+            others = [other for other in files if other is not file]
+            if others:
+                chunk_locs = list(others[0].chunks[chunk_id])
+            files.add(file)
+            file.chunks[chunk_id] = chunk_locs
+            return chunk_locs, others
+
+    def set_chunk_locs(self, file, chunk_id, chunk_locs):
+        """Sets the locations of a chunk of the file, in every file referencing it."""
+        with self.lock:
+            for holder in self.shared.get(chunk_id) or [file]:
+                holder.set_locs(chunk_id, list(chunk_locs))
+
+    def release_chunks(self, file, chunk_ids=None):
+        """Drops the references of a file going away, or of the given chunks of it, returns the (chunk_id, chunk_locs) pairs no other file references."""
+        with self.lock:
+            released = []
+            chunks = file.chunks if chunk_ids is None else {chunk_id: file.chunks[chunk_id] for chunk_id in chunk_ids}
+            for chunk_id, chunk_locs in chunks.items():
+                files = self.shared.get(chunk_id)
+                if files is not None:
+                    files.discard(file)
+                    if files:
+                        continue
+                    del self.shared[chunk_id]
+                released.append((chunk_id, chunk_locs))
+            return released
+
+    def commit_append(self, file, size):
+        """Puts the chunks of a finished append in place of the tail it wrote again, returns the released tail chunks."""
+        with self.lock:
+            if file.appending is None:
+                return []
+            tail = [chunk_id for chunk_id in file.append_tail if chunk_id in file.chunks]
+            released = self.release_chunks(file, tail)
+            for chunk_id in tail:
+                del file.chunks[chunk_id]
+            file.chunks.update(file.appending)
+            file.size = size
+            file.appending = None
+            file.append_tail = []
+            return released
+
+    def abort_append(self, file):
+        """Drops an append in progress, returns the chunks it wrote."""
+        with self.lock:
+            if file.appending is None:
+                return []
+            written = list(file.appending.items())
+            file.appending = None
+            file.append_tail = []
+            return written
+
+    def add_dir(self, parent, name):
+        with self.lock:
+            directory = Directory(parent.dfs_path + name + '/')
+            self._register(directory, parent)
+            parent.subdirectories[name] = directory
+            self.dirs[self.normalize(directory.dfs_path)] = directory
+            return directory
+
+    def add_file(self, parent, name, chunk_size=config.CHUNK_SIZE, codec=compression.NONE, policy=erasure.REPLICATED):
+        with self.lock:
+            parent.add_file(name, chunk_size, codec, policy)
+            file = parent.files[name]
+            self._register(file, parent)
+            self.files[file.dfs_path] = file
+            return file
+
+    def remove_file(self, parent, name):
+        with self.lock:
+            file = parent.files.pop(name)
+            self.files.pop(file.dfs_path, None)
+            self.inodes.pop(file.inode, None)
+            return file
+
+    def rename_file(self, file, new_name):
+        with self.lock:
+            parent = file.parent
+            parent.files.pop(file.name)
+            self.files.pop(file.dfs_path, None)
+            file.name = new_name
+            file.dfs_path = parent.dfs_path + new_name
+            parent.replace_file(file)
+            self.files[file.dfs_path] = file
+
+    def dump(self):
+        """Returns the namespace as plain tuples for a snapshot, parents before children."""
+        dirs = []
+        files = []
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            dirs.append((directory.dfs_path, directory.inode))
+            for file in directory.files.values():
+                appending = None if file.appending is None else pack_chunks(file.appending)
+                files.append((directory.dfs_path, file.name, file.inode, file.chunk_size, file.size, file.status, file.packed_chunks(),
+                              file.codec, file.policy, file.open_chunk, appending, file.append_tail))
+            stack.extend(directory.subdirectories.values())
+        return {'next_inode': self.next_inode, 'dirs': dirs, 'files': files}
+
+    def load(self, state):
+        with self.lock:
+            for dfs_path, inode in state['dirs']:
+                if dfs_path == '/':
+                    self.inodes.pop(self.root.inode)
+                    self._register(self.root, None, inode)
+                    continue
+                parent_path, name = self.normalize(dfs_path).rsplit('/', 1)
+                parent = self.dirs[parent_path or '/']
+                directory = Directory(dfs_path)
+                parent.subdirectories[name] = directory
+                self._register(directory, parent, inode)
+                self.dirs[self.normalize(dfs_path)] = directory
+
+            for dir_path, name, inode, chunk_size, size, status, packed, *extra in state['files']:
+                # snapshots taken before codecs and policies existed have no such fields
+                codec = extra[0] if len(extra) > 0 else compression.NONE
+                policy = extra[1] if len(extra) > 1 else erasure.REPLICATED
+                parent = self.dirs[self.normalize(dir_path)]
+                file = File(name, dir_path + name, chunk_size, codec, policy)
+                file.size = size
+                file.status = status
+                file._packed = packed
+                file.open_chunk = extra[2] if len(extra) > 2 else None
+                if len(extra) > 3 and extra[3] is not None:
+                    file.appending = unpack_chunks(extra[3])
+                    file.append_tail = extra[4]
+                parent.replace_file(file)
+                self._register(file, parent, inode)
+                self.files[file.dfs_path] = file
+                if dedup.PREFIX in packed[0]:
+                    # reference counts are not stored, every file's chunk ids give them back
+                    for chunk_id in packed[0].split('\n'):
+                        if dedup.is_content_id(chunk_id):
+                            self.shared.setdefault(chunk_id, set()).add(file)
+            self.next_inode = state['next_inode']
+
+    def _register(self, node, parent, inode=None):
+        if inode is None:
+            inode = self.next_inode
+            self.next_inode += 1
+        node.inode = inode
+        node.parent = parent
+        self.inodes[inode] = node
+
+
+class ReplicationScheduler():
+    """Restores the replication factor of chunks that lost replicas.
+
+    Chunks are queued by how many live replicas they have left, fewest first.
+    A chunk is copied by asking one of its live replicas to send it to a live
+    server that does not hold it (replicate_chunk), with at most
+    `max_per_server` copies in flight per chunk server, as source or target.
+    Replicas on dead servers are then dropped from the chunk map and queued
+    for garbage collection, which deletes them if their server comes back.
+
+    Shards of erasure coded files have a single replica. A lost shard is
+    rebuilt by the master, which reads k other shards of its stripe, decodes
+    the missing one and writes it to a live server holding no shard of the
+    stripe; stripes are queued by how many more shards they can lose.
+
+    The chunks of a file are checked when it is committed; all chunks are
+    scanned when a chunk server goes down and every REPLICATION_SCAN_INTERVAL.
+    A replica a chunk server reports as corrupted is dropped and its chunk
+    checked at once. The chunk a file takes record appends on is left alone
+    until it is sealed.
+    """
+    def __init__(self, namespace, registry, placement, logger, deletes, max_per_server=config.REPLICATION_MAX_PER_SERVER,
+                 interval=config.REPLICATION_INTERVAL):
+        self.namespace = namespace
+        self.registry = registry
+        self.placement = placement
+        self.logger = logger
+        self.deletes = deletes
+        self.max_per_server = max_per_server
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queue = [] # heap of (live replicas, or shards past k plus one, seq, chunk_id, file)
+        self.queued = set()
+        self.seq = 0
+        self.inflight = {} # chunk_loc -> copies in flight from or to the server
+        self.alive = set()
+        self.last_scan = 0
+        self.pool = connection_pool.ConnectionPool('master', timeout=config.REPLICATION_TIMEOUT)
+        self.workers = ThreadPoolExecutor(max_workers=max_per_server * config.NUM_CHUNKS)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            alive = set(self.registry.alive())
+            lost = self.alive - alive
+            self.alive = alive
+            if lost or time.monotonic() - self.last_scan > config.REPLICATION_SCAN_INTERVAL:
+                self.scan(alive)
+            self.dispatch(alive)
+
+    def check_file(self, file):
+        alive = set(self.registry.alive())
+        for chunk_id, chunk_locs in list(file.chunks.items()):
+            self._check(file, chunk_id, chunk_locs, alive)
+
+    def scan(self, alive):
+        self.last_scan = time.monotonic()
+        for file in list(self.namespace.files.values()):
+            if file.status == FileStatus.COMMITTED:
+                for chunk_id, chunk_locs in list(file.chunks.items()):
+                    self._check(file, chunk_id, chunk_locs, alive)
+
+    def dispatch(self, alive):
+        deferred = []
+        with self.lock:
+            while self.queue:
+                entry = heapq.heappop(self.queue)
+                _, _, chunk_id, file = entry
+                chunk_locs = file.chunks.get(chunk_id) or []
+                live_locs = [loc for loc in chunk_locs if loc in alive]
+                if file.policy != erasure.REPLICATED:
+                    if not self._dispatch_rebuild(entry, file, chunk_id, live_locs, alive):
+                        deferred.append(entry)
+                    continue
+                if file.status != FileStatus.COMMITTED or not live_locs or len(live_locs) >= config.REPLICATION_FACTOR:
+                    self.queued.discard(chunk_id)
+                    continue
+                sources = [loc for loc in live_locs if self.inflight.get(loc, 0) < self.max_per_server]
+                # a server still due to delete an old replica of the chunk would delete the copy too
+                deleting = self.deletes.holders(chunk_id)
+                targets = [loc for loc in alive if loc not in chunk_locs and loc not in deleting
+                           and self.inflight.get(loc, 0) < self.max_per_server]
+                if not sources or not targets:
+                    deferred.append(entry)
+                    continue
+                source = min(sources, key=lambda loc: self.inflight.get(loc, 0))
+                target = self.placement.choose(1, targets, live_locs)
+                if not target:
+                    deferred.append(entry)
+                    continue
+                target = target[0]
+                self.inflight[source] = self.inflight.get(source, 0) + 1
+                self.inflight[target] = self.inflight.get(target, 0) + 1
+                self.workers.submit(self._copy, file, chunk_id, source, target)
+            for entry in deferred:
+                heapq.heappush(self.queue, entry)
+
+    def _dispatch_rebuild(self, entry, file, chunk_id, live_locs, alive):
+        # returns False to try the shard again in a later round
+        if file.status != FileStatus.COMMITTED or live_locs:
+            self.queued.discard(chunk_id)
+            return True
+        k, _ = erasure.parse_policy(file.policy)
+        shards = self._stripe(file, chunk_id)
+        sources = {idx: (shard, locs[0]) for idx, (shard, locs) in shards.items() if shard != chunk_id and locs and locs[0] in alive}
+        if len(sources) < k:
+            # the stripe is lost until enough of its servers come back
+            self.queued.discard(chunk_id)
+            return True
+        holders = {loc for _, locs in shards.values() for loc in locs}
+        targets = [loc for loc in alive if loc not in holders and self.inflight.get(loc, 0) < self.max_per_server]
+        target = self.placement.choose(1, targets, [loc for _, loc in sources.values()])
+        if not target:
+            return False
+        target = target[0]
+        self.inflight[target] = self.inflight.get(target, 0) + 1
+        self.workers.submit(self._rebuild, file, chunk_id, sources, target)
+        return True
+
+    def _stripe(self, file, chunk_id):
+        # shard index -> (shard chunk id, chunk_locs) for every shard of the chunk's stripe
+        stripe_id, _ = erasure.split_shard_id(chunk_id)
+        shards = {}
+        for idx in range(sum(erasure.parse_policy(file.policy))):
+            shard = erasure.shard_id(stripe_id, idx)
+            shards[idx] = (shard, file.chunks.get(shard) or [])
+        return shards
+
+    def _check(self, file, chunk_id, chunk_locs, alive):
+        if chunk_id == file.open_chunk:
+            # a copy would miss the records appended after it, the chunk is copied once sealed
+            return
+        live = sum(1 for loc in chunk_locs if loc in alive)
+        if file.policy != erasure.REPLICATED:
+            if live:
+                return
+            k, _ = erasure.parse_policy(file.policy)
+            live_shards = sum(1 for _, locs in self._stripe(file, chunk_id).values() if any(loc in alive for loc in locs))
+            # stripes with fewer than k shards can not be rebuilt until a holder comes back
+            if live_shards < k:
+                return
+            live = live_shards - k + 1
+        # chunks without a live replica can not be copied until a holder comes back
+        elif live == 0 or live >= config.REPLICATION_FACTOR or live >= len(alive):
+            return
+        with self.lock:
+            if chunk_id in self.queued:
+                return
+            self.queued.add(chunk_id)
+            heapq.heappush(self.queue, (live, self.seq, chunk_id, file))
+            self.seq += 1
+
+    def _copy(self, file, chunk_id, source, target):
+        try:
+            with self.pool.connection(source) as sock:
+                request = protocol.request('master', 'replicate_chunk', [{'chunk_id': chunk_id, 'new_chunk_loc': target}])
+                sock.sendall(request)
+                response = protocol.recv_frame(sock).body
+            # replicate_chunk answers 1 once the target stored the copy
+            copied = response.get('status') == 1
+        except Exception as e:
+            print(e)
+            copied = False
+        with self.lock:
+            self.inflight[source] -= 1
+            self.inflight[target] -= 1
+            self.queued.discard(chunk_id)
+        if not copied:
+            print(f"Copying chunk {chunk_id} from chunk server {source} to {target} failed")
+            return
+
+        alive = set(self.registry.alive())
+        chunk_locs = file.chunks.get(chunk_id)
+        if chunk_locs is None or self.namespace.lookup_path(file.dfs_path) is not file:
+            # the file was deleted during the copy, a shared chunk may still have other files
+            file = self.namespace.find_chunk(chunk_id) if dedup.is_content_id(chunk_id) else None
+            if file is None:
+                self._collect(chunk_id, [target])
+                return
+            chunk_locs = file.chunks[chunk_id]
+        new_locs = [loc for loc in chunk_locs if loc in alive] + [target]
+        lost = [loc for loc in chunk_locs if loc not in alive]
+        self.namespace.set_chunk_locs(file, chunk_id, new_locs)
+        self.logger.log_info('set_chunk_loc', [file.parent.dfs_path, file.name, chunk_id, new_locs])
+        if lost:
+            self._collect(chunk_id, lost)
+        self._check(file, chunk_id, new_locs, alive)
+
+    def _rebuild(self, file, chunk_id, sources, target):
+        code = erasure.code(file.policy)
+        _, idx = erasure.split_shard_id(chunk_id)
+        try:
+            shards = {}
+            for pos, (shard, chunk_loc) in sources.items():
+                if len(shards) == code.k:
+                    break
+                try:
+                    shards[pos] = self._read_shard(chunk_loc, shard)
+                except Exception as e:
+                    print(f"Reading shard {shard} from chunk server {chunk_loc} failed: {e}")
+            data = code.rebuild(shards, idx)
+            with self.pool.connection(target) as sock:
+                sock.sendall(protocol.request('master', 'write_chunk', [chunk_id], len(data)))
+                sock.sendall(data)
+                response = protocol.recv_frame(sock).body
+            rebuilt = response.get('status') == 0
+        except Exception as e:
+            print(e)
+            rebuilt = False
+        with self.lock:
+            self.inflight[target] -= 1
+            self.queued.discard(chunk_id)
+        if not rebuilt:
+            print(f"Rebuilding shard {chunk_id} on chunk server {target} failed")
+            return
+
+        chunk_locs = file.chunks.get(chunk_id)
+        if chunk_locs is None or self.namespace.lookup_path(file.dfs_path) is not file:
+            # the file was deleted during the rebuild
+            self._collect(chunk_id, [target])
+            return
+        file.chunks[chunk_id] = [target]
+        self.logger.log_info('set_chunk_loc', [file.parent.dfs_path, file.name, chunk_id, [target]])
+        if chunk_locs:
+            self._collect(chunk_id, chunk_locs)
+        print(f"Rebuilt shard {chunk_id} on chunk server {target}")
+
+    def _read_shard(self, chunk_loc, chunk_id):
+        with self.pool.connection(chunk_loc) as sock:
+            sock.sendall(protocol.request('master', 'read_chunk', [chunk_id]))
+            frame = protocol.recv_frame(sock)
+            data = protocol.recv_payload(sock, frame.payload_len)
+        if frame.body['status'] != 0:
+            raise Exception(frame.body.get('message', 'read_chunk failed'))
+        return data
+
+    def drop_replica(self, chunk_id, chunk_loc):
+        # a replica that failed its checksums is gone, copy the chunk again from a good one
+        file = self.namespace.find_chunk(chunk_id)
+        if file is None:
+            return
+        chunk_locs = file.chunks.get(chunk_id)
+        if chunk_locs is None or chunk_loc not in chunk_locs:
+            return
+        new_locs = [loc for loc in chunk_locs if loc != chunk_loc]
+        self.namespace.set_chunk_locs(file, chunk_id, new_locs)
+        self.logger.log_info('set_chunk_loc', [file.parent.dfs_path, file.name, chunk_id, new_locs])
+        print(f"Dropped corrupted replica of chunk {chunk_id} on chunk server {chunk_loc}")
+        self._check(file, chunk_id, new_locs, set(self.registry.alive()))
+
+    def _collect(self, chunk_id, chunk_locs):
+        self.deletes.add([(chunk_id, chunk_locs)])
+        self.logger.log_info('gc_enqueue', [[[chunk_id, chunk_locs]]])
+
 
 class MasterServer():
     def __init__(self, host, port):
@@ -191,194 +856,231 @@ class MasterServer():
         self.sock.bind((self.host, self.port))
         self.NUM_CHUNKS = config.NUM_CHUNKS
         self.logger = Logger(config.MASTER_LOG)
-        self.root = self.logger.root
+        self.namespace = self.logger.namespace
+        self.root = self.namespace.root
         self.lock_map = {} # maps key: ip+port as string to file object
         self.system_locked = False
-        self.dead_servers = []
-        heart_beat_thread = threading.Thread(target=self.heart_beat_handler)
-        heart_beat_thread.start()	
+        self.registry = server_registry.ServerRegistry()
+        self.pool = connection_pool.ConnectionPool('master', timeout=config.HEART_BEAT_TIMEOUT)
+        self.deletes = self.logger.deletes
+        self.locks = lock_manager.LockManager()
+        for file in list(self.namespace.files.values()):
+            if file.appending is not None:
+                # the client appending to it was connected to the old master
+                self._abort_append(file)
+        self.record_locks = [threading.Lock() for _ in range(config.RECORD_LOCKS)]
+        self.record_opening = {} # inode -> set once the producer opening the file's next chunk is done
+        self.collector = garbage_collector.GarbageCollector(self.deletes, self.pool, self.logger, self.registry)
+        self.placement = placement.PlacementEngine(self.registry)
+        self.replication = ReplicationScheduler(self.namespace, self.registry, self.placement, self.logger, self.deletes)
         chunk_audit_thread = threading.Thread(target=self.chunk_audit)
         chunk_audit_thread.start()
+        snapshot_thread = threading.Thread(target=self.snapshot_handler)
+        snapshot_thread.start()
+        collector_thread = threading.Thread(target=self.collector.run)
+        collector_thread.start()
+        replication_thread = threading.Thread(target=self.replication.run)
+        replication_thread.start()
 
         # prune_chunk_thread = threading.Thread(target=self.prune_chunk_handler)
         # prune_chunk_thread.start()
 
-        self.client_to_file_lock = SynchronizedDict()
-
         
     def is_alive(self, client):
-        client.send(self.__respond_status(0, 'Alive'))
+        client.sendall(self.__respond_status(0, 'Alive'))
 
     def listen(self):
-        self.sock.listen()
+        self.sock.listen(config.LISTEN_BACKLOG)
         while True:
             client, address = self.sock.accept()
             handler = threading.Thread(target=self.service, args=(client, address))
             handler.start()
 
+    def listen_async(self):
+        # every connection is served from one event loop instead of a thread per client
+        self.sock.listen(config.LISTEN_BACKLOG)
+        aio_server.AsyncServer(self.sock, self.accept, self.serve_request).serve_forever()
+
     def service(self, client, address):
+        if not self.accept(client, address):
+            return
+        while self.serve_request(client, address):
+            pass
+
+    def accept(self, client, address):
         ip, port = address
-        connected = True
-        while connected:
-            try:
-                message = client.recv(config.MESSAGE_SIZE)
-                if message == b'':
-                    raise socket.error
-                if message:
-                    message = json.loads(message.decode('utf-8'))
-                    sender_type = message['sender_type']
-                    command = message['function']
-                    args = message['args']
-
-                if sender_type == 'client':
-                    if command == 'create_file':
-                        self.create_file(client, args)
-                    elif command == 'set_chunk_loc':
-                        self.set_chunk_loc(client, args)
-                    elif command == 'commit_file':
-                        self.commit_file(client, args)
-                    elif command == 'create_dir':
-                        self.create_dir(client, args)
-                    elif command == 'read_file':
-                        self.read_file(client, args)
-                    elif command == 'list_files':
-                        self.list_files(client, args)
-                    elif command == 'delete_file':
-                        self.delete_file(client, args)
-                    elif command == 'commit_delete':
-                        self.commit_delete(client, args)
-                    elif command == "file_failed":
-                        self.file_failed(client, args)
-                    elif command == 'close':
-                        self.close_connection(client)
-                        connected = False
-                        print(f"Client with IP {ip} and Port {port} disconnected.")
-                        
-            except socket.error:
-                print(f"Client with IP {ip} and Port {port} unexpectedly disconnected.")
-                self.handle_client_disconnect(ip, port)
-                client.close()
-                connected = False 
+        try:
+            protocol.accept(client)
+        except socket.error as e:
+            print(f"Client with IP {ip} and Port {port} rejected: {e}")
+            client.close()
+            return False
+        return True
+
+    def serve_request(self, client, address):
+        # handles one request, returns False once the connection is closed
+        ip, port = address
+        try:
+            message = protocol.recv_frame(client).body
+            sender_type = message['sender_type']
+            command = message['function']
+            args = message['args']
+
+            if sender_type == 'client':
+                # every request keeps the leases of the client's locks alive
+                self.locks.renew(self._owner(address))
+                if command == 'create_file':
+                    self.create_file(client, args)
+                elif command == 'set_chunk_loc':
+                    self.set_chunk_loc(client, args)
+                elif command == 'allocate_chunks':
+                    self.allocate_chunks(client, args)
+                elif command == 'allocate_content':
+                    self.allocate_content(client, args)
+                elif command == 'commit_file':
+                    self.commit_file(client, args)
+                elif command == 'create_dir':
+                    self.create_dir(client, args)
+                elif command == 'read_file':
+                    self.read_file(client, args)
+                elif command == 'release_read':
+                    self.release_read(client, args)
+                elif command == 'renew_lease':
+                    # sent by clients busy reading, the leases were renewed above
+                    pass
+                elif command == 'list_files':
+                    self.list_files(client, args)
+                elif command == 'delete_file':
+                    self.delete_file(client, args)
+                elif command == 'commit_delete':
+                    self.commit_delete(client, args)
+                elif command == "file_failed":
+                    self.file_failed(client, args)
+                elif command == 'replica_failed':
+                    self.replica_failed(client, args)
+                elif command == 'append_file':
+                    self.append_file(client, args)
+                elif command == 'commit_append':
+                    self.commit_append(client, args)
+                elif command == 'abort_append':
+                    self.abort_append(client, args)
+                elif command == 'record_chunk':
+                    self.record_chunk(client, args)
+                elif command == 'close':
+                    self.close_connection(client)
+                    print(f"Client with IP {ip} and Port {port} disconnected.")
+                    return False
+            elif sender_type == 'chunk_server':
+                if command == 'heartbeat':
+                    self.heartbeat(client, args)
+                    
+        except socket.error:
+            print(f"Client with IP {ip} and Port {port} unexpectedly disconnected.")
+            self.handle_client_disconnect(ip, port)
+            client.close()
+            return False
+        return True
 
 
 
     def handle_client_disconnect(self, ip, port):
-        lock_key = str(ip) + str(port)
-        if lock_key in self.client_to_file_lock.keys():
-            file = self.client_to_file_lock.__getitem__(lock_key)
-            directory = file.dfs_path
-            directory = [part for part in directory.split('/') if part]
-            directory = directory[:-1]
-            curr_dir = self.root
-
-            for d in directory:
-                if d not in curr_dir.subdirectories:
-                    return
-                curr_dir = curr_dir.subdirectories[d]
+        for inode, mode in self.locks.release_all(self._owner((ip, port))):
+            file = self.namespace.inodes.get(inode)
+            if file is None or self.namespace.lookup_path(file.dfs_path) is not file:
+                continue
 
-            curr_dir.files.pop(file.name)
             dir_name = file.dfs_path
             file_name = file.name
             if file.status is not  FileStatus.COMMITTED:
                 uid = str(uuid.uuid4())
-                file.name = '__aborted__' + uid
+                self.namespace.rename_file(file, '__aborted__' + uid)
                 file.status = FileStatus.ABORTED
                 self.logger.log_info('abort_file', [dir_name, file_name, uid])
-			
-    
-            self.client_to_file_lock.__delitem__(lock_key)
-            curr_dir.replace_file(file)
+            elif file.appending is not None:
+                self._abort_append(file)
 
     def file_failed(self, client, args):
         directory = args[0]
         file_name = args[1]
 
-        directory = [part for part in directory.split('/') if part]
-        curr_dir = self.root
-        
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(directory)
+        if curr_dir is None:
+            return
 
         if file_name in curr_dir.files:
             file = curr_dir.files[file_name]
             file.status = FileStatus.ABORTED
-            # will eventually be cleaned up
+            # unlocked, so prune cleans it up with its next round
+            self.locks.release(self._owner(client.getpeername()), file.inode)
         else:
             # if current client holds the lock delete it
-            ip, port = client.getpeername()
-            lock_key = str(ip) + str(port)
-            if lock_key in self.client_to_file_lock.keys():
-                self.client_to_file_lock.__delitem__(lock_key)
+            self.locks.release_all(self._owner(client.getpeername()))
             
+    def replica_failed(self, client, args):
+        directory = args[0]
+        file_name = args[1]
+        failed = args[2]
+
+        curr_dir = self.namespace.lookup_dir(directory)
+        if curr_dir is None:
+            return
+
+        if file_name not in curr_dir.files:
+            return
+        file = curr_dir.files[file_name]
+        for chunk_id, chunk_loc in failed:
+            chunk_locs = file.chunk_locs(chunk_id)
+            if chunk_locs is not None and chunk_loc in chunk_locs:
+                chunk_locs = [loc for loc in chunk_locs if loc != chunk_loc]
+                self.namespace.set_chunk_locs(file, chunk_id, chunk_locs)
+                self.logger.log_info('set_chunk_loc', [args[0], args[1], chunk_id, chunk_locs])
+            
+    def snapshot_handler(self):
+        while True:
+            time.sleep(config.SNAPSHOT_INTERVAL)
+            if self.logger.log_bytes < config.SNAPSHOT_LOG_BYTES:
+                continue
+            try:
+                self.logger.snapshot()
+            except Exception as e:
+                print(e)
+
     def chunk_audit(self):
         while True:
             time.sleep(config.PRUNING_INTERVAL)
-            with chunk_server_lock:
-                curr_dir = self.root
-                self.prune(curr_dir)
+            self.prune(self.root)
         
     def prune(self, dir : Directory):
+        # files left uncommitted by a client that is gone; their chunks go to the garbage collector
         to_pop = []
-        for file_name in list(dir.files.keys()):
-            if dir.files[file_name] not in self.client_to_file_lock.values():
-                if dir.files[file_name].status is not FileStatus.COMMITTED:
-                    success = True
-                    for chunk_id, chunk_locs in dir.files[file_name].chunks.items():
-                        for idx, loc in enumerate(config.CHUNK_PORTS):
-                            try:
-                                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                                sock.connect((self.host, config.CHUNK_PORTS[idx]))
-                                request = self.__respond_message("delete_chunk", [chunk_id])
-                                sock.send(request)
-                                response = sock.recv(config.MESSAGE_SIZE)
-                                response = json.loads(response.decode('utf-8'))
-                                if response['status'] == 0:
-                                    pass
-                            except Exception as e:
-                                print(e)
-                                success = False
-                    if success:
-                        to_pop.append(file_name)
-                        self.logger.log_info('commit_delete', [dir.dfs_path, file_name])
+        for file_name, file in list(dir.files.items()):
+            with self.namespace.lock:
+                abandoned = file.status is not FileStatus.COMMITTED and not self.locks.is_locked(file.inode)
+            if abandoned:
+                to_pop.append(file_name)
+            elif file.appending is not None and not self.locks.is_locked(file.inode):
+                # so are appends
+                self._abort_append(file)
         for file_name in to_pop:
-            dir.files.pop(file_name)
+            self.deletes.add(self.namespace.release_chunks(dir.files[file_name]))
+            self.namespace.remove_file(dir, file_name)
+            self.logger.log_info('commit_delete', [dir.dfs_path, file_name])
         if len(to_pop) > 0:
             print(f"{len(to_pop)} files pruned")
 
-        for sub_dir_name, sub_dir in dir.subdirectories.items():
+        for sub_dir in list(dir.subdirectories.values()):
             self.prune(sub_dir)
             
                 
             
-    def heart_beat_handler(self):
-        while True:
-            time.sleep(config.HEART_BEAT_INTERVAL)
-            with chunk_server_lock:
-                for idx, port in enumerate(config.CHUNK_PORTS):
-                    try:
-                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        sock.settimeout(config.HEART_BEAT_TIMEOUT)
-                        sock.connect((self.host, port))
-                        request = self.__respond_message("heartbeat", [])
-                        sock.send(request)
-                        response = sock.recv(config.MESSAGE_SIZE)
-                        response = json.loads(response.decode('utf-8'))
-                        if response['status'] == 0:
-                            if idx in self.dead_servers:
-                                self.dead_servers.remove(idx)
-                            pass
-                        else:
-                            raise Exception
-                    except socket.error as e:
-                        print(f"Chunk Server with IP {self.host} and Port {port} not responding.")
-                        self.dead_servers.append(idx)
-                        sock.close()
-                    except Exception as e:
-                        self.dead_servers.append(idx)
-                        print(f"Chunk Server with IP {self.host} and Port {port} not up.")
-                        sock.close()
+    def heartbeat(self, client, args):
+        # status report pushed by a chunk server
+        report = args[0]
+        if self.registry.report(report['index'], report):
+            print(f"Chunk server {report['index']} is up")
+        for chunk_id in report.get('corrupt', []):
+            self.replication.drop_replica(chunk_id, report['index'])
+        client.sendall(self.__respond_status(0, 'OK'))
 
 
     def read_file(self, client, args):
@@ -386,60 +1088,55 @@ class MasterServer():
         file_name = args[1]
 
 
-        directory = [part for part in directory.split('/') if part]
-        curr_dir = self.root
-
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(directory)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         if file_name not in curr_dir.files:
-            client.send(self.__respond_status(-1, 'File does not exist'))
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
         else:
             file = curr_dir.files[file_name]
             if file.status != FileStatus.COMMITTED:
-                client.send(self.__respond_status(-1, 'File not committed'))
+                client.sendall(self.__respond_status(-1, 'File not committed'))
                 return
-            ip, port = client.getpeername()
-            lock_key = str(ip) + str(port)
-            self.client_to_file_lock.__setitem__(lock_key, file)
-            print(f"locked file {lock_key}")
-            for id, loc in file.chunks.items():
-                response = {
-                    'status': 0,
-                    'chunk_id': id,
-                    'chunk_loc': loc
-                }
-                response = json.dumps(response).encode('utf-8')
-                response += b' ' * (config.MESSAGE_SIZE - len(response))
-                client.send(response)
-
-            client.send(self.__respond_status(1, 'Done'))
-            response = client.recv(config.MESSAGE_SIZE)
-            response = json.loads(response.decode('utf-8'))
-            if response['status'] == 0:
-                self.client_to_file_lock.__delitem__(lock_key)
-                print(f"unlocked file {lock_key}")
-            else:
-                print(response['message'])
-                self.client_to_file_lock.__delitem__(lock_key)
-                print(f"unlocked file {lock_key}")
+            owner = self._owner(client.getpeername())
+            if not self.locks.acquire(owner, file.inode, lock_manager.SHARED):
+                client.sendall(self.__respond_status(-1, 'File is locked by another client'))
+                return
+            print(f"locked file {owner}")
+            response = {
+                'status': 0,
+                'size': file.size,
+                'chunk_size': file.chunk_size,
+                'codec': file.codec,
+                'policy': file.policy,
+                'chunks': list(file.chunks.items()),
+                'lease': config.METADATA_LEASE # how long the client may read the file without asking again
+            }
+            # the lock is held until the client sends release_read, no handler waits for the download
+            client.sendall(protocol.response(response))
+
+    def release_read(self, client, args):
+        # args[2] and args[3] are the status and message of the finished read
+        file = self.namespace.lookup_file(args[0], args[1])
+        if args[2] != 0:
+            print(args[3])
+        if file is None:
+            return
+        owner = self._owner(client.getpeername())
+        self.locks.release(owner, file.inode)
+        print(f"unlocked file {owner}")
 
 
 
     def list_files(self, client, args):
         dfs_dir = args[0]
 
-        directory = [part for part in dfs_dir.split('/') if part]
-        curr_dir = self.root
-
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(dfs_dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         data = list(curr_dir.files.keys())
         data = [file for file in data if curr_dir.files[file].status == FileStatus.COMMITTED]
@@ -447,12 +1144,10 @@ class MasterServer():
         response = {
             'status': 0,
             'data': data,
-            'directories': directories
+            'directories': directories,
+            'lease': config.METADATA_LEASE
         }
-
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        client.send(response)
+        client.sendall(protocol.response(response))
 
 
 
@@ -460,93 +1155,90 @@ class MasterServer():
         directory = args[0]
         file_name = args[1]
 
-        directory = [part for part in directory.split('/') if part]
-        curr_dir = self.root
-
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(directory)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         if file_name not in curr_dir.files:
-            client.send(self.__respond_status(-1, 'File does not exist'))
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
         else:
             file = curr_dir.files[file_name]
             if file.status != FileStatus.COMMITTED:
-                client.send(self.__respond_status(-1, 'File not committed'))
+                client.sendall(self.__respond_status(-1, 'File not committed'))
                 print(file.status)
                 return
-            ip, port = client.getpeername()
-            lock_key = str(ip) + str(port)
+            owner = self._owner(client.getpeername())
+            if not self.locks.acquire(owner, file.inode, lock_manager.EXCLUSIVE):
+                client.sendall(self.__respond_status(-1, 'File is locked by another client'))
+                return
 
-
-            # check if any client is currently has locked the file 
-            for key in self.client_to_file_lock.keys():
-                if self.client_to_file_lock.__getitem__(key) == file:
-                    client.send(self.__respond_status(-1, 'File is locked by another client'))
-                    return
-                
-            self.client_to_file_lock.__setitem__(lock_key, file)
-            file.status = FileStatus.DELETED
-            for id, loc in file.chunks.items():
-                
-                response = {
-                    'status': 0,
-                    'chunk_id': id,
-                    'chunk_loc': loc
-                }
-                response = json.dumps(response).encode('utf-8')
-                response += b' ' * (config.MESSAGE_SIZE - len(response))
-                client.send(response)
-
-            self.logger.log_info('delete', [args[0], args[1]])
-            client.send(self.__respond_status(1, 'Done'))
+            # only the metadata goes now, the garbage collector deletes the chunks later
+            self.deletes.add(self.namespace.release_chunks(file))
+            self.namespace.remove_file(curr_dir, file_name)
+            self.logger.log_info('commit_delete', [args[0], args[1]])
+            self.locks.release(owner, file.inode)
+            response = {
+                'status': 0,
+                'message': 'File Deleted',
+                'chunks': [] # clients that still delete chunks themselves have nothing to do
+            }
+            client.sendall(protocol.response(response))
 
     def create_file(self, client, args):
         directory = args[0]
         file_name = args[1]
+        chunk_size = args[2] if len(args) > 2 else config.CHUNK_SIZE
+        codec = args[3] if len(args) > 3 else compression.NONE
+        policy = args[4] if len(args) > 4 else erasure.REPLICATED
         print('file name: ', file_name)
 
-        directory = [part for part in directory.split('/') if part]
-        curr_dir = self.root
-        
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        if not isinstance(chunk_size, int) or chunk_size <= 0 or chunk_size > config.MAX_CHUNK_SIZE:
+            client.sendall(self.__respond_status(-1, f'Chunk size must be between 1 and {config.MAX_CHUNK_SIZE} bytes'))
+            return
+        try:
+            compression.parse(codec)
+            counts = erasure.parse_policy(policy)
+        except Exception as e:
+            client.sendall(self.__respond_status(-1, str(e)))
+            return
+        if counts is not None and sum(counts) > self.NUM_CHUNKS:
+            # every shard of a stripe needs a chunk server of its own
+            client.sendall(self.__respond_status(-1, f'{policy} needs {sum(counts)} chunk servers, there are {self.NUM_CHUNKS}'))
+            return
+
+        curr_dir = self.namespace.lookup_dir(directory)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         if file_name in curr_dir.files:
             file = curr_dir.files[file_name]
             if file.status == FileStatus.COMMITTED:	
-                client.send(self.__respond_status(-1, 'File already exists'))
+                client.sendall(self.__respond_status(-1, 'File already exists'))
             else:
-                client.send(self.__respond_status(-1, 'File is being written by another user'))
+                client.sendall(self.__respond_status(-1, 'File is being written by another user'))
         else:
-            curr_dir.add_file(file_name)
-            file = curr_dir.files[file_name]
-            file.status = FileStatus.CREATING
             ip, port = client.getpeername()
+            with self.namespace.lock:
+                # prune drops uncommitted files nobody holds, it only looks at them under the same lock
+                file = self.namespace.add_file(curr_dir, file_name, chunk_size, codec, policy)
+                file.status = FileStatus.CREATING
+                self.locks.acquire(self._owner((ip, port)), file.inode, lock_manager.EXCLUSIVE)
             print(f"added file {file_name} from client {ip}:{port}")
-            self.logger.log_info('create', [args[0], args[1]])
-            client.send(self.__respond_status(0, 'File Created'))
-            lock_key = str(ip) + str(port)
-            self.client_to_file_lock.__setitem__(lock_key, file)
+            self.logger.log_info('create', [args[0], args[1], chunk_size, codec, policy])
+            client.sendall(self.__respond_status(0, 'File Created'))
 
     def set_chunk_loc(self, client, args):
         dfs_dir = args[0]
         dfs_name = args[1]
-        directory = [part for part in dfs_dir.split('/') if part]
-        curr_dir = self.root
-        for d in directory: 
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(dfs_dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         if dfs_name not in curr_dir.files:
-            client.send(self.__respond_status(-1, 'File does not exist'))
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
         chunk_id = self._create_chunk_id()
         chunk_locs = self._sample_chunk_locs()
 
@@ -559,103 +1251,363 @@ class MasterServer():
         }
 
         self.logger.log_info('set_chunk_loc', [args[0], args[1], chunk_id, chunk_locs])
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        client.send(response)
+        client.sendall(protocol.response(response))
+
+    def allocate_chunks(self, client, args):
+        dfs_dir = args[0]
+        dfs_name = args[1]
+        count = args[2]
+        curr_dir = self.namespace.lookup_dir(dfs_dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
+
+        if dfs_name not in curr_dir.files:
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
+            return
+
+        file = curr_dir.files[dfs_name]
+        counts = erasure.parse_policy(file.policy)
+        # chunks of an append stay apart until commit_append
+        file_chunks = file.chunks if file.appending is None else file.appending
+        chunks = []
+        for _ in range(count):
+            if counts is None:
+                chunk_locs = self._sample_chunk_locs()
+                if not chunk_locs:
+                    client.sendall(self.__respond_status(-1, 'No chunk servers with free disk space up'))
+                    return
+                chunks.append([self._create_chunk_id(), chunk_locs])
+                continue
+            # a stripe is k + m shards with one replica each, all on different chunk servers
+            chunk_locs = self.placement.choose(sum(counts))
+            if len(chunk_locs) < sum(counts):
+                client.sendall(self.__respond_status(-1, f'Not enough chunk servers up for {file.policy}'))
+                return
+            stripe_id = self._create_chunk_id()
+            chunks.extend([erasure.shard_id(stripe_id, idx), [chunk_loc]] for idx, chunk_loc in enumerate(chunk_locs))
+        for chunk_id, chunk_locs in chunks:
+            file_chunks[chunk_id] = chunk_locs
+
+        # one log record for the whole batch
+        self.logger.log_info('allocate_chunks', [args[0], args[1], chunks])
+        response = {
+            'status': 0,
+            'chunks': chunks
+        }
+        client.sendall(protocol.response(response))
+
+    def allocate_content(self, client, args):
+        # like allocate_chunks for the chunk ids the client derived from the chunk data (dedup.py)
+        dfs_dir = args[0]
+        dfs_name = args[1]
+        chunk_ids = args[2]
+        curr_dir = self.namespace.lookup_dir(dfs_dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
+
+        if dfs_name not in curr_dir.files:
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
+            return
+
+        file = curr_dir.files[dfs_name]
+        allocated = []
+        chunks = []
+        error = None
+        for chunk_id in chunk_ids:
+            if not dedup.is_content_id(chunk_id):
+                error = f'{chunk_id} is not a content-addressed chunk id'
+                break
+            if chunk_id in file.chunks:
+                # the chunk map holds a chunk once, a repeat within the file is stored as a chunk of its own
+                chunk_id = self._create_chunk_id()
+                chunk_locs = self._sample_chunk_locs()
+                if not chunk_locs:
+                    error = 'No chunk servers with free disk space up'
+                    break
+                file.chunks[chunk_id] = chunk_locs
+                stored = False
+            else:
+                chunk_locs = []
+                if chunk_id not in self.namespace.shared:
+                    # servers still due to delete an earlier copy of the same data get no new one
+                    deleting = self.deletes.holders(chunk_id)
+                    candidates = [loc for loc in self.registry.alive() if loc not in deleting]
+                    chunk_locs = self.placement.choose(config.REPLICATION_FACTOR, candidates)
+                    if not chunk_locs:
+                        error = 'No chunk servers with free disk space up'
+                        break
+                chunk_locs, others = self.namespace.share_chunk(file, chunk_id, chunk_locs)
+                # a chunk of a file still being written may not be on its servers yet, it is written again
+                stored = any(other.status == FileStatus.COMMITTED for other in others)
+            allocated.append([chunk_id, chunk_locs])
+            chunks.append([chunk_id, chunk_locs, stored])
+
+        # the chunks allocated before a failure are in the file already and go to the log either way
+        if allocated:
+            self.logger.log_info('allocate_content', [args[0], args[1], allocated])
+        if error is not None:
+            client.sendall(self.__respond_status(-1, error))
+            return
+        response = {
+            'status': 0,
+            'chunks': chunks
+        }
+        client.sendall(protocol.response(response))
 
     def commit_file(self, client, args):
         dir = args[0]
         file_name = args[1]
-        directory = [part for part in dir.split('/') if part]
-        curr_dir = self.root
-        for d in directory:
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
         file = curr_dir.files[file_name]
         file.status = FileStatus.COMMITTED
+        file.size = args[2] if len(args) > 2 else 0
         ip, port = client.getpeername()
-        lock_key = str(ip) + str(port)
-        self.client_to_file_lock.__delitem__(lock_key)
-        self.logger.log_info('commit_file', [args[0], args[1]])
+        self.locks.release(self._owner((ip, port)), file.inode)
+        self.logger.log_info('commit_file', [args[0], args[1], file.size])
+        # chunks that lost replicas during the upload
+        self.replication.check_file(file)
         print(f"File {file_name} committed by client {ip}:{port}")
 
 
+    def append_file(self, client, args):
+        # write locks a committed file for an append; the client writes the partial last chunk or
+        # stripe again with the new data behind it, into chunks readers do not see before commit_append
+        curr_dir = self.namespace.lookup_dir(args[0])
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
+        file = curr_dir.files.get(args[1])
+        if file is None:
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
+            return
+        if file.status != FileStatus.COMMITTED:
+            client.sendall(self.__respond_status(-1, 'File not committed'))
+            return
+        owner = self._owner(client.getpeername())
+        if not self.locks.acquire(owner, file.inode, lock_manager.EXCLUSIVE):
+            client.sendall(self.__respond_status(-1, 'File is locked by another client'))
+            return
+        with self._record_lock(file):
+            # record_chunk checks appending under the same lock
+            if file.open_chunk is not None or file.inode in self.record_opening:
+                error = 'File takes record appends, use record_append'
+            elif file.appending is not None:
+                error = 'File is being appended to'
+            else:
+                error = None
+                file.appending = {}
+        if error is not None:
+            self.locks.release(owner, file.inode)
+            client.sendall(self.__respond_status(-1, error))
+            return
+
+        tail = []
+        if file.size % file.chunk_size:
+            counts = erasure.parse_policy(file.policy)
+            unit = 1 if counts is None else sum(counts)
+            tail = list(itertools.islice(reversed(file.chunks), unit))[::-1]
+        file.append_tail = tail
+        self.logger.log_info('append_file', [args[0], args[1], tail])
+        response = {
+            'status': 0,
+            'size': file.size,
+            'chunk_size': file.chunk_size,
+            'codec': file.codec,
+            'policy': file.policy,
+            'tail': [[chunk_id, file.chunks[chunk_id]] for chunk_id in tail]
+        }
+        client.sendall(protocol.response(response))
+
+    def commit_append(self, client, args):
+        # args[2] is the number of bytes appended; the new chunks and the size change in one step
+        file = self.namespace.lookup_file(args[0], args[1])
+        if file is None or file.appending is None:
+            client.sendall(self.__respond_status(-1, 'No append in progress'))
+            return
+        size = file.size + args[2]
+        self.deletes.add(self.namespace.commit_append(file, size))
+        self.logger.log_info('commit_append', [args[0], args[1], size])
+        self.locks.release(self._owner(client.getpeername()), file.inode)
+        # chunks that lost replicas during the upload
+        self.replication.check_file(file)
+        client.sendall(self.__respond_status(0, 'Append committed'))
+
+    def abort_append(self, client, args):
+        file = self.namespace.lookup_file(args[0], args[1])
+        if file is None or file.appending is None:
+            client.sendall(self.__respond_status(-1, 'No append in progress'))
+            return
+        self._abort_append(file)
+        self.locks.release(self._owner(client.getpeername()), file.inode)
+        client.sendall(self.__respond_status(0, 'Append aborted'))
+
+    def _abort_append(self, file):
+        self.deletes.add(self.namespace.abort_append(file))
+        self.logger.log_info('abort_append', [file.parent.dfs_path, file.name])
+
+    def record_chunk(self, client, args):
+        # returns the chunk record appends to the file go to. args[2] is a chunk the client could
+        # not append a record to, with its size on the first replica in args[3]; if it is still the
+        # open chunk it is sealed and the file gets a new one
+        dfs_dir, dfs_name, failed_id, failed_size = args
+        file = self.namespace.lookup_file(dfs_dir, dfs_name)
+        if file is None:
+            client.sendall(self.__respond_status(-1, 'File does not exist'))
+            return
+        if file.status != FileStatus.COMMITTED:
+            client.sendall(self.__respond_status(-1, 'File not committed'))
+            return
+        if file.codec != compression.NONE or file.policy != erasure.REPLICATED:
+            # the chunk servers append records in place, which compressed chunks and stripes do not allow
+            client.sendall(self.__respond_status(-1, 'Record appends need an uncompressed replicated file'))
+            return
+        while True:
+            with self._record_lock(file):
+                if file.appending is not None:
+                    client.sendall(self.__respond_status(-1, 'File is being appended to'))
+                    return
+                opening = self.record_opening.get(file.inode)
+                if opening is None:
+                    if file.open_chunk is not None and failed_id != file.open_chunk:
+                        response = self._record_response(file)
+                        break
+                    # this producer opens the next chunk, the others wait for it below
+                    opening = self.record_opening[file.inode] = threading.Event()
+                    response = None
+                    break
+            opening.wait()
+        if response is not None:
+            client.sendall(protocol.response(response))
+            return
+
+        # the chunk servers are only talked to outside the lock, a slow one holds up this file alone
+        sealed = file.open_chunk
+        try:
+            chunk_id = self._create_chunk_id()
+            chunk_locs = self._create_empty_chunk(chunk_id, self._sample_chunk_locs())
+            if not chunk_locs:
+                client.sendall(self.__respond_status(-1, 'No chunk servers up'))
+                return
+            size = 0 if sealed is None else self._seal(sealed, file.chunks.get(sealed, []), failed_size)
+            with self._record_lock(file):
+                file.size += size
+                file.chunks[chunk_id] = chunk_locs
+                file.open_chunk = chunk_id
+                file_size = file.size
+                response = self._record_response(file)
+            self.logger.log_info('record_chunk', [dfs_dir, dfs_name, chunk_id, chunk_locs, file_size])
+        finally:
+            with self._record_lock(file):
+                del self.record_opening[file.inode]
+            opening.set()
+        if sealed is not None:
+            # the sealed chunk may have lost a replica while it was open
+            self.replication.check_file(file)
+        client.sendall(protocol.response(response))
+
+    def _record_lock(self, file):
+        return self.record_locks[file.inode % len(self.record_locks)]
+
+    def _record_response(self, file):
+        return {
+            'status': 0,
+            'chunk_id': file.open_chunk,
+            'chunk_locs': file.chunks[file.open_chunk],
+            'chunk_size': file.chunk_size
+        }
+
+    def _create_empty_chunk(self, chunk_id, chunk_locs):
+        # the chunk exists on its replicas before the first record reaches it, so it reads as empty
+        # until then; returns the replicas that stored it
+        for idx, chunk_loc in enumerate(chunk_locs):
+            try:
+                with self.pool.connection(chunk_loc) as sock:
+                    sock.sendall(protocol.request('master', 'write_chunk', [chunk_id, chunk_locs[idx + 1:]]))
+                    stored = protocol.recv_frame(sock).body.get('stored', [])
+            except OSError as e:
+                # the next replica leads the chain
+                print(f'Creating chunk {chunk_id} on chunk server {chunk_loc} failed: {e}')
+                continue
+            return [chunk_loc for chunk_loc in chunk_locs if chunk_loc in stored]
+        return []
+
+    def _seal(self, chunk_id, chunk_locs, failed_size):
+        # the replicas of the chunk refuse appends from now on, producers still holding it come
+        # back for the new one. Returns its size: the largest a replica answered with, or the size
+        # the failing client saw if none answered
+        sizes = [failed_size or 0]
+        for chunk_loc in chunk_locs:
+            try:
+                with self.pool.connection(chunk_loc) as sock:
+                    sock.sendall(protocol.request('master', 'seal_chunk', [chunk_id]))
+                    sizes.append(protocol.recv_frame(sock).body.get('size', 0))
+            except OSError as e:
+                print(f'Sealing chunk {chunk_id} on chunk server {chunk_loc} failed: {e}')
+        return max(sizes)
+
     def create_dir(self, client, args):
         dir_loc = args[0]
         new_dir = args[1]
         print(dir_loc, new_dir)
 
-        dir_loc = [part for part in dir_loc.split('/') if part]
-        curr_dir = self.root
-        
-        for d in dir_loc:
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(dir_loc)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
 
         if new_dir in curr_dir.subdirectories:
-            client.send(self.__respond_status(-1, 'Directory already exists'))
+            client.sendall(self.__respond_status(-1, 'Directory already exists'))
         else:
+            # the namespace changes before the record is logged, a snapshot taken in between holds the directory
+            self.namespace.add_dir(curr_dir, new_dir)
             self.logger.log_info('create_dir', [args[0], args[1]])
-            curr_dir.subdirectories[new_dir] = Directory(curr_dir.dfs_path + new_dir + '/')
-            client.send(self.__respond_status(0, 'Directory Created'))
+            client.sendall(self.__respond_status(0, 'Directory Created'))
         
     def commit_delete(self, client, args):
         dir = args[0]
         file_name = args[1]
-        directory = [part for part in dir.split('/') if part]
-        curr_dir = self.root
-        for d in directory:
-            if d not in curr_dir.subdirectories:
-                client.send(self.__respond_status(-1, 'Directory does not exist'))
-                return
-            curr_dir = curr_dir.subdirectories[d]
+        curr_dir = self.namespace.lookup_dir(dir)
+        if curr_dir is None:
+            client.sendall(self.__respond_status(-1, 'Directory does not exist'))
+            return
+        if file_name not in curr_dir.files:
+            # delete_file already removed it
+            client.sendall(self.__respond_status(0, 'File Deleted'))
+            return
         file = curr_dir.files[file_name]
-        ip, port = client.getpeername()
-        lock_key = str(ip) + str(port)
-        self.client_to_file_lock.__delitem__(lock_key)
-        curr_dir.files.pop(file_name)
+        self.locks.release(self._owner(client.getpeername()), file.inode)
+        self.deletes.add(self.namespace.release_chunks(file))
+        self.namespace.remove_file(curr_dir, file_name)
         self.logger.log_info('commit_delete', [args[0], args[1]])
-        client.send(self.__respond_status(0, 'File Deleted'))
+        client.sendall(self.__respond_status(0, 'File Deleted'))
 
 
     def close_connection(self, client):
         client.close()
 
     
+    def _owner(self, address):
+        # locks belong to the client connection
+        ip, port = address
+        return f'{ip}:{port}'
+
     def _create_chunk_id(self):
         return str(uuid.uuid4())
     
     def _sample_chunk_locs(self):
-        available_ports = []
-        for idx, port in enumerate(config.CHUNK_PORTS):
-            if idx not in self.dead_servers:
-                available_ports.append(idx)
-        chunk_locs = random.sample(available_ports, min(config.REPLICATION_FACTOR, len(available_ports)))
-        return chunk_locs
+        return self.placement.choose(config.REPLICATION_FACTOR)
         
 
     def __respond_message(self, function, args):
-        message = {
-            'sender_type': 'master',
-            'function': function,
-            'args': args
-        }
-        message = json.dumps(message).encode('utf-8')
-        message += b' ' * (config.MESSAGE_SIZE - len(message))
-        return message
+        return protocol.request('master', function, args)
 
     def __respond_status(self, code, message):
-        response =  {
-            'status': code,
-            'message': message
-        }
-        response = json.dumps(response).encode('utf-8')
-        response += b' ' * (config.MESSAGE_SIZE - len(response))
-        return response
+        return protocol.status(code, message)
     
     
 
@@ -664,5 +1616,8 @@ if __name__ == '__main__':
     ms = MasterServer(config.HOST, config.MASTER_PORT)
     print("\033[H\033[J")
     print('Master Server Running')
-    ms.listen()
+    if '--asyncio' in sys.argv[1:]:
+        ms.listen_async()
+    else:
+        ms.listen()
     
\ No newline at end of file
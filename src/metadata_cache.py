@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+def normalize(path):
+    return '/' + '/'.join(part for part in path.split('/') if part)
+
+
+class MetadataCache():
+    """Client side cache of file chunk maps and directory listings.
+
+    Every entry comes with a lease from the master and is only used until
+    the lease runs out, so a client sees changes made by other clients at
+    most `lease` seconds late. The master keeps the chunks of deleted files
+    for GC_GRACE seconds, longer than any lease, so a cached chunk map never
+    points at chunks that are already gone. At most `size` entries are kept,
+    the least recently used one is dropped first.
+    """
+    def __init__(self, size=config.METADATA_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, lease):
+        if not lease or self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + lease, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_server(self, chunk_loc):
+        """Drops the chunk maps that point at the chunk server."""
+        with self.lock:
+            for key, (_, value) in list(self.entries.items()):
+                if key[0] == 'file' and any(chunk_loc in chunk_locs for _, chunk_locs in value['chunks']):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def file_key(dfs_dir, dfs_name):
+        return ('file', normalize(dfs_dir), dfs_name)
+
+    @staticmethod
+    def dir_key(dfs_dir):
+        return ('dir', normalize(dfs_dir))
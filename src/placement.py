@@ -0,0 +1,77 @@
+import random
+
+import config
+
+
+class PlacementEngine():
+    """Chooses the chunk servers that receive new replicas.
+
+    Every live chunk server gets a weight from its last status report: its
+    free disk space, divided by how busy it is (in-flight writes plus recent
+    request rates). Weighting by free bytes rather than by the free fraction
+    fills big and small disks to the same level. Servers with less than
+    PLACEMENT_MIN_FREE_DISK bytes free get no new replicas. Replicas of one
+    chunk go to different failure domains (FAILURE_DOMAINS) as long as there
+    are domains left.
+
+    Modes: 'weighted' picks servers with probability proportional to their
+    weight, 'p2c' samples two servers and takes the better one, 'random'
+    ignores the weights.
+    """
+    def __init__(self, registry, mode=config.PLACEMENT_MODE, domains=config.FAILURE_DOMAINS):
+        if mode not in ('weighted', 'p2c', 'random'):
+            raise Exception(f'Unknown placement mode {mode}')
+        self.registry = registry
+        self.mode = mode
+        self.domains = domains
+
+    def choose(self, count, candidates=None, existing=()):
+        """Returns up to `count` servers out of `candidates` (default: all live ones) not in `existing`."""
+        if candidates is None:
+            candidates = self.registry.alive()
+        weights = {chunk_loc: self.weight(chunk_loc) for chunk_loc in candidates}
+        reported = [weight for weight in weights.values() if weight is not None]
+        if not reported:
+            # no reports yet: fall back to spreading evenly
+            weights = dict.fromkeys(candidates, 1.0)
+        else:
+            # servers that have not reported yet count as average ones, so none is chosen once every reported one is full
+            average = sum(reported) / len(reported)
+            weights = {chunk_loc: average if weight is None else weight for chunk_loc, weight in weights.items()}
+
+        used = {self.domain(chunk_loc) for chunk_loc in existing}
+        chosen = []
+        while len(chosen) < count:
+            left = [chunk_loc for chunk_loc in candidates
+                    if weights[chunk_loc] > 0 and chunk_loc not in chosen and chunk_loc not in existing]
+            if not left:
+                break
+            spread = [chunk_loc for chunk_loc in left if self.domain(chunk_loc) not in used]
+            chunk_loc = self._pick(spread or left, weights)
+            chosen.append(chunk_loc)
+            used.add(self.domain(chunk_loc))
+        return chosen
+
+    def weight(self, chunk_loc):
+        status = self.registry.status(chunk_loc)
+        if not status:
+            return None
+        free = status.get('free_disk', 0)
+        if free < config.PLACEMENT_MIN_FREE_DISK:
+            return 0.0
+        rates = status.get('reads_per_s', 0) + status.get('writes_per_s', 0)
+        busy = status.get('inflight_writes', 0) + rates * config.PLACEMENT_RATE_WEIGHT
+        return free / (1 + busy)
+
+    def domain(self, chunk_loc):
+        if self.domains is None:
+            return chunk_loc
+        return self.domains[chunk_loc]
+
+    def _pick(self, candidates, weights):
+        if self.mode == 'random' or len(candidates) == 1:
+            return random.choice(candidates)
+        if self.mode == 'p2c':
+            first, second = random.sample(candidates, 2)
+            return first if weights[first] >= weights[second] else second
+        return random.choices(candidates, [weights[chunk_loc] for chunk_loc in candidates])[0]
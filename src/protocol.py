@@ -0,0 +1,132 @@
+"""Framed wire protocol shared by the master, the chunk servers and the client.
+
+Every message is a fixed size header followed by a JSON body and an optional
+raw payload (chunk data is never put inside the JSON body):
+
+    magic (2s) | version (B) | type (B) | body length (I) | payload length (Q)
+
+The first frame on every connection is a HELLO carrying the protocol version,
+so peers speaking a different version (or the old 8192 byte space padded JSON
+messages) are told apart at connect time instead of failing mid request.
+"""
+import json
+import socket
+import struct
+from collections import namedtuple
+
+import config
+
+MAGIC = b'DF'
+VERSION = 1
+
+HELLO = 1
+REQUEST = 2
+RESPONSE = 3
+
+HEADER = struct.Struct('!2sBBIQ')
+
+Frame = namedtuple('Frame', ['type', 'body', 'payload_len'])
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+def encode(msg_type, body, payload_len=0):
+    body = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(MAGIC, VERSION, msg_type, len(body), payload_len) + body
+
+
+def request(sender_type, function, args, payload_len=0):
+    message = {
+        'sender_type': sender_type,
+        'function': function,
+        'args': args
+    }
+    return encode(REQUEST, message, payload_len)
+
+
+def response(body, payload_len=0):
+    return encode(RESPONSE, body, payload_len)
+
+
+def status(code, message, payload_len=0):
+    body = {
+        'status': code,
+        'message': message
+    }
+    return encode(RESPONSE, body, payload_len)
+
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError('Peer closed the connection')
+        received += n
+    return bytes(buf)
+
+
+def recv_payload(sock, size):
+    return recv_exact(sock, size)
+
+
+def _parse_header(header):
+    magic, version, msg_type, body_len, payload_len = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError('Peer is not speaking the DFS framed protocol')
+    if version != VERSION:
+        raise ProtocolError(f'Protocol version mismatch: peer {version}, local {VERSION}')
+    return msg_type, body_len, payload_len
+
+
+def recv_frame(sock):
+    msg_type, body_len, payload_len = _parse_header(recv_exact(sock, HEADER.size))
+    body = json.loads(recv_exact(sock, body_len)) if body_len else None
+    return Frame(msg_type, body, payload_len)
+
+
+def handshake(sock, sender_type):
+    sock.sendall(encode(HELLO, {'version': VERSION, 'sender_type': sender_type}))
+    frame = recv_frame(sock)
+    if frame.type != HELLO or frame.body.get('status') != 0:
+        raise ProtocolError(frame.body.get('message', 'Handshake rejected'))
+    return frame.body
+
+
+def accept(sock):
+    """Server side of the handshake, returns the HELLO body sent by the peer."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    header = recv_exact(sock, HEADER.size)
+    if header[:len(MAGIC)] != MAGIC:
+        # peers from before the framed protocol send space padded JSON
+        legacy = json.dumps({'status': -1, 'message': 'Protocol version mismatch, upgrade this peer'}).encode('utf-8')
+        legacy += b' ' * (config.MESSAGE_SIZE - len(legacy))
+        sock.sendall(legacy)
+        raise ProtocolError('Rejected peer using the legacy padded JSON protocol')
+    magic, version, msg_type, body_len, _ = HEADER.unpack(header)
+    if version != VERSION or msg_type != HELLO:
+        reply = {'status': -1, 'message': f'Protocol version mismatch: server speaks version {VERSION}'}
+        sock.sendall(encode(HELLO, reply))
+        raise ProtocolError(f'Rejected peer speaking protocol version {version}')
+    body = json.loads(recv_exact(sock, body_len))
+    sock.sendall(encode(HELLO, {'status': 0, 'version': VERSION}))
+    return body
+
+
+def connect(port, sender_type, host=config.HOST, timeout=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if timeout is not None:
+            sock.settimeout(timeout)
+        sock.connect((socket.gethostbyname(host), port))
+        # requests and replies are small frames followed by payloads, don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handshake(sock, sender_type)
+    except Exception:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,34 @@
+"""Framing of records written by record appends.
+
+Every record is stored as
+
+    MAGIC | length (I) | crc32 of the record (I) | record
+
+Record appends are at least once: a record whose append failed on some
+replica is appended again, so a file may hold it twice, and the replicas
+that missed the failed append hold zeros where it went. Readers step over
+everything that is not a whole frame with a matching checksum.
+"""
+import struct
+import zlib
+
+MAGIC = b'DFSR'
+HEADER = struct.Struct('!4sII')
+
+
+def frame(record):
+    return HEADER.pack(MAGIC, len(record), zlib.crc32(record)) + record
+
+
+def parse(data):
+    """Yields the records framed in data, skipping padding and torn frames."""
+    view = memoryview(data)
+    pos = data.find(MAGIC)
+    while 0 <= pos and pos + HEADER.size <= len(data):
+        _, length, crc = HEADER.unpack_from(data, pos)
+        end = pos + HEADER.size + length
+        if end <= len(data) and zlib.crc32(view[pos + HEADER.size:end]) == crc:
+            yield bytes(view[pos + HEADER.size:end])
+            pos = data.find(MAGIC, end)
+        else:
+            pos = data.find(MAGIC, pos + 1)
@@ -0,0 +1,70 @@
+import os
+import time
+
+import checksum
+import config
+
+
+class Scrubber():
+    """Checks the chunks of a chunk server against their checksums in the background.
+
+    The scrubber walks the chunk directory and reads every chunk that was
+    not checked within the last `interval` seconds; chunks a client read in
+    full count as checked, so the walk mostly reads cold chunks. Reads are
+    held to `rate` bytes per second to leave the disk to clients. Chunks
+    without checksums get them. A bad replica is moved aside and reported
+    to the master, which copies the chunk again from a good replica.
+    """
+    def __init__(self, server, rate=config.SCRUB_RATE, interval=config.SCRUB_INTERVAL):
+        self.server = server
+        self.rate = rate
+        self.interval = interval
+        self.next_read = 0 # earliest time the next read fits in the budget
+
+    def run(self):
+        while True:
+            self.scrub()
+            time.sleep(config.SCRUB_IDLE)
+
+    def scrub(self):
+        if not os.path.isdir(self.server.rootdir):
+            return
+        for entry in os.scandir(self.server.rootdir):
+            if not self.server.is_chunk(entry.name):
+                continue
+            if time.monotonic() - self.server.verified.get(entry.name, float('-inf')) < self.interval:
+                continue
+            self.check(entry.name)
+
+    def check(self, chunk_id):
+        chunk_path = os.path.join(self.server.rootdir, chunk_id)
+        try:
+            with open(chunk_path, 'rb') as f:
+                checked = checksum.check(f, chunk_path, throttle=self._throttle)
+                if not checked and not os.path.exists(checksum.sidecar(chunk_path)):
+                    checksum.create(f, chunk_path, throttle=self._throttle)
+        except FileNotFoundError:
+            # deleted while it was checked
+            return
+        except checksum.ChunkCorrupted:
+            # a record append may have grown the chunk during the throttled read, only a
+            # mismatch seen again while appends wait is real
+            try:
+                with self.server.chunk_lock(chunk_id), open(chunk_path, 'rb') as f:
+                    checksum.check(f, chunk_path)
+            except checksum.ChunkCorrupted as e:
+                self.server.quarantine(chunk_id, e)
+                return
+            except OSError:
+                return
+        except OSError as e:
+            print(f'Scrubbing chunk {chunk_id} failed: {e}')
+            return
+        self.server.verified[chunk_id] = time.monotonic()
+
+    def _throttle(self, num_bytes):
+        # sleep as long as reading num_bytes takes at the allowed rate
+        now = time.monotonic()
+        self.next_read = max(self.next_read, now) + num_bytes / self.rate
+        if self.next_read > now:
+            time.sleep(self.next_read - now)
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import config
+
+
+class ServerRegistry():
+    """Liveness and latest status report of every chunk server.
+
+    Chunk servers push a heartbeat with their status every
+    HEART_BEAT_INTERVAL seconds. A server is alive while its last heartbeat
+    is less than `timeout` seconds old, so failure detection takes the same
+    time however many chunk servers there are. Servers not heard from yet
+    count as alive for the first `timeout` seconds after the master starts,
+    while their first heartbeats come in.
+    """
+    def __init__(self, timeout=config.HEART_BEAT_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_seen = {} # chunk_loc -> time of the last heartbeat
+        self.reports = {} # chunk_loc -> last status report
+
+    def report(self, chunk_loc, report):
+        """Records a heartbeat, returns True if the server was not known to be alive before."""
+        now = time.monotonic()
+        with self.lock:
+            was_alive = chunk_loc in self.last_seen and self._alive(chunk_loc, now)
+            self.last_seen[chunk_loc] = now
+            self.reports[chunk_loc] = report
+        return not was_alive
+
+    def is_alive(self, chunk_loc):
+        with self.lock:
+            return self._alive(chunk_loc, time.monotonic())
+
+    def alive(self):
+        now = time.monotonic()
+        with self.lock:
+            return [chunk_loc for chunk_loc in range(config.NUM_CHUNKS) if self._alive(chunk_loc, now)]
+
+    def status(self, chunk_loc):
+        with self.lock:
+            return self.reports.get(chunk_loc, {})
+
+    def _alive(self, chunk_loc, now):
+        last_seen = self.last_seen.get(chunk_loc)
+        if last_seen is None:
+            return now - self.started < self.timeout
+        return now - last_seen < self.timeout
@@ -0,0 +1,383 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import compression
+import config
+import connection_pool
+import erasure
+import latency_tracker
+import protocol
+
+
+# connections to the chunk servers shared by every transfer of this process
+connections = connection_pool.ConnectionPool('client')
+# read latencies of the chunk servers, shared the same way
+latencies = latency_tracker.LatencyTracker()
+
+
+def write_chunk(chunk_loc, chunk_id, data):
+    with connections.connection(chunk_loc) as chunk_server:
+        request = protocol.request('client', 'write_chunk', [chunk_id], len(data))
+        chunk_server.sendall(request)
+        chunk_server.sendall(data)
+        response = protocol.recv_frame(chunk_server).body
+    if response['status'] != 0:
+        raise Exception(response['message'])
+
+
+def read_chunk(chunk_loc, chunk_id, offset=0, length=None):
+    with connections.connection(chunk_loc) as chunk_server:
+        request = protocol.request('client', 'read_chunk', [chunk_id, offset, length])
+        chunk_server.sendall(request)
+        frame = protocol.recv_frame(chunk_server)
+        data = protocol.recv_payload(chunk_server, frame.payload_len)
+    if frame.body['status'] != 0:
+        raise Exception(frame.body.get('message', 'read_chunk failed'))
+    return data
+
+
+def delete_chunk(chunk_loc, chunk_id):
+    with connections.connection(chunk_loc) as chunk_server:
+        request = protocol.request('client', 'delete_chunk', [chunk_id])
+        chunk_server.sendall(request)
+        return protocol.recv_frame(chunk_server).body
+
+
+def write_chunk_chain(chunk_locs, chunk_id, data):
+    """Sends the chunk once to the head of the replica chain, returns the replicas that stored it."""
+    for idx, chunk_loc in enumerate(chunk_locs):
+        try:
+            chunk_server = connections.acquire(chunk_loc)
+        except OSError:
+            # dead head, the next replica leads the chain
+            continue
+        try:
+            request = protocol.request('client', 'write_chunk', [chunk_id, chunk_locs[idx + 1:]], len(data))
+            chunk_server.sendall(request)
+            chunk_server.sendall(data)
+            stored = protocol.recv_frame(chunk_server).body.get('stored', [])
+        except BaseException:
+            chunk_server.close()
+            raise
+        connections.release(chunk_loc, chunk_server)
+        return stored
+    return []
+
+
+def append_chunk(chunk_locs, chunk_id, data, limit):
+    """Appends a record to a chunk through its replica chain, returns the answer of the first replica."""
+    if not chunk_locs:
+        return {'status': -1, 'message': f'Chunk {chunk_id} has no replicas'}
+    try:
+        with connections.connection(chunk_locs[0]) as chunk_server:
+            request = protocol.request('client', 'append_chunk', [chunk_id, chunk_locs[1:], None, limit], len(data))
+            chunk_server.sendall(request)
+            chunk_server.sendall(data)
+            return protocol.recv_frame(chunk_server).body
+    except OSError as e:
+        return {'status': -1, 'message': f'Chunk server {chunk_locs[0]} unreachable: {e}'}
+
+
+class UploadEngine():
+    """Reads a local file once and writes its chunks to all replicas in parallel.
+
+    At most `window` chunks are buffered or on the wire at any time, every
+    replica write of those chunks runs on a pool of `workers` threads. In
+    'chain' mode each chunk is sent once to its first replica, which forwards
+    it down the chain; in 'fanout' mode the client sends it to every replica.
+    Files with a codec have every chunk compressed on its own worker thread
+    before it is written. Files with an erasure coding policy are read a
+    stripe at a time, and each stripe is encoded on that thread into shards
+    that are written like chunks with a single replica; a stripe counts as
+    written while at most m of its shards failed. Chunks handed out without
+    locations are content-addressed chunks the chunk servers already hold,
+    they are read from the local file but not written.
+    """
+    def __init__(self, window=config.UPLOAD_WINDOW, workers=config.UPLOAD_WORKERS, chunk_size=config.CHUNK_SIZE,
+                 mode=config.REPLICATION_MODE, codec=compression.NONE, policy=erasure.REPLICATED):
+        self.window = max(1, min(window, config.TRANSFER_MEMORY // chunk_size))
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.mode = mode
+        self.codec = codec
+        self.code = erasure.code(policy)
+        self.stored_bytes = 0 # bytes written to the chunk servers, after compression and over all replicas or shards
+        self.skipped = 0 # chunks not written because they were stored already
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.window)
+        self.pending = {}   # unit -> writes not finished yet, a unit being a chunk or a stripe
+        self.units = {}     # unit -> chunk ids of the unit
+        self.written = {}   # chunk_id -> replicas holding the chunk
+        self.failed = {}    # chunk_id -> replicas the write failed on
+        self.aborted = False
+
+    def upload(self, local_path, chunks, head=b''):
+        """Writes the file chunk by chunk to the (chunk_id, chunk_locs) pairs yielded by chunks.
+
+        chunk_locs is None for a chunk that needs no writing. `head` is written
+        before the file, an append puts the partial last chunk of the file
+        being appended to there.
+
+        Returns the number of bytes written, head included.
+        """
+        num_bytes = 0
+        # the encoders finish, and hand their chunks to the writers, before the writers shut down
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, ThreadPoolExecutor(max_workers=self.workers) as encoders:
+            with open(local_path, 'rb', buffering=config.UPLOAD_READ_BUFFER) as f:
+                read = self._reader(f, head)
+                for entries in self._units(chunks):
+                    if entries[0][1] is None:
+                        num_bytes += len(read(self.chunk_size))
+                        self.skipped += 1
+                        continue
+                    self.slots.acquire()
+                    if self.aborted:
+                        self.slots.release()
+                        break
+                    data = read(self.chunk_size)
+                    num_bytes += len(data)
+                    unit = entries[0][0]
+                    with self.lock:
+                        self.units[unit] = [chunk_id for chunk_id, _ in entries]
+                        # held until every write of the unit is submitted
+                        self.pending[unit] = 1
+                        for chunk_id, _ in entries:
+                            self.written[chunk_id] = []
+                    if self.codec == compression.NONE and self.code is None:
+                        self._write(pool, unit, entries, [data])
+                    else:
+                        future = encoders.submit(self._encode, data)
+                        future.add_done_callback(lambda future, unit=unit, entries=entries: self._encoded(future, pool, unit, entries))
+        return num_bytes
+
+    @staticmethod
+    def _reader(f, head):
+        head = memoryview(head)
+        def read(size):
+            nonlocal head
+            if not head:
+                return f.read(size)
+            data = bytes(head[:size])
+            head = head[size:]
+            if len(data) < size:
+                data += f.read(size - len(data))
+            return data
+        return read
+
+    def _units(self, chunks):
+        # a chunk at a time, or the k + m shards of a stripe at a time
+        if self.code is None:
+            for entry in chunks:
+                yield [entry]
+            return
+        chunks = iter(chunks)
+        for entry in chunks:
+            yield [entry] + list(itertools.islice(chunks, self.code.k + self.code.m - 1))
+
+    def _encode(self, data):
+        data = compression.encode(self.codec, data)
+        return [data] if self.code is None else self.code.encode(data)
+
+    def _encoded(self, future, pool, unit, entries):
+        if future.exception() is not None:
+            # the unit reaches no chunk server, which aborts the upload
+            print(f'Encoding chunk {unit} failed: {future.exception()}')
+            self._write_done(unit)
+            return
+        self._write(pool, unit, entries, future.result())
+
+    def _write(self, pool, unit, entries, pieces):
+        for (chunk_id, chunk_locs), data in zip(entries, pieces):
+            if not chunk_locs:
+                continue
+            with self.lock:
+                self.stored_bytes += len(data) * len(chunk_locs)
+            if self.mode == 'chain':
+                with self.lock:
+                    self.pending[unit] += 1
+                future = pool.submit(write_chunk_chain, chunk_locs, chunk_id, data)
+                future.add_done_callback(lambda future, chunk_id=chunk_id, chunk_locs=chunk_locs: self._chain_done(future, unit, chunk_id, chunk_locs))
+                continue
+            for chunk_loc in chunk_locs:
+                with self.lock:
+                    self.pending[unit] += 1
+                future = pool.submit(write_chunk, chunk_loc, chunk_id, data)
+                future.add_done_callback(lambda future, chunk_id=chunk_id, chunk_loc=chunk_loc: self._replica_done(future, unit, chunk_id, chunk_loc))
+        self._write_done(unit)
+
+    def lost_chunks(self):
+        return [chunk_id for chunk_id, locs in self.written.items() if not locs]
+
+    def _replica_done(self, future, unit, chunk_id, chunk_loc):
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                self.written[chunk_id].append(chunk_loc)
+            else:
+                self.failed.setdefault(chunk_id, []).append(chunk_loc)
+        self._write_done(unit)
+
+    def _chain_done(self, future, unit, chunk_id, chunk_locs):
+        stored = future.result() if future.exception() is None else []
+        with self.lock:
+            self.written[chunk_id] = [chunk_loc for chunk_loc in chunk_locs if chunk_loc in stored]
+            failed = [chunk_loc for chunk_loc in chunk_locs if chunk_loc not in stored]
+            if failed:
+                self.failed[chunk_id] = failed
+        self._write_done(unit)
+
+    def _write_done(self, unit):
+        with self.lock:
+            self.pending[unit] -= 1
+            if self.pending[unit]:
+                return
+            del self.pending[unit]
+            lost = sum(1 for chunk_id in self.units.pop(unit) if not self.written[chunk_id])
+            if lost > (0 if self.code is None else self.code.m):
+                # the unit can not be read back, the file can not be committed
+                self.aborted = True
+        self.slots.release()
+
+
+class DownloadEngine():
+    """Fetches up to `window` chunks at once and writes them to a sink in file order.
+
+    Only the chunks inside the window are held in memory, so memory use does
+    not depend on the size of the file being read. Each chunk is read from
+    its fastest replica first; when that read takes longer than the hedge
+    delay, the next replica is read as well and the first answer wins.
+    Chunks of files with a codec are decompressed by the worker that read
+    them. Stripes of erasure coded files are read from their k data shards;
+    a parity shard is read as well for every data shard that fails or takes
+    longer than the hedge delay, and the stripe is decoded from the first k
+    shards that arrive.
+    """
+    def __init__(self, window=config.DOWNLOAD_WINDOW, workers=config.DOWNLOAD_WORKERS, chunk_size=config.CHUNK_SIZE,
+                 tracker=None, codec=compression.NONE, policy=erasure.REPLICATED):
+        self.window = max(1, min(window, config.TRANSFER_MEMORY // chunk_size))
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.tracker = tracker or latencies
+        self.codec = codec
+        self.code = erasure.code(policy)
+        self.unreachable = set() # chunk servers a read failed on
+        self.chunks_done = 0 # entries of the chunk map written to the sink so far, k + m per stripe
+        self.bytes_done = 0
+        self.hedged = 0 # reads repeated on another replica, or parity shards read in place of slow data shards
+
+    def download(self, chunks, sink, size=None):
+        """Writes the (chunk_id, chunk_locs) chunks in order to the file-like sink, returns the bytes written.
+
+        Erasure coded files need the `size` of the data the chunks hold, to cut
+        the padding off the last stripe.
+        """
+        num_bytes = 0
+        in_flight = deque()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        # the reads themselves, at most two per chunk or k + m per stripe; the slower ones of a hedge are left to finish
+        reads = 2 if self.code is None else self.code.k + self.code.m
+        self.requests = ThreadPoolExecutor(max_workers=self.workers * reads)
+        try:
+            for idx, entries in enumerate(self._units(chunks)):
+                if self.code is None:
+                    future = pool.submit(self._fetch, *entries[0])
+                else:
+                    length = min(self.chunk_size, size - idx * self.chunk_size)
+                    future = pool.submit(self._fetch_stripe, entries, length)
+                in_flight.append((future, len(entries)))
+                if len(in_flight) >= self.window:
+                    num_bytes += self._drain(in_flight, sink)
+            while in_flight:
+                num_bytes += self._drain(in_flight, sink)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.requests.shutdown(wait=False)
+        return num_bytes
+
+    def _units(self, chunks):
+        # a chunk at a time, or the k + m shards of a stripe at a time
+        if self.code is None:
+            for entry in chunks:
+                yield [entry]
+            return
+        chunks = iter(chunks)
+        for entry in chunks:
+            yield [entry] + list(itertools.islice(chunks, self.code.k + self.code.m - 1))
+
+    def _drain(self, in_flight, sink):
+        future, entries = in_flight.popleft()
+        data = future.result()
+        sink.write(data)
+        self.chunks_done += entries
+        self.bytes_done += len(data)
+        return len(data)
+
+    def _fetch(self, chunk_id, chunk_locs):
+        # fastest replica first, fall back to the next replica when one fails
+        replicas = deque(self.tracker.order(chunk_locs))
+        running = {} # future -> chunk_loc
+        while True:
+            if not running:
+                if not replicas:
+                    raise Exception('too many chunkservers down')
+                chunk_loc = replicas.popleft()
+                running[self.requests.submit(self._read, chunk_loc, chunk_id)] = chunk_loc
+            delay = self.tracker.hedge_delay() if replicas and len(running) == 1 else None
+            done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # the read is slower than the hedge percentile, race it against the next replica
+                chunk_loc = replicas.popleft()
+                running[self.requests.submit(self._read, chunk_loc, chunk_id)] = chunk_loc
+                self.hedged += 1
+                continue
+            for future in done:
+                chunk_loc = running.pop(future)
+                if future.exception() is None:
+                    return compression.decode(self.codec, future.result())
+                self.unreachable.add(chunk_loc)
+
+    def _fetch_stripe(self, entries, length):
+        # data shards first; every failed or slow shard brings in the next parity shard
+        spare = deque(range(self.code.k, len(entries)))
+        running = {self.requests.submit(self._read_any, *entries[idx]): idx for idx in range(self.code.k)}
+        shards = {}
+        while len(shards) < self.code.k:
+            if not running:
+                raise Exception('too many chunkservers down')
+            delay = self.tracker.hedge_delay() if spare else None
+            done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                idx = spare.popleft()
+                running[self.requests.submit(self._read_any, *entries[idx])] = idx
+                self.hedged += 1
+                continue
+            for future in done:
+                idx = running.pop(future)
+                if future.exception() is None:
+                    shards[idx] = future.result()
+                elif spare:
+                    idx = spare.popleft()
+                    running[self.requests.submit(self._read_any, *entries[idx])] = idx
+        stripe = self.code.decode(dict(itertools.islice(shards.items(), self.code.k)))
+        return compression.decode(self.codec, stripe, padded=True)[:length]
+
+    def _read_any(self, chunk_id, chunk_locs):
+        for chunk_loc in chunk_locs:
+            try:
+                return self._read(chunk_loc, chunk_id)
+            except Exception:
+                self.unreachable.add(chunk_loc)
+        raise Exception(f'No replica of chunk {chunk_id} answered')
+
+    def _read(self, chunk_loc, chunk_id):
+        start = time.monotonic()
+        try:
+            data = read_chunk(chunk_loc, chunk_id)
+        except Exception:
+            self.tracker.failed(chunk_loc)
+            raise
+        self.tracker.record(chunk_loc, time.monotonic() - start)
+        return data